@@ -48,6 +48,7 @@ setup(
     version = "1.0.0",
     packages = ['restorable_collections', ],
     package_dir = { 'restorable_collections' : 'source/restorable_collections/' },
+    extras_require = { 'background' : ['futures; python_version < "3"', ], },
     author = 'Alexis Petrounias <www.petrounias.org>',
     maintainer = 'Alexis Petrounias <www.petrounias.org>',
     keywords = 'collections, pickle, pickling, unpickling, cPickle, cycles, self-references',
@@ -61,6 +62,9 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     zip_safe = True)
@@ -61,12 +61,102 @@ __maintainer__ = (u"Alexis Petrounias <www.petrounias.org>", )
 __author__ = (u"Alexis Petrounias <www.petrounias.org>", )
 
 # Python
-from collections import MutableMapping, MutableSet, OrderedDict, defaultdict
+import gc, os, re
+from binascii import hexlify
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from errno import ENOENT
+from itertools import chain, compress
+from mmap import ACCESS_READ, mmap
+from multiprocessing import Pool, cpu_count
+from operator import eq, methodcaller, not_
+from pickle import Pickler, PicklingError, Unpickler, UnpicklingError
+from struct import Struct
+from sys import version_info
+from threading import Event, local
+from time import time
+from timeit import default_timer
+from types import BuiltinFunctionType, FunctionType, ModuleType
+from weakref import WeakKeyDictionary, WeakValueDictionary, ref
+from zlib import crc32
 
-__all__ = ('VERSION', 'Restorable', 'RestorableDict', 'RestorableOrderedDict', )
+# Python 2 and 3
+try:
+    import cPickle
+except ImportError:
+    import pickle as cPickle
+try:
+    from collections.abc import ItemsView, Iterable, KeysView, Mapping, \
+        MutableMapping, MutableSet, Set, ValuesView
+except ImportError:
+    from collections import ItemsView, Iterable, KeysView, Mapping, \
+        MutableMapping, MutableSet, Set, ValuesView
+try:
+    from copyreg import __newobj__, dispatch_table
+except ImportError:
+    from copy_reg import __newobj__, dispatch_table
+try:
+    from _thread import allocate_lock, get_ident
+except ImportError:
+    from thread import allocate_lock, get_ident
+try:
+    from multiprocessing import get_context
+except ImportError:
+    get_context = None
+try:
+    from os import replace as _replace
+except ImportError:
+    from os import rename as _replace
+
+if version_info[0] < 3:
+    _iterkeys = methodcaller('iterkeys')
+    _itervalues = methodcaller('itervalues')
+    _iteritems = methodcaller('iteritems')
+    _viewkeys = methodcaller('viewkeys')
+    _text, _integers, _range = unicode, (int, long), xrange
+else:
+    _iterkeys = methodcaller('keys')
+    _itervalues = methodcaller('values')
+    _iteritems = methodcaller('items')
+    _viewkeys = methodcaller('keys')
+    _text, _integers, _range = str, (int, ), range
+
+# Optional
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+try:
+    from pickle import PickleBuffer
+except ImportError:
+    PickleBuffer = None
+
+__all__ = ('VERSION', 'Restorable', 'RestorableDict', 'RestorableOrderedDict',
+    'Restoration', 'restoring', 'restoring_load', 'restoring_loads',
+    'RestorationCounters', 'RestorationStatistics', 'enable_instrumentation',
+    'disable_instrumentation', 'restoration_statistics',
+    'RestorableOrderedSet', 'RestorableOrderedDefaultDict',
+    'RestorableCounter', 'RestorableFrozenSet', 'RestorableFrozenDict',
+    'RestorableWeakKeyDict', 'RestorableWeakValueDict', 'RestorableLRUDict',
+    'RestorableKeyedDict', 'RestorationDelta', 'apply_deltas',
+    'RestorationSnapshot', 'RestorableMappedDict', 'OUT_OF_BAND_THRESHOLD',
+    'RestorablePickler', 'RestorableUnpickler', 'CyclicCollection',
+    'find_cyclic_collections', 'RestorableShardedDict', 'dump_sharded',
+    'load_sharded', )
 
 VERSION = (1, 0, 0)
 
+#: Size in bytes from which binary values of restorable collections are pickled
+#: out of band with pickle protocol 5 and later; see
+#: :meth:`Restorable.__reduce_ex__`.
+OUT_OF_BAND_THRESHOLD = 1 << 16
+
+try:
+    _cpu_count = cpu_count()
+except NotImplementedError:
+    _cpu_count = 1
+
 
 class Restorable(object):
     """
@@ -87,54 +177,291 @@ class Restorable(object):
     information necessary for :meth:`_restore` to complete; inheriting from this
     class therefore means responsibility for providing appropriate state is with
     the subclass :meth:`__getstate__`.
+
+    Interception of attribute access is only ever performed by objects which
+    are pending restoration: :meth:`__setstate__` switches the class of the
+    unpickled object to a pending variant of its own class (see
+    :class:`_PendingRestoration`), and the object switches back to its own class
+    once restored. Objects which have never been unpickled, or which have
+    already been restored, therefore incur no attribute access overhead at all.
+
+    The wrapped :attr:`_contents` and all restoration state are held in
+    :attr:`__slots__` rather than a per-instance :attr:`__dict__`, in order to
+    keep large numbers of small collections compact; subclasses should declare
+    empty :attr:`__slots__` of their own in order to remain compact.
+
+    Changes can be tracked in order to checkpoint objects incrementally (see
+    :meth:`track_changes`), by switching them to an observed variant of their
+    class which notifies the :attr:`_observers` of each change.
     """
 
+    __slots__ = ('_contents', '_restoration_data', '_restoration_lock',
+        '_restoration_thread', '_observers', '__weakref__', )
+
+    #: Class-level marker, `True` only for pending variants of a class.
+    _requires_restoration = False
+
+    #: Class-level marker, `True` only for observed variants of a class.
+    _observed = False
+
+    #: The mix-in class of observed variants of this class, or `None` if
+    #: changes to instances of this class cannot be observed.
+    _observed_mixin = None
+
+    #: The mix-in class of pending variants of this class, serving reads which
+    #: need not restore from :attr:`_restoration_data`, or `None`.
+    _pending_mixin = None
+
     def __init__(self):
         """
-        Marks this :class:`Restorable` with :attr:`_requires_restoration` as
-        `False` because collections do not need to be restored unless they have
-        just been unpickled.
+        Collections do not need to be restored unless they have just been
+        unpickled, which the class-level :attr:`_requires_restoration` marker
+        already reflects; no per-instance marker is maintained.
         """
-        self._requires_restoration = False
+        pass
 
     def __setstate__(self, state):
         """
-        After performing default object state restoration by assigning *state*
-        to this object's internal :attr:`__dict__`, sets the
-        :attr:`_requires_restoration` marker to `True` so that during the next
-        wrapped :attr`_`contents` attribute access :meth`_restore` is called.
+        After performing default object state restoration by assigning each
+        item of the *state* :class:`dict` as an attribute of this object,
+        switches the class of this object to its pending variant, whose :attr:`_requires_restoration`
+        marker is `True`, so that during the next wrapped :attr:`_contents`
+        attribute access :meth:`_restore` is called. A
+        :attr:`_restoration_lock` is also allocated, which guards restoration
+        against concurrent access by multiple threads.
+
+        If this object is unpickled within a :func:`restoring` context, it is
+        also tracked by that context's :class:`Restoration`.
 
         If you inherit from :class:`Restorable` and override
-        :meth:`__setstate__` then you must ensure the
-        :attr:`_requires_restoration` market is set to `True`.
+        :meth:`__setstate__` then you must ensure that this method is invoked.
 
         :param object state: the unpickled state of this object.
         """
-        self.__dict__ = state
-        self._requires_restoration = True
+        for name, value in _iteritems(state):
+            setattr(self, name, value)
+        self._restoration_lock = allocate_lock()
+        self._restoration_thread = None
+        if _statistics is not None:
+            _statistics._unpickled(_public_class(type(self)))
+        self.__class__ = _pending_class(type(self))
+        restorations = getattr(_tracking, 'restorations', None)
+        if restorations:
+            restorations[-1].restorables.append(self)
 
-    def __getattribute__(self, item):
+    def __reduce_ex__(self, protocol):
         """
-        Intercepts attribute access to this object so that the first time the
-        wrapped :attr:`_contents` attribute is accessed the object is restored
-        if necessary. This is achieved by checking whether
-        :attr:`_requires_restoration` is `True` and if so, sets the marker to
-        `False` and invokes :meth:`_restore`. Since the marker is set to `False`
-        prior to invocation of the restoration logic, implementations of
-        :meth:`_restore` are free to access thi object and its wrapped
-        :attr:`_contents` without entering an indefinite recursion through this
-        interceptor. Sets :attr:`_restoration_data` to None afterwards so that
-        no pointers remain to potentially removed keys.
+        Reduces this object to its class and the state returned by its
+        :meth:`__getstate__`, for all pickle protocols. The state is always
+        included, even when empty, so that :meth:`__setstate__` is invoked
+        during unpickling of empty collections. Pending and observed variants
+        reduce to the class they are variants of.
 
-        :param str item: the attribute of interest.
-        :return: the value of the attribute.
+        From pickle protocol 5 onwards, binary values of at least
+        :data:`OUT_OF_BAND_THRESHOLD` bytes are wrapped in
+        :class:`PickleBuffer` objects (see :meth:`_out_of_band`), which pickling
+        with a *buffer_callback* hands over out of band rather than copying
+        them into the pickle; unpickling with the corresponding *buffers* then
+        loads such values as the buffers given, such as views of shared memory,
+        without copying them either. Pickled in band, values are loaded as
+        :class:`bytes`, or as :class:`bytearray` if writable. The state of
+        subclasses defining their own :meth:`__getstate__` or
+        :meth:`__setstate__` is pickled as it is.
+
+        :param int protocol: the pickle protocol in use.
+        :return: the reduction of this object.
         """
-        if item == '_contents':
-            if self._requires_restoration:
-                self._requires_restoration = False
-                self._restore(self._restoration_data)
-                self._restoration_data = None
-        return object.__getattribute__(self, item)
+        cls = _public_class(type(self))
+        state = self.__getstate__()
+        if protocol >= 5 and PickleBuffer is not None and _native_state(cls):
+            state = self._out_of_band(state)
+        if cls is type(self):
+            return __newobj__, (cls, ), state
+        # pickle refuses __newobj__ for objects of another class
+        return _new_restorable, (cls, ), state
+
+    def __copy__(self):
+        """
+        Returns a shallow copy of this object by natively copying the wrapped
+        :attr:`_contents`. Subclasses holding additional state must copy it
+        too. Objects of subclasses defining their own :meth:`__getstate__` or
+        :meth:`__setstate__` are copied through their state instead, as
+        :func:`copy.copy` would.
+
+        :return: a shallow copy of this object.
+        """
+        cls = _public_class(type(self))
+        copy = cls.__new__(cls)
+        if not _native_state(cls):
+            # whose keys are complete, unlike those of unpickled objects
+            copy.__setstate__(self.__getstate__())
+            _complete_restoration(copy)
+            return copy
+        copy._contents = self._contents.copy()
+        return copy
+
+    def __deepcopy__(self, memo):
+        """
+        Returns a deep copy of this object, whose keys (or elements) are deep
+        copies registered in *memo*, bypassing pickling altogether.
+
+        Copying cycles faces the same problem as unpickling them: a deep copy
+        of a key may still be incomplete, because it is being copied by a
+        caller of this method, and may therefore not be hashed yet. The copy is
+        consequently created pending restoration from the copied state, as if
+        it had been unpickled; however, when this object is the outermost
+        object being copied, all copies are complete by the time its state has
+        been copied, and the copy is restored at once.
+
+        :param dict memo: the :func:`deepcopy` memo.
+        :return: a deep copy of this object.
+        """
+        outermost = not memo
+        cls = _public_class(type(self))
+        copy = cls.__new__(cls)
+        memo[id(self)] = copy
+        if _native_state(cls):
+            state = self._deepcopy_state(memo)
+        else:
+            state = deepcopy(self.__getstate__(), memo)
+        copy.__setstate__(state)
+        if outermost:
+            _complete_restoration(copy)
+        return copy
+
+    def _deepcopy_state(self, memo):
+        """
+        Returns a deep copy of the state of this object, for
+        :meth:`__deepcopy__`. Subclasses whose state holds their entries (or
+        elements) deep-copy them straight from the wrapped :attr:`_contents`
+        once restored, rather than deep-copying an intermediate state; objects
+        pending restoration are copied from their pending state instead, so
+        that copying does not restore them.
+
+        Not used for subclasses defining their own :meth:`__getstate__` or
+        :meth:`__setstate__`, whose state is deep-copied as a whole.
+
+        :param dict memo: the :func:`deepcopy` memo.
+        :return: the state of the deep copy.
+        """
+        return deepcopy(self.__getstate__(), memo)
+
+    def track_changes(self, enabled = True):
+        """
+        Starts, or restarts, recording the keys (or elements) changed by
+        mutations of this object, so that :meth:`dump_delta` need only emit
+        what changed. Tracking switches this object to an observed variant of
+        its class, so that untracked objects incur no overhead at all.
+
+        :param bool enabled: `False` in order to stop tracking changes.
+        :raises TypeError: if changes to this class cannot be tracked.
+        """
+        journal = _journal(self)
+        if journal is not None:
+            _unobserve(self, journal)
+        if enabled:
+            _observe(self, _Journal())
+
+    def dump_delta(self):
+        """
+        Returns the changes of this object since :meth:`track_changes` or the
+        previous :meth:`dump_delta`, whose cost is proportional to the number
+        of changed keys (or elements). Clearing, and removal from ordered
+        collections, cannot be expressed as individual changes, in which case
+        the delta holds the entire state instead.
+
+        :return: a pickleable :class:`RestorationDelta`.
+        :raises ValueError: if changes are not being tracked.
+        """
+        journal = _journal(self)
+        if journal is None:
+            raise ValueError('changes are not being tracked')
+        if journal.everything:
+            delta = RestorationDelta(state = self.__getstate__())
+        else:
+            delta = RestorationDelta(changes = self._delta(list(journal.keys)))
+        journal.reset()
+        return delta
+
+    def apply_delta(self, delta):
+        """
+        Applies a :class:`RestorationDelta` dumped by an object of the same
+        class to this object, which must not be tracking changes.
+
+        :param RestorationDelta delta: the delta to apply.
+        """
+        if type(self)._observed:
+            raise TypeError('cannot apply deltas while observing changes')
+        if delta.state is not None:
+            self.__setstate__(delta.state)
+        else:
+            self._apply_delta(delta.changes)
+
+    def snapshot(self):
+        """
+        Returns a frozen view of this object as it is now, which pickles as an
+        object of the same class holding the current contents, regardless of
+        changes to this object in the meantime.
+
+        Taking a snapshot takes constant time: the snapshot observes this
+        object, saving the previous value of each key (or element) the first
+        time it changes, until it is released with
+        :meth:`RestorationSnapshot.release`. Pickling the snapshot copies the contents at once and reverts the
+        saved changes, so that writers may continue concurrently. Classes
+        whose changes cannot be observed are copied immediately instead.
+
+        :return: a :class:`RestorationSnapshot` of this object.
+        """
+        return RestorationSnapshot(self)
+
+    def _delta(self, keys):
+        """
+        Abstract method returning the changes of the wrapped :attr:`_contents`
+        regarding *keys*, in the form accepted by :meth:`_apply_delta`; must be
+        overridden by subclasses whose changes can be observed.
+
+        :param list keys: the changed keys (or elements).
+        :raises NotImplementedError: if not overridden by the subclass
+        """
+        raise NotImplementedError(
+            "you must specify the _delta method with the Restorable type")
+
+    def _apply_delta(self, changes):
+        """
+        Abstract method applying *changes* returned by :meth:`_delta` to the
+        wrapped :attr:`_contents`; must be overridden by subclasses whose
+        changes can be observed.
+
+        :param object changes: the changes to apply.
+        :raises NotImplementedError: if not overridden by the subclass
+        """
+        raise NotImplementedError(
+            "you must specify the _apply_delta method with the Restorable type")
+
+    def _out_of_band(self, state):
+        """
+        Returns *state*, as returned by :meth:`__getstate__`, with its large
+        binary values wrapped by :func:`_out_of_band_value`; by default *state*
+        itself, for subclasses which do not hold such values.
+
+        :param object state: the pickled state of this object.
+        :return: the pickled state of this object for pickle protocol 5.
+        """
+        return state
+
+    def _pending_state(self, restoration_data):
+        """
+        Returns the state :meth:`__getstate__` would return once this object
+        were restored from *restoration_data*, without restoring it; by default
+        *restoration_data* itself, for subclasses whose restoration data is
+        their entire pickled state. Must not access the wrapped
+        :attr:`_contents`.
+
+        :param object restoration_data: the restoration data of this object,
+            which is pending restoration.
+        :return: the pickled state of this object.
+        """
+        return restoration_data
 
     def _restore(self, restoration_data):
         """
@@ -155,125 +482,4141 @@ class Restorable(object):
             "you must specify the _restore method with the Restorable type")
 
 
-class RestorableDict(MutableMapping, Restorable, object):
+class _PendingRestoration(object):
     """
-    A :class:`MutableMapping` restorable wrapper of a :class:`dict`.
+    Mix-in class of the pending variants of :class:`Restorable` classes, as
+    created by :func:`_pending_class`. Instances of pending variants have been
+    unpickled but not yet restored; once restored, they switch back to their
+    :attr:`_restored_class`.
     """
 
-    def __init__(self, *args, **kwargs):
-        self._contents = dict(*args, **kwargs)
-        Restorable.__init__(self)
+    __slots__ = ()
+
+    _requires_restoration = True
+
+    def __getattribute__(self, item):
+        """
+        Intercepts attribute access to this object so that the first time the
+        wrapped :attr:`_contents` attribute is accessed the object is restored.
+        Since access by the thread performing the restoration is not
+        intercepted, implementations of :meth:`_restore` are free to access
+        this object and its wrapped :attr:`_contents` without entering an
+        indefinite recursion through this interceptor.
+
+        :param str item: the attribute of interest.
+        :return: the value of the attribute.
+        """
+        if item == '_contents':
+            _complete_restoration(self)
+        return object.__getattribute__(self, item)
 
     def __getstate__(self):
-        return [ (key, value) for key, value in self._contents.iteritems() ]
+        """
+        Returns the state of this object without restoring it, as converted
+        from its :attr:`_restoration_data` by :meth:`Restorable._pending_state`,
+        so that re-pickling objects which have not been accessed since they
+        were unpickled neither rehashes their keys nor restores collections
+        nested in them. Objects of subclasses defining their own
+        :meth:`__getstate__` or :meth:`__setstate__`, whose state this object
+        does not know, are restored and pickled by their own
+        :meth:`__getstate__` instead.
+        """
+        cls = _public_class(type(self))
+        restoration_data = _pending_data(self)
+        if restoration_data is None or not _native_state(cls):
+            return cls.__getstate__(self)
+        return self._pending_state(restoration_data)
 
-    def __setstate__(self, state):
-        Restorable.__setstate__(self, {
-            '_contents' : dict(),
-            '_restoration_data' : state,
-        })
 
-    def _restore(self, restoration_data):
-        for (key, value) in restoration_data:
-            self._contents[key] = value
+def _out_of_band_value(value):
+    """
+    :return: *value* wrapped in a :class:`PickleBuffer` if it is a binary value
+        of at least :data:`OUT_OF_BAND_THRESHOLD` bytes, otherwise *value*
+        itself.
+    """
+    cls = type(value)
+    if cls is bytes or cls is bytearray:
+        size = len(value)
+    elif cls is memoryview and value.contiguous:
+        size = value.nbytes
+    else:
+        return value
+    return PickleBuffer(value) if size >= OUT_OF_BAND_THRESHOLD else value
 
-    def __getitem__(self, item):
-        return self._contents[item]
 
-    def __setitem__(self, key, value):
-        self._contents[key] = value
+def _pending_data(restorable):
+    """
+    :return: the :attr:`_restoration_data` of *restorable* if it is pending
+        restoration, or `None` once restored.
+    """
+    # restoration clears the data before switching the class back
+    data = object.__getattribute__(restorable, '_restoration_data')
+    return data if type(restorable)._requires_restoration else None
 
-    def __delitem__(self, key):
-        del self._contents[key]
+
+class _PendingMapping(object):
+    """
+    Mix-in class of the pending variants of :class:`RestorableDict` classes
+    whose :attr:`_restoration_data` is the list of pickled entries, as created
+    by :func:`_pending_class`.
+
+    Lengths and scans of the entries do not hash keys, and are therefore
+    served from the pickled entries without restoring; lookups by key and
+    mutations restore as usual. Entries are scanned in their pickled order,
+    which unordered collections need not retain once restored. As with
+    dictionaries, :meth:`keys`, :meth:`values` and :meth:`items` return lists
+    on Python 2 and views on Python 3, which remain valid once restored.
+    """
+
+    __slots__ = ()
+
+    def __len__(self):
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).__len__(self)
+        return len(entries)
 
     def __iter__(self):
-        return iter(self._contents)
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).__iter__(self)
+        return (key for key, value in entries)
+
+    def keys(self):
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).keys(self)
+        if version_info[0] < 3:
+            return [ key for key, value in entries ]
+        return KeysView(self)
+
+    def values(self):
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).values(self)
+        if version_info[0] < 3:
+            return [ value for key, value in entries ]
+        return _PendingValuesView(self)
+
+    def items(self):
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).items(self)
+        if version_info[0] < 3:
+            return [ (key, value) for key, value in entries ]
+        return _PendingItemsView(self)
+
+    def iterkeys(self):
+        return self.__iter__()
+
+    def itervalues(self):
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).itervalues(self)
+        return (value for key, value in entries)
+
+    def iteritems(self):
+        entries = _pending_data(self)
+        if entries is None:
+            return _public_class(type(self)).iteritems(self)
+        return ((key, value) for key, value in entries)
+
+
+class _PendingValuesView(ValuesView):
+    """
+    View of the values of a :class:`_PendingMapping`, which scans its entries
+    rather than looking up each of its keys, which would restore it.
+    """
+
+    __slots__ = ()
+
+    def __iter__(self):
+        return self._mapping.itervalues()
+
+    def __contains__(self, value):
+        for v in self._mapping.itervalues():
+            if v is value or v == value:
+                return True
+        return False
+
+
+class _PendingItemsView(ItemsView):
+    """
+    View of the items of a :class:`_PendingMapping`, which scans its entries
+    rather than looking up each of its keys, which would restore it.
+    """
+
+    __slots__ = ()
+
+    def __iter__(self):
+        return self._mapping.iteritems()
+
+
+class _PendingSet(object):
+    """
+    Mix-in class of the pending variants of :class:`RestorableSet` classes,
+    whose :attr:`_restoration_data` is the list of pickled elements, as created
+    by :func:`_pending_class`; see :class:`_PendingMapping`.
+    """
+
+    __slots__ = ()
 
     def __len__(self):
-        return len(self._contents)
+        elements = _pending_data(self)
+        if elements is None:
+            return _public_class(type(self)).__len__(self)
+        return len(elements)
 
-    def __repr__(self):
-        return """RestorableDict{}""".format(repr(self._contents))
+    def __iter__(self):
+        elements = _pending_data(self)
+        if elements is None:
+            return _public_class(type(self)).__iter__(self)
+        return iter(elements)
 
 
-class RestorableDefaultDict(RestorableDict, object):
+def _pending_class(cls):
     """
-    A :class:`MutableMapping` restorable wrapper of a :class:`defaultdict`.
+    Returns the pending variant of the :class:`Restorable` class *cls*, creating
+    it the first time it is requested. The pending variant of a pending variant
+    is itself.
+
+    Pending variants also derive from the :attr:`Restorable._pending_mixin`
+    of *cls*, if any.
+
+    :param type cls: a :class:`Restorable` class.
+    :return: the pending variant of *cls*.
     """
+    if cls._requires_restoration:
+        return cls
+    try:
+        return _pending_classes[cls]
+    except KeyError:
+        mixins = (cls._pending_mixin, ) if cls._pending_mixin else ()
+        return _pending_classes.setdefault(cls, type(cls)(cls.__name__,
+            (_PendingRestoration, ) + mixins + (cls, ), {
+                '__module__' : cls.__module__,
+                '__doc__' : cls.__doc__,
+                '__slots__' : (),
+                '_restored_class' : cls,
+            }))
 
-    def __init__(self, *args, **kwargs):
-        self._contents = defaultdict(*args, **kwargs)
-        Restorable.__init__(self)
+_pending_classes = dict()
 
-    def __getstate__(self):
-        return (self._contents.default_factory,
-            [ (key, value) for key, value in self._contents.iteritems() ])
 
-    def __setstate__(self, state):
-        Restorable.__setstate__(self, {
-            '_contents' : defaultdict(state[0]),
-            '_restoration_data' : state[1],
-        })
+def _complete_restoration(restorable):
+    """
+    Restores *restorable* if it is pending restoration, by invoking its
+    :meth:`Restorable._restore` method and switching it back to its restored
+    class. Sets :attr:`_restoration_data` to None afterwards so that no pointers
+    remain to potentially removed keys.
 
-    def __repr__(self):
-        return """RestorableDefaultDict{}""".format(repr(self._contents))
+    Restoration is performed precisely once, under the object's own
+    :attr:`_restoration_lock`; other threads arriving during restoration wait
+    for it to complete, whereas accesses by the restoring thread itself return
+    immediately. Once restored, the object no longer intercepts attribute
+    access, so no lock is involved in accessing it.
 
+    :param Restorable restorable: the object to restore.
+    """
+    cls = type(restorable)
+    if not cls._requires_restoration:
+        return
+    lock = restorable._restoration_lock
+    if lock is None or restorable._restoration_thread == get_ident():
+        return
+    with lock:
+        if type(restorable)._requires_restoration:
+            restorable._restoration_thread = get_ident()
+            restoration_data = restorable._restoration_data
+            statistics = _statistics
+            if statistics is not None:
+                started = default_timer()
+            try:
+                restorable._restore(restoration_data)
+            finally:
+                restorable._restoration_data = None
+                restorable.__class__ = cls._restored_class
+                restorable._restoration_thread = None
+                restorable._restoration_lock = None
+            if statistics is not None:
+                statistics._restored(_public_class(cls), len(restorable),
+                    default_timer() - started)
 
-class RestorableOrderedDict(RestorableDict, object):
+
+def _public_class(cls):
     """
-    A :class:`MutableMapping` restorable wrapper of a :class:`OrderedDict`.
+    :return: the class of which *cls* is a pending or observed variant, or
+        *cls* itself.
     """
+    return getattr(cls, '_restored_class', cls)
 
-    def __init__(self, *args, **kwargs):
-        self._contents = OrderedDict(*args, **kwargs)
-        Restorable.__init__(self)
 
-    def __setstate__(self, state):
-        Restorable.__setstate__(self, {
-            '_contents' : OrderedDict(),
-            '_restoration_data' : state,
-        })
+def _native_state(cls):
+    """
+    :return: `True` if the :class:`Restorable` class *cls*, or the class of
+        which it is a variant, has the :meth:`__getstate__` and
+        :meth:`__setstate__` of the restorable collections of this module,
+        whose state is known to copying, rather than its own.
+    """
+    cls = _public_class(cls)
+    try:
+        return _native_states[cls]
+    except KeyError:
+        native = all(getattr(_defining_class(cls, name), '__module__', None) ==
+            __name__ for name in ('__getstate__', '__setstate__'))
+        return _native_states.setdefault(cls, native)
 
-    def __repr__(self):
-        return """RestorableOrderedDict{}""".format(repr(self._contents))
+_native_states = dict()
 
 
-class RestorableSet(MutableSet, Restorable, object):
+#: Notified in place of a key when all keys (or elements), or their order,
+#: are about to change.
+_EVERYTHING = object()
+
+
+def _observed_class(cls):
     """
-    A :class:`MutableSet` restorable wrapper of a :class:`set`.
+    Returns the observed variant of the :class:`Restorable` class *cls*,
+    creating it the first time it is requested. Observed variants override
+    all mutators of their class in order to notify the observers held in
+    :attr:`Restorable._observers` before each change, by way of the
+    :attr:`Restorable._observed_mixin` of *cls*.
+
+    :param type cls: a :class:`Restorable` class.
+    :return: the observed variant of *cls*.
+    :raises TypeError: if changes to instances of *cls* cannot be observed.
     """
+    try:
+        return _observed_classes[cls]
+    except KeyError:
+        if cls._observed_mixin is None:
+            raise TypeError("changes to {} cannot be observed".format(
+                cls.__name__))
+        return _observed_classes.setdefault(cls, type(cls)(cls.__name__,
+            (cls._observed_mixin, cls, ), {
+                '__module__' : cls.__module__,
+                '__doc__' : cls.__doc__,
+                '__slots__' : (),
+                '_restored_class' : cls,
+                '_observed' : True,
+            }))
 
-    def __init__(self, *args):
-        self._contents = set(*args)
-        Restorable.__init__(self)
+_observed_classes = dict()
 
-    def __getstate__(self):
-        return list(self._contents)
 
-    def __setstate__(self, state):
-        Restorable.__setstate__(self, {
-            '_contents' : set(),
-            '_restoration_data' : state,
-        })
+def _observe(restorable, observer):
+    """
+    Restores *restorable* if necessary, and adds *observer* to its observers,
+    switching it to the observed variant of its class. Observers are called
+    with *restorable* and the key (or element) about to change, or
+    :data:`_EVERYTHING`.
 
-    def _restore(self, restoration_data):
-        self._contents.update(restoration_data)
+    The list of observers is replaced rather than modified, so that observers
+    may add or remove observers while being notified.
+    """
+    restorable._contents
+    cls = type(restorable)
+    if cls._observed:
+        restorable._observers = restorable._observers + [ observer ]
+    else:
+        observed = _observed_class(cls)
+        restorable._observers = [ observer ]
+        restorable.__class__ = observed
 
-    def __contains__(self, x):
-        return x in self._contents
 
-    def __iter__(self):
-        return iter(self._contents)
+def _unobserve(restorable, observer):
+    """
+    Removes *observer* from the observers of *restorable*, switching it back
+    to its own class once no observers remain.
+    """
+    observers = [ o for o in restorable._observers if o is not observer ]
+    if observers:
+        restorable._observers = observers
+    else:
+        restorable.__class__ = type(restorable)._restored_class
+        restorable._observers = None
 
-    def __len__(self):
-        return len(self._contents)
 
-    def add(self, value):
-        return self._contents.add(value)
+def _notify(restorable, key):
+    for observer in restorable._observers:
+        observer(restorable, key)
 
-    def discard(self, value):
-        return self._contents.discard(value)
 
-    def __repr__(self):
-        return """RestorableSet{}""".format(repr(self._contents))
+def _notify_removal(restorable, key):
+    # removal followed by re-insertion changes the order of ordered contents
+    _notify(restorable, _EVERYTHING
+        if isinstance(restorable._contents, _ORDERED_MAPPINGS) else key)
+
+
+class _Journal(object):
+    """
+    Observer recording the keys (or elements) changed since it was last
+    :meth:`reset`, in order of first change, for :meth:`Restorable.dump_delta`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.keys = OrderedDict()
+        self.everything = False
+
+    def __call__(self, restorable, key):
+        if key is _EVERYTHING:
+            self.everything = True
+            self.keys.clear()
+        elif not self.everything and key not in self.keys:
+            self.keys[key] = None
+
+
+def _journal(restorable):
+    """
+    :return: the :class:`_Journal` observing *restorable*, or `None`.
+    """
+    if type(restorable)._observed:
+        for observer in restorable._observers:
+            if isinstance(observer, _Journal):
+                return observer
+    return None
+
+
+class RestorationDelta(object):
+    """
+    The changes of a :class:`Restorable` object as returned by
+    :meth:`Restorable.dump_delta`, holding either the entire pickled
+    :attr:`state` of the object, or only its :attr:`changes`.
+    """
+
+    def __init__(self, state = None, changes = None):
+        self.state = state
+        self.changes = changes
+
+
+def apply_deltas(restorable, deltas):
+    """
+    Applies a chain of :class:`RestorationDelta` objects, in order, to
+    *restorable*, typically a base snapshot just unpickled.
+
+    :param Restorable restorable: the object to apply the deltas to.
+    :param deltas: an iterable of deltas.
+    :return: *restorable*.
+    """
+    for delta in deltas:
+        restorable.apply_delta(delta)
+    return restorable
+
+
+def _new_restorable(cls):
+    """
+    :return: a new, uninitialized object of the :class:`Restorable` class
+        *cls*, whose state is yet to be set by unpickling; used in place of
+        :func:`__newobj__` where the pickled object is not of class *cls*.
+    """
+    return cls.__new__(cls)
+
+
+def _deepcopy_entries(contents, memo):
+    """
+    :return: the list of deep copies of the key and value pairs of the mapping
+        *contents*, registered in the :func:`deepcopy` *memo*.
+    """
+    return [ (deepcopy(key, memo), deepcopy(value, memo))
+        for key, value in _iteritems(contents) ]
+
+
+#: Saved as the previous value of keys which were absent.
+_MISSING = object()
+
+
+class RestorationSnapshot(object):
+    """
+    A frozen view of a :class:`Restorable` object as returned by
+    :meth:`Restorable.snapshot`, which pickles as an object of the same class
+    holding the contents at the time of the snapshot. Copies of a snapshot are
+    likewise objects of that class.
+
+    Snapshots observe their object until they are released, either by
+    :meth:`release` or by leaving the snapshot as a context; changes which
+    cannot be reverted per key, such as clearing, instead cause the snapshot
+    to copy the contents before they change and release the object early.
+
+    Snapshots may also be read: looking up a key (or element) takes constant
+    time while the snapshot observes its object, whereas iterating over the
+    snapshot or taking its :func:`len` copies the contents once and releases
+    the object. Lookups of missing keys raise :exc:`KeyError` rather than
+    supplying default values.
+    """
+
+    def __init__(self, restorable):
+        self._restorable = restorable
+        self._saved = dict()
+        self._state = None
+        self._view = None
+        try:
+            _observe(restorable, self)
+        except TypeError:
+            self._restorable = None
+            self._state = restorable.__getstate__()
+        self._class = _public_class(type(restorable))
+
+    def __call__(self, restorable, key):
+        if key is _EVERYTHING:
+            self._state = self._snapshot_state()
+            self.release()
+            return
+        contents = restorable._contents
+        if isinstance(contents, set):
+            previous = key in contents
+        else:
+            previous = contents.get(key, _MISSING)
+        # the first of concurrent writers saves the value before its change
+        self._saved.setdefault(key, previous)
+
+    def _snapshot_state(self):
+        """
+        :return: the pickled state of the object at the time of the snapshot.
+        :raises ValueError: if the snapshot has been released.
+        """
+        if self._state is not None:
+            return self._state
+        restorable = self._restorable
+        if restorable is None:
+            raise ValueError('the snapshot has been released')
+        contents = restorable._contents.copy()
+        saved = list(self._saved.items())
+        if isinstance(contents, set):
+            for element, present in saved:
+                if present:
+                    contents.add(element)
+                else:
+                    contents.discard(element)
+        else:
+            for key, value in saved:
+                if value is _MISSING:
+                    contents.pop(key, None)
+                else:
+                    contents[key] = value
+        view = self._class.__new__(self._class)
+        view._contents = contents
+        return view.__getstate__()
+
+    def release(self):
+        """
+        Stops observing the object, so that its changes no longer incur the
+        cost of saving previous values. Snapshots which have not already
+        copied the contents can no longer be pickled once released.
+        """
+        restorable, self._restorable = self._restorable, None
+        if restorable is not None:
+            _unobserve(restorable, self)
+
+    def _copy(self):
+        """
+        :return: an object of the class of the snapshot holding the contents
+            at the time of the snapshot, copied the first time this is called.
+        :raises ValueError: if the snapshot has been released.
+        """
+        view = self._view
+        if view is None:
+            state = self._snapshot_state()
+            view = _new_restorable(self._class)
+            view.__setstate__(state)
+            self._state, self._view = state, view
+            self.release()
+        return view
+
+    def _lookup(self, key):
+        """
+        :return: the value of *key* at the time of the snapshot, or
+            :data:`_MISSING` if it was absent; snapshots of unordered sets
+            return whether it was present instead.
+        """
+        restorable = self._restorable
+        if restorable is not None:
+            contents = restorable._contents
+            if isinstance(contents, set):
+                current = key in contents
+            else:
+                current = contents.get(key, _MISSING)
+            # writers save the previous value before they change it, and
+            # copy the contents before releasing the object
+            value = self._saved.get(key, current)
+            if self._restorable is restorable:
+                return value
+        view = self._copy()
+        if isinstance(view, Set):
+            return key in view
+        return view[key] if key in view else _MISSING
+
+    def __getitem__(self, key):
+        if issubclass(self._class, Set):
+            raise TypeError('snapshots of sets are not subscriptable')
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        value = self._lookup(key)
+        # ordered sets hold their elements as keys of None
+        return value is not _MISSING and not (value is False and
+            issubclass(self._class, Set))
+
+    def __iter__(self):
+        return iter(self._copy())
+
+    def __len__(self):
+        return len(self._copy())
+
+    def __reduce_ex__(self, protocol):
+        state = self._snapshot_state()
+        if protocol >= 5 and PickleBuffer is not None:
+            state = _new_restorable(self._class)._out_of_band(state)
+        return _new_restorable, (self._class, ), state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class _ObservedMapping(object):
+    """
+    Mix-in class of the observed variants of :class:`RestorableDict` classes,
+    as created by :func:`_observed_class`.
+
+    Mutators delegate to the methods of the restored class explicitly rather
+    than through :func:`super`, since observers may switch the object back to
+    its restored class while being notified.
+    """
+
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        _notify(self, key)
+        _public_class(type(self)).__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        _notify_removal(self, key)
+        _public_class(type(self)).__delitem__(self, key)
+
+    def pop(self, key, *args):
+        if key in self._contents:
+            _notify_removal(self, key)
+        return _public_class(type(self)).pop(self, key, *args)
+
+    def popitem(self, *args, **kwargs):
+        public, contents = _public_class(type(self)), self._contents
+        if isinstance(contents, _ORDERED_MAPPINGS):
+            if contents:
+                _notify(self, _EVERYTHING)
+            return public.popitem(self, *args, **kwargs)
+        # pop whichever item the public class pops, and put it back while
+        # observers save it
+        key, value = public.popitem(self, *args, **kwargs)
+        contents[key] = value
+        _notify(self, key)
+        return key, contents.pop(key)
+
+    def clear(self):
+        _notify(self, _EVERYTHING)
+        _public_class(type(self)).clear(self)
+
+    def setdefault(self, key, default = None):
+        if key not in self._contents:
+            _notify(self, key)
+        return _public_class(type(self)).setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                other = [ (key, other[key]) for key in other.keys() ]
+            for key, value in other:
+                self[key] = value
+        for key, value in _iteritems(kwargs):
+            self[key] = value
+
+
+class _ObservedDefaultMapping(_ObservedMapping):
+    """
+    Mix-in class of the observed variants of :class:`RestorableDefaultDict`
+    classes, whose lookups of missing keys insert default values.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, item):
+        if item not in self._contents:
+            _notify(self, item)
+        return _public_class(type(self)).__getitem__(self, item)
+
+
+class _ObservedCounter(_ObservedMapping):
+    """
+    Mix-in class of the observed variants of :class:`RestorableCounter`
+    classes, whose :meth:`update` and :meth:`subtract` count.
+    """
+
+    __slots__ = ()
+
+    def update(self, iterable = None, **kwargs):
+        iterable = _notify_counts(self, iterable, kwargs)
+        _public_class(type(self)).update(self, iterable, **kwargs)
+
+    def subtract(self, iterable = None, **kwargs):
+        iterable = _notify_counts(self, iterable, kwargs)
+        _public_class(type(self)).subtract(self, iterable, **kwargs)
+
+
+def _notify_counts(restorable, iterable, kwargs):
+    """
+    Notifies the observers of *restorable* of each key counted by *iterable*
+    and *kwargs*.
+
+    :return: *iterable*, or a :class:`list` of its elements if it is neither a
+        mapping nor `None`, so that it can be iterated over again.
+    """
+    if iterable is not None:
+        if hasattr(iterable, 'keys'):
+            keys = iterable.keys()
+        else:
+            keys = iterable = list(iterable)
+        for key in keys:
+            _notify(restorable, key)
+    for key in kwargs:
+        _notify(restorable, key)
+    return iterable
+
+
+class _ObservedSet(object):
+    """
+    Mix-in class of the observed variants of :class:`RestorableSet` classes,
+    as created by :func:`_observed_class`.
+    """
+
+    __slots__ = ()
+
+    def add(self, value):
+        if value not in self._contents:
+            _notify(self, value)
+        return _public_class(type(self)).add(self, value)
+
+    def discard(self, value):
+        if value in self._contents:
+            _notify_removal(self, value)
+        return _public_class(type(self)).discard(self, value)
+
+    def remove(self, value):
+        if value in self._contents:
+            _notify_removal(self, value)
+        _public_class(type(self)).remove(self, value)
+
+    def pop(self, *args):
+        contents = self._contents
+        if not contents:
+            raise KeyError('pop from an empty set')
+        if isinstance(contents, OrderedDict):
+            _notify(self, _EVERYTHING)
+            return _public_class(type(self)).pop(self, *args)
+        value = next(iter(contents))
+        self.remove(value)
+        return value
+
+    def clear(self):
+        _notify(self, _EVERYTHING)
+        _public_class(type(self)).clear(self)
+
+    def __iand__(self, other):
+        _notify(self, _EVERYTHING)
+        return _public_class(type(self)).__iand__(self, other)
+
+    def __ior__(self, other):
+        _notify(self, _EVERYTHING)
+        return _public_class(type(self)).__ior__(self, other)
+
+    def __ixor__(self, other):
+        _notify(self, _EVERYTHING)
+        return _public_class(type(self)).__ixor__(self, other)
+
+    def __isub__(self, other):
+        _notify(self, _EVERYTHING)
+        return _public_class(type(self)).__isub__(self, other)
+
+
+class _ObservedOrderedSet(_ObservedSet):
+    """
+    Mix-in class of the observed variants of :class:`RestorableOrderedSet`
+    classes, which may also be reordered.
+    """
+
+    __slots__ = ()
+
+    def move_to_end(self, value, last = True):
+        _notify(self, _EVERYTHING)
+        _public_class(type(self)).move_to_end(self, value, last)
+
+
+class RestorationCounters(object):
+    """
+    Counters of the restoration of :class:`Restorable` objects, either overall
+    or of a single class, as maintained by :class:`RestorationStatistics`.
+
+    Durations are in seconds and cover the entire :meth:`Restorable._restore`
+    invocation, including time spent in the :meth:`__hash__` and
+    :meth:`__eq__` methods of keys. The :attr:`histogram` counts restorations
+    by duration: bucket 0 counts those which took less than a microsecond, and
+    bucket *i* those which took less than 2 ** *i* microseconds but at least
+    half of that; the last bucket also counts all longer restorations.
+    """
+
+    #: The number of buckets of :attr:`histogram`.
+    buckets = 32
+
+    def __init__(self):
+        self.unpickled = 0
+        self.restored = 0
+        self.entries = 0
+        self.time = 0.0
+        self.histogram = [0] * self.buckets
+
+    @property
+    def pending(self):
+        """
+        :return: the number of objects unpickled but not yet restored.
+        """
+        return max(0, self.unpickled - self.restored)
+
+    def _count(self, size, duration):
+        self.restored += 1
+        self.entries += size
+        self.time += duration
+        self.histogram[min(int(duration * 1000000).bit_length(),
+            self.buckets - 1)] += 1
+
+    def __repr__(self):
+        return """{}(pending={}, restored={}, entries={}, time={})""".format(
+            type(self).__name__, self.pending, self.restored, self.entries,
+            self.time)
+
+
+class RestorationStatistics(RestorationCounters):
+    """
+    Overall :class:`RestorationCounters`, along with counters per
+    :class:`Restorable` class in :attr:`classes`, maintained while
+    instrumentation is enabled by :func:`enable_instrumentation`.
+
+    If a *callback* is given, it is invoked after every restoration with the
+    class of the restored object, the number of entries restored, and the
+    duration of restoration in seconds.
+    """
+
+    def __init__(self, callback = None):
+        RestorationCounters.__init__(self)
+        self.callback = callback
+        self.classes = dict()
+        self._lock = allocate_lock()
+
+    def _class_counters(self, cls):
+        try:
+            return self.classes[cls]
+        except KeyError:
+            return self.classes.setdefault(cls, RestorationCounters())
+
+    def _unpickled(self, cls):
+        with self._lock:
+            self.unpickled += 1
+            self._class_counters(cls).unpickled += 1
+
+    def _restored(self, cls, size, duration):
+        with self._lock:
+            self._count(size, duration)
+            self._class_counters(cls)._count(size, duration)
+        if self.callback is not None:
+            self.callback(cls, size, duration)
+
+_statistics = None
+
+
+def enable_instrumentation(callback = None):
+    """
+    Enables instrumentation of the restoration of :class:`Restorable` objects,
+    replacing any statistics maintained so far. While disabled, which is the
+    default, instrumentation costs nothing beyond a single check per
+    unpickling and per restoration.
+
+    :param callable callback: invoked after every restoration with the class
+        of the restored object, the number of entries restored, and the
+        duration of restoration in seconds.
+    :return: the :class:`RestorationStatistics` maintained from now on.
+    """
+    global _statistics
+    _statistics = RestorationStatistics(callback)
+    return _statistics
+
+
+def disable_instrumentation():
+    """
+    Disables instrumentation of the restoration of :class:`Restorable` objects.
+
+    :return: the :class:`RestorationStatistics` maintained until now, or `None`
+        if instrumentation was not enabled.
+    """
+    global _statistics
+    statistics, _statistics = _statistics, None
+    return statistics
+
+
+def restoration_statistics():
+    """
+    :return: the :class:`RestorationStatistics` currently maintained, or `None`
+        if instrumentation is not enabled.
+    """
+    return _statistics
+
+
+
+class Restoration(object):
+    """
+    A batch of :class:`Restorable` objects unpickled within a :func:`restoring`
+    context, all of which are restored together once unpickling has completed,
+    instead of lazily upon their first access; either by :meth:`restore` in the
+    current thread, or by :meth:`restore_in_background` in a pool of threads.
+    """
+
+    def __init__(self):
+        self.restorables = []
+        self.exception = None
+        self._warm = Event()
+        self._lock = allocate_lock()
+        self._outstanding = 0
+        self._callbacks = []
+
+    def restore(self):
+        """
+        Restores all tracked :class:`Restorable` objects which are still pending
+        restoration in a single pass, with garbage collection paused, and stops
+        tracking them.
+        """
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for restorable in self.restorables:
+                _complete_restoration(restorable)
+        finally:
+            if enabled:
+                gc.enable()
+        del self.restorables[:]
+        self._set_warm()
+
+    def restore_in_background(self, executor = None, chunk_size = 256):
+        """
+        Submits all tracked :class:`Restorable` objects to *executor* in chunks
+        of *chunk_size*, and stops tracking them, so that their restoration
+        overlaps with whatever the current thread does next. Objects accessed
+        before the executor reaches them are restored immediately in the
+        accessing thread, and are skipped by the executor.
+
+        :param executor: a :class:`concurrent.futures.Executor`; if omitted, a
+            :class:`concurrent.futures.ThreadPoolExecutor` is created for the
+            purpose and shut down once all chunks have been submitted.
+        :param int chunk_size: the number of objects restored per task.
+        :raises ImportError: if *executor* is omitted and
+            :mod:`concurrent.futures` is not available.
+        """
+        restorables, self.restorables = self.restorables, []
+        chunks = [ restorables[i:i + chunk_size]
+            for i in _range(0, len(restorables), chunk_size) ]
+        if not chunks:
+            self._set_warm()
+            return
+        self._outstanding = len(chunks)
+        shutdown = executor is None
+        if shutdown:
+            if ThreadPoolExecutor is None:
+                raise ImportError("background restoration requires "
+                    "concurrent.futures, available as the futures package")
+            executor = ThreadPoolExecutor(
+                max_workers = min(len(chunks), _cpu_count))
+        for chunk in chunks:
+            executor.submit(self._restore_chunk, chunk)
+        if shutdown:
+            executor.shutdown(wait = False)
+
+    def _restore_chunk(self, chunk):
+        try:
+            for restorable in chunk:
+                _complete_restoration(restorable)
+        except BaseException as e:
+            if self.exception is None:
+                self.exception = e
+        finally:
+            with self._lock:
+                self._outstanding -= 1
+                warm = not self._outstanding
+            if warm:
+                self._set_warm()
+
+    def _set_warm(self):
+        with self._lock:
+            self._warm.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        """
+        :return: `True` if all tracked objects have been restored.
+        """
+        return self._warm.is_set()
+
+    def wait(self, timeout = None):
+        """
+        Blocks until all tracked objects have been restored, or until *timeout*
+        seconds have elapsed.
+
+        :param float timeout: the maximum number of seconds to wait for, or
+            `None` in order to wait indefinitely.
+        :return: `True` if all tracked objects have been restored.
+        :raises Exception: the first exception raised during restoration in the
+            background, if any.
+        """
+        warm = self._warm.wait(timeout)
+        if self.exception is not None:
+            raise self.exception
+        return warm
+
+    def add_done_callback(self, callback):
+        """
+        Arranges for *callback* to be invoked with this :class:`Restoration`
+        once all tracked objects have been restored; invokes it immediately if
+        they already have.
+
+        :param callable callback: the callback.
+        """
+        with self._lock:
+            if not self._warm.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+_tracking = local()
+
+
+@contextmanager
+def restoring(background = False, executor = None):
+    """
+    Context manager which tracks every :class:`Restorable` object unpickled by
+    the current thread within the context, and restores all of them eagerly
+    when the context exits, so that the cost of restoration is paid once rather
+    than upon first access. Nothing is restored if the context exits with an
+    exception.
+
+    .. code-block:: python
+
+        with restoring():
+            graph = pickle.load(f)
+
+    If *background* is `True`, or an *executor* is given, restoration is
+    instead handed to :meth:`Restoration.restore_in_background` and the
+    returned :class:`Restoration` reports when all objects are restored.
+
+    .. code-block:: python
+
+        with restoring(background = True) as restoration:
+            graph = pickle.load(f)
+        ...
+        restoration.wait()
+
+    :param bool background: whether to restore in a pool of threads.
+    :param executor: the :class:`concurrent.futures.Executor` to restore with.
+    :return: the :class:`Restoration` tracking unpickled objects.
+    """
+    restoration = Restoration()
+    restorations = _tracking.__dict__.setdefault('restorations', [])
+    restorations.append(restoration)
+    try:
+        yield restoration
+    finally:
+        restorations.pop()
+    if background or executor is not None:
+        restoration.restore_in_background(executor)
+    else:
+        restoration.restore()
+
+
+def restoring_load(f):
+    """
+    Unpickles an object from the open file *f* within a :func:`restoring`
+    context, so that all unpickled :class:`Restorable` objects are restored by
+    the time it returns.
+
+    :param file f: the file to unpickle from.
+    :return: the unpickled object.
+    """
+    with restoring():
+        return cPickle.load(f)
+
+
+def restoring_loads(string):
+    """
+    Unpickles an object from *string* within a :func:`restoring` context, so
+    that all unpickled :class:`Restorable` objects are restored by the time it
+    returns.
+
+    :param str string: the pickled object.
+    :return: the unpickled object.
+    """
+    with restoring():
+        return cPickle.loads(string)
+
+
+#: The built-in collections pickled by :class:`RestorablePickler`, whose
+#: insertions are deferred until unpickling has completed.
+_DEFERRED_CLASSES = frozenset((dict, defaultdict, OrderedDict, set, ))
+
+#: The types of keys (or elements) which are complete as soon as they are
+#: unpickled, and can therefore be inserted immediately.
+_ATOMIC_CLASSES = frozenset((type(None), bool, float, complex, bytes, _text,
+    str, ) + _integers)
+
+
+class _Creation(object):
+    """
+    Persistent identifier of a built-in collection, pickled ahead of its
+    contents so that :class:`RestorableUnpickler` creates the collection before
+    unpickling anything which may refer back to it.
+    """
+
+    __slots__ = ('pid', )
+
+    def __init__(self, pid):
+        self.pid = pid
+
+
+class _Reductions(object):
+    """
+    The dispatch table of a :class:`RestorablePickler`, which reduces all
+    objects other than classes with the same function.
+    """
+
+    __slots__ = ('reduce', )
+
+    def __init__(self, reduce):
+        self.reduce = reduce
+
+    def __getitem__(self, cls):
+        if issubclass(cls, type):
+            # pickled by name
+            raise KeyError(cls)
+        return self.reduce
+
+    def get(self, cls, default = None):
+        try:
+            return self[cls]
+        except KeyError:
+            return default
+
+
+class RestorablePickler(Pickler, object):
+    """
+    A :class:`pickle.Pickler` which pickles plain :class:`dict`,
+    :class:`defaultdict`, :class:`OrderedDict`, and :class:`set` objects (but
+    not their subclasses) such that :class:`RestorableUnpickler` inserts their
+    keys (or elements) only once the entire object graph has been unpickled, by
+    which time keys which are part of cycles are complete and can be hashed.
+    Existing classes may thus keep their built-in collections, and pay no
+    wrapper overhead at run-time; see also :class:`RestorableDict`.
+
+    Collections whose keys (or elements) are all strings, numbers, or `None`,
+    such as the attribute dictionaries of objects, are pickled as usual. So are
+    collections which are passed to a reconstructor, such as the :class:`dict`
+    which a :class:`Counter` reduces to, or whose enclosing state is passed to
+    :meth:`__setstate__`, since these may be consumed before unpickling has
+    completed. A collection which is only found to be consumed after it has
+    been pickled with deferred insertions raises :exc:`pickle.PicklingError`.
+
+    Collections are pickled as persistent identifiers holding their contents,
+    which is the only hook the C implementation of :mod:`pickle` offers for
+    exact built-in collections, and pickles produced by this class can
+    therefore only be unpickled by :class:`RestorableUnpickler`. Pickle
+    protocol 0 is not supported, and the highest protocol is used by default.
+
+    .. code-block:: python
+
+        RestorablePickler(f).dump(graph)
+        graph = RestorableUnpickler(f).load()
+    """
+
+    def __init__(self, file, protocol = None, *args, **kwargs):
+        if protocol is None:
+            protocol = cPickle.HIGHEST_PROTOCOL
+        elif protocol == 0:
+            raise ValueError('pickle protocol 0 is not supported')
+        Pickler.__init__(self, file, protocol, *args, **kwargs)
+        self._protocol = protocol
+        self._numbers = dict()
+        self._collections = []
+        self._consumed = set()
+        if version_info[0] >= 3:
+            self._dispatch_table = getattr(self, 'dispatch_table',
+                dispatch_table)
+            self.dispatch_table = _Reductions(self._reduce)
+
+    def persistent_id(self, obj):
+        """
+        Identifies built-in collections by the order in which they are first
+        pickled. The first occurrence of a collection is pickled along with its
+        class, arguments, and contents, and further occurrences as its number
+        only.
+
+        :param object obj: the object being pickled.
+        :return: the persistent identifier of *obj*, or `None` if *obj* is
+            not a built-in collection whose insertions should be deferred.
+        """
+        cls = type(obj)
+        if cls is _Creation:
+            return obj.pid
+        if cls not in _DEFERRED_CLASSES or id(obj) in self._consumed or \
+                _ATOMIC_CLASSES.issuperset(map(type, obj)):
+            return None
+        number = self._numbers.get(id(obj))
+        if number is not None:
+            return number
+        number = self._numbers[id(obj)] = len(self._collections)
+        # keeps the collection alive, so that its id is not reused
+        self._collections.append(obj)
+        if cls is set:
+            contents = list(obj)
+        else:
+            contents = list(chain.from_iterable(_iteritems(obj)))
+        arguments = (obj.default_factory, ) if cls is defaultdict else ()
+        return _Creation((number, cls, arguments)), contents
+
+    def _reduce(self, obj):
+        """
+        Reduces *obj* as :mod:`pickle` does, noting the built-in collections
+        which the reduction consumes.
+        """
+        reduce = self._dispatch_table.get(type(obj))
+        if reduce is not None:
+            reduction = reduce(obj)
+        else:
+            reduction = obj.__reduce_ex__(self._protocol)
+        if isinstance(reduction, tuple):
+            self._consume(obj, *reduction[1:])
+        return reduction
+
+    if version_info[0] < 3:
+
+        # the pure Python pickler has no per-pickler dispatch table
+        def save_reduce(self, func, args, state = None, listitems = None,
+                dictitems = None, obj = None):
+            self._consume(obj, args, state)
+            Pickler.save_reduce(self, func, args, state, listitems, dictitems,
+                obj)
+
+    def _consume(self, obj, arguments, state = None, listitems = None,
+            dictitems = None, state_setter = None):
+        """
+        Notes the built-in collections found in the *arguments* of a reduction
+        of *obj*, and in its *state* if that is passed to a function, such that
+        they are pickled with their contents.
+
+        :raises PicklingError: if such a collection has already been pickled
+            with deferred insertions.
+        """
+        values = [arguments]
+        if state is not None and (state_setter is not None or
+                hasattr(type(obj), '__setstate__')):
+            values.append(state)
+        followed = set()
+        while values:
+            value = values.pop()
+            cls = type(value)
+            if cls in (tuple, list):
+                contents = value
+            elif cls in _DEFERRED_CLASSES:
+                if _ATOMIC_CLASSES.issuperset(map(type, value)):
+                    contents = _itervalues(value) if cls is not set else ()
+                elif id(value) in self._numbers:
+                    raise PicklingError('{} consumed by the reduction of {} '
+                        'has been pickled with deferred insertions'.format(
+                        cls.__name__, type(obj).__name__))
+                else:
+                    self._consumed.add(id(value))
+                    # keeps the collection alive, so that its id is not reused
+                    self._collections.append(value)
+                    continue
+            else:
+                continue
+            if id(value) not in followed:
+                followed.add(id(value))
+                values.extend(contents)
+
+    def clear_memo(self):
+        Pickler.clear_memo(self)
+        self._numbers.clear()
+        del self._collections[:]
+        self._consumed.clear()
+
+
+class RestorableUnpickler(Unpickler, object):
+    """
+    A :class:`pickle.Unpickler` for pickles produced by
+    :class:`RestorablePickler`, which creates built-in collections empty when
+    unpickling them, and inserts their keys (or elements) once :meth:`load` has
+    unpickled the entire object graph, innermost collections first. Unpickled
+    collections are plain built-in objects which do not require restoration.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Unpickler.__init__(self, *args, **kwargs)
+        self._collections = dict()
+        self._insertions = []
+
+    def load(self):
+        """
+        Unpickles an object, and then inserts the contents of all built-in
+        collections unpickled along with it. Nothing is inserted if unpickling
+        raises an exception.
+
+        :return: the unpickled object.
+        """
+        del self._insertions[:]
+        obj = Unpickler.load(self)
+        insertions, self._insertions = self._insertions, []
+        for collection, contents in insertions:
+            if type(collection) is set:
+                collection.update(contents)
+            else:
+                items = iter(contents)
+                collection.update(zip(items, items))
+        return obj
+
+    def persistent_load(self, pid):
+        """
+        :param pid: a persistent identifier pickled by
+            :meth:`RestorablePickler.persistent_id`.
+        :return: the built-in collection identified by *pid*.
+        :raises UnpicklingError: if *pid* does not identify a built-in
+            collection.
+        """
+        try:
+            if not isinstance(pid, tuple):
+                return self._collections[pid]
+            if len(pid) == 2:
+                collection, contents = pid
+                self._insertions.append((collection, contents))
+                return collection
+            number, cls, arguments = pid
+        except (KeyError, TypeError, ValueError):
+            raise UnpicklingError('unsupported persistent id: {!r}'.format(
+                pid))
+        if cls not in _DEFERRED_CLASSES:
+            raise UnpicklingError('unsupported persistent id: {!r}'.format(
+                pid))
+        collection = self._collections[number] = cls(*arguments)
+        return collection
+
+
+#: Objects which are pickled by name, or not at all, and whose references are
+#: therefore not followed by :func:`find_cyclic_collections`.
+_OPAQUE_CLASSES = (type, ModuleType, FunctionType, BuiltinFunctionType, ref, )
+
+
+class CyclicCollection(object):
+    """
+    A built-in collection reported by :func:`find_cyclic_collections`, which
+    does not survive pickling unless it is replaced by its restorable wrapper,
+    or pickled with :class:`RestorablePickler`.
+    """
+
+    def __init__(self, collection, path, keys):
+        #: The collection.
+        self.collection = collection
+        #: The shortest path to the collection from the analyzed object.
+        self.path = path
+        #: The number of entries of the collection.
+        self.size = len(collection)
+        #: The keys (or elements) of the collection which refer back to it.
+        self.keys = keys
+
+    def __repr__(self):
+        return "CyclicCollection({}, {}, size = {}, keys = {})".format(
+            type(self.collection).__name__, self.path, self.size,
+            len(self.keys))
+
+
+def find_cyclic_collections(obj, name = 'obj'):
+    """
+    Walks the object graph reachable from *obj*, and returns every built-in
+    :class:`dict`, :class:`defaultdict`, :class:`OrderedDict`, and :class:`set`
+    which has keys (or elements) hashed by their state, and from which the
+    collection itself is reachable in turn. Unpickling such a key may require
+    unpickling the collection first, in which case the key is inserted before
+    its state is restored, and hashed incorrectly; all other built-in
+    collections are safe to keep.
+
+    References are followed through containers and through the attributes and
+    :attr:`__slots__` of objects; classes, modules, and functions, which are
+    pickled by name, are not followed. The contents of :class:`Restorable`
+    collections are followed but not reported, and objects pending restoration
+    are not restored.
+
+    .. code-block:: python
+
+        for found in find_cyclic_collections(graph, 'graph'):
+            print(found.path, found.size)
+
+    :param object obj: the object to analyze.
+    :param str name: the name of *obj* with which reported paths start.
+    :return: a :class:`list` of :class:`CyclicCollection`, in order of
+        increasing path length.
+    """
+    nodes = [obj]
+    numbers = { id(obj) : 0 }
+    parents = [None]
+    edges = []
+    keys = dict()
+    wrapped = set()
+    for number, node in enumerate(nodes):
+        children = []
+        for label, referent, key in _references(node, wrapped):
+            cls = type(referent)
+            if cls in _ATOMIC_CLASSES or isinstance(referent, _OPAQUE_CLASSES):
+                continue
+            child = numbers.get(id(referent))
+            if child is None:
+                child = numbers[id(referent)] = len(nodes)
+                nodes.append(referent)
+                parents.append((number, label))
+            children.append(child)
+            if key and _hashes_state(referent):
+                keys.setdefault(number, []).append(child)
+        edges.append(children)
+
+    components = _strongly_connected_components(edges)
+    found = []
+    for number in sorted(keys):
+        collection = nodes[number]
+        if type(collection) not in _DEFERRED_CLASSES or \
+                id(collection) in wrapped:
+            continue
+        cyclic = [ nodes[key] for key in keys[number]
+            if components[key] == components[number] ]
+        if cyclic:
+            labels = []
+            child = number
+            while parents[child] is not None:
+                child, (template, argument) = parents[child]
+                labels.append(template.format(argument))
+            path = name + ''.join(reversed(labels))
+            found.append(CyclicCollection(collection, path, cyclic))
+    return found
+
+
+def _references(obj, wrapped):
+    """
+    :return: an iterator over the label, referent, and whether the referent is
+        a key (or element), of every reference of *obj* which pickling follows.
+        Labels are pairs of a format string and its argument, formatted only
+        for the paths which are reported. The wrapped contents of
+        :class:`Restorable` objects are added to the set of *wrapped*
+        identities.
+    """
+    if isinstance(obj, dict):
+        # without looking keys up, which may have been hashed incorrectly
+        for key, value in dict.items(obj):
+            yield ('<key {!r}>', key), key, True
+            yield ('[{!r}]', key), value, False
+        if isinstance(obj, defaultdict):
+            yield ('.{}', 'default_factory'), obj.default_factory, False
+    elif isinstance(obj, (set, frozenset)):
+        for element in obj:
+            yield ('<element {!r}>', element), element, True
+    elif isinstance(obj, (list, tuple)):
+        for i, element in enumerate(obj):
+            yield ('[{}]', i), element, False
+    if type(obj) in _DEFERRED_CLASSES or id(obj) in wrapped:
+        # pickled by their contents only
+        return
+    described = isinstance(obj, (dict, set, frozenset, list, tuple))
+    try:
+        attributes = object.__getattribute__(obj, '__dict__')
+    except (AttributeError, TypeError):
+        pass
+    else:
+        described = True
+        for attribute, value in _iteritems(attributes):
+            yield ('.{}', attribute), value, False
+    for attribute in _slots(type(obj)):
+        try:
+            value = object.__getattribute__(obj, attribute)
+        except (AttributeError, TypeError):
+            continue
+        described = True
+        if attribute == '_contents' and isinstance(obj, Restorable):
+            wrapped.add(id(value))
+        yield ('.{}', attribute), value, False
+    if not described:
+        for i, referent in enumerate(gc.get_referents(obj)):
+            yield ('<referent {}>', i), referent, False
+
+
+def _slots(cls):
+    """
+    :return: the names of all :attr:`__slots__` of *cls* holding references.
+    """
+    for base in cls.__mro__:
+        slots = base.__dict__.get('__slots__', ())
+        if isinstance(slots, (str, _text)):
+            slots = (slots, )
+        for slot in slots:
+            if slot in ('__dict__', '__weakref__'):
+                continue
+            if slot.startswith('__') and not slot.endswith('__'):
+                slot = '_{}{}'.format(base.__name__.lstrip('_'), slot)
+            yield slot
+
+
+def _hashes_state(key):
+    """
+    :return: `True` if *key* is hashed by its state, rather than by its
+        identity or a built-in value.
+    """
+    cls = type(key)
+    if cls in _ATOMIC_CLASSES:
+        return False
+    if cls in (tuple, frozenset):
+        return any(_hashes_state(element) for element in key)
+    return cls.__hash__ is not object.__hash__
+
+
+def _strongly_connected_components(edges):
+    """
+    Tarjan's algorithm, without recursion.
+
+    :param list edges: the numbers of the successors of each node.
+    :return: the number of the strongly connected component of each node.
+    """
+    count = len(edges)
+    indices = [None] * count
+    lowest = [0] * count
+    stacked = [False] * count
+    components = [None] * count
+    stack = []
+    index = component = 0
+    for start in _range(count):
+        if indices[start] is not None:
+            continue
+        work = [(start, 0)]
+        while work:
+            node, successor = work.pop()
+            if not successor:
+                indices[node] = lowest[node] = index
+                index += 1
+                stack.append(node)
+                stacked[node] = True
+            successors = edges[node]
+            while successor < len(successors):
+                child = successors[successor]
+                successor += 1
+                if indices[child] is None:
+                    work.append((node, successor))
+                    work.append((child, 0))
+                    break
+                if stacked[child]:
+                    lowest[node] = min(lowest[node], indices[child])
+            else:
+                if lowest[node] == indices[node]:
+                    while True:
+                        child = stack.pop()
+                        stacked[child] = False
+                        components[child] = component
+                        if child == node:
+                            break
+                    component += 1
+                if work:
+                    parent = work[-1][0]
+                    lowest[parent] = min(lowest[parent], lowest[node])
+    return components
+
+
+class RestorableDict(Restorable, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a :class:`dict`.
+
+    Implements the entire :class:`MutableMapping` interface by delegation to
+    the wrapped :class:`dict`, and is registered as a virtual subclass of
+    :class:`MutableMapping` instead of inheriting from it, so that it need not
+    carry a per-instance :attr:`__dict__`.
+    """
+
+    __slots__ = ()
+
+    __hash__ = None
+
+    _observed_mixin = _ObservedMapping
+
+    _pending_mixin = _PendingMapping
+
+    def __init__(self, *args, **kwargs):
+        self._contents = dict(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __getstate__(self):
+        return [ (key, value) for key, value in _iteritems(self._contents) ]
+
+    def _deepcopy_state(self, memo):
+        if type(self)._requires_restoration:
+            return Restorable._deepcopy_state(self, memo)
+        return _deepcopy_entries(self._contents, memo)
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : dict(),
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        self._contents.update(restoration_data)
+
+    def _out_of_band(self, state):
+        return [ (key, _out_of_band_value(value)) for key, value in state ]
+
+    def _delta(self, keys):
+        contents = self._contents
+        return ([ (key, contents[key]) for key in keys if key in contents ],
+            [ key for key in keys if key not in contents ])
+
+    def _apply_delta(self, changes):
+        contents = self._contents
+        items, removed = changes
+        for key in removed:
+            contents.pop(key, None)
+        for key, value in items:
+            contents[key] = value
+
+    def __getitem__(self, item):
+        return self._contents[item]
+
+    def __setitem__(self, key, value):
+        self._contents[key] = value
+
+    def __delitem__(self, key):
+        del self._contents[key]
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __contains__(self, key):
+        return key in self._contents
+
+    def get(self, key, default = None):
+        return self._contents.get(key, default)
+
+    def keys(self):
+        return self._contents.keys()
+
+    def values(self):
+        return self._contents.values()
+
+    def items(self):
+        return self._contents.items()
+
+    def iterkeys(self):
+        return iter(_iterkeys(self._contents))
+
+    def itervalues(self):
+        return iter(_itervalues(self._contents))
+
+    def iteritems(self):
+        return iter(_iteritems(self._contents))
+
+    def pop(self, key, *args):
+        return self._contents.pop(key, *args)
+
+    def popitem(self):
+        return self._contents.popitem()
+
+    def clear(self):
+        self._contents.clear()
+
+    def setdefault(self, key, default = None):
+        return self._contents.setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        if args and isinstance(args[0], RestorableDict):
+            args = (args[0]._contents, ) + args[1:]
+        self._contents.update(*args, **kwargs)
+
+    def __eq__(self, other):
+        if isinstance(other, RestorableLRUDict):
+            # which compares regardless of recency of use
+            return NotImplemented
+        if isinstance(other, (RestorableDict, RestorableFrozenDict)):
+            other = other._contents
+        elif not isinstance(other, dict):
+            if not isinstance(other, Mapping):
+                return NotImplemented
+            return dict(self._contents.items()) == dict(other.items())
+        return self._contents == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return """RestorableDict{}""".format(repr(self._contents))
+
+
+class RestorableDefaultDict(RestorableDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a :class:`defaultdict`.
+    """
+
+    __slots__ = ()
+
+    _observed_mixin = _ObservedDefaultMapping
+
+    def __init__(self, *args, **kwargs):
+        self._contents = defaultdict(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __getstate__(self):
+        return (self._contents.default_factory,
+            [ (key, value) for key, value in _iteritems(self._contents) ])
+
+    def _deepcopy_state(self, memo):
+        if type(self)._requires_restoration:
+            return Restorable._deepcopy_state(self, memo)
+        contents = self._contents
+        return (deepcopy(contents.default_factory, memo),
+            _deepcopy_entries(contents, memo))
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : defaultdict(state[0]),
+            '_restoration_data' : state[1],
+        })
+
+    def _pending_state(self, restoration_data):
+        contents = object.__getattribute__(self, '_contents')
+        return contents.default_factory, restoration_data
+
+    def _out_of_band(self, state):
+        default_factory, entries = state
+        return default_factory, RestorableDict._out_of_band(self, entries)
+
+    def __repr__(self):
+        return """RestorableDefaultDict{}""".format(repr(self._contents))
+
+
+class RestorableOrderedDict(RestorableDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a :class:`OrderedDict`.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        self._contents = OrderedDict(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : OrderedDict(),
+            '_restoration_data' : state,
+        })
+
+    def __reversed__(self):
+        return reversed(self._contents)
+
+    def popitem(self, last = True):
+        return self._contents.popitem(last)
+
+    def __repr__(self):
+        return """RestorableOrderedDict{}""".format(repr(self._contents))
+
+
+if version_info >= (3, 7):
+
+    class _OrderedDefaultDict(defaultdict):
+        """
+        A :class:`defaultdict` which, like :class:`OrderedDict`, may pop its
+        first item and compares order-sensitively with other ordered
+        mappings (an :class:`OrderedDict` on the left hand side compares it as
+        a plain dictionary); wrapped by :class:`RestorableOrderedDefaultDict`. Since
+        Python 3.7 dictionaries preserve insertion order, so missing keys take
+        the native :class:`defaultdict` path rather than a Python
+        :meth:`__missing__`.
+        """
+
+        def popitem(self, last = True):
+            if last:
+                return defaultdict.popitem(self)
+            if not self:
+                raise KeyError('dictionary is empty')
+            key = next(iter(self))
+            return key, self.pop(key)
+
+        if not hasattr(dict, '__reversed__'):
+            def __reversed__(self):
+                return reversed(list(self))
+
+        def __eq__(self, other):
+            if isinstance(other, _ORDERED_MAPPINGS):
+                return dict.__eq__(self, other) and all(map(eq, self, other))
+            return dict.__eq__(self, other)
+
+        def __ne__(self, other):
+            equal = self.__eq__(other)
+            return equal if equal is NotImplemented else not equal
+
+        __hash__ = None
+
+        def __repr__(self):
+            return 'OrderedDefaultDict' + \
+                defaultdict.__repr__(self)[len(type(self).__name__):]
+
+else:
+
+    class _OrderedDefaultDict(OrderedDict):
+        """
+        An :class:`OrderedDict` which, like :class:`defaultdict`, calls its
+        :attr:`default_factory` in order to supply values for missing keys;
+        wrapped by :class:`RestorableOrderedDefaultDict`.
+        """
+
+        def __init__(self, default_factory = None, *args, **kwargs):
+            if default_factory is not None and not callable(default_factory):
+                raise TypeError('first argument must be callable or None')
+            OrderedDict.__init__(self, *args, **kwargs)
+            self.default_factory = default_factory
+
+        def __missing__(self, key):
+            if self.default_factory is None:
+                raise KeyError(key)
+            self[key] = value = self.default_factory()
+            return value
+
+        def __reduce__(self):
+            return type(self), (self.default_factory, ), None, None, \
+                iter(self.items())
+
+        def copy(self):
+            return type(self)(self.default_factory, self)
+
+        def __repr__(self):
+            items = OrderedDict.__repr__(self)
+            if items == '...':
+                return items
+            items = items[len(type(self).__name__) + 1:-1]
+            return """OrderedDefaultDict({!r}, {})""".format(
+                self.default_factory, items or '[]')
+
+_ORDERED_MAPPINGS = (OrderedDict, _OrderedDefaultDict)
+
+
+class RestorableOrderedDefaultDict(RestorableDefaultDict,
+        RestorableOrderedDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of an :class:`OrderedDict`
+    which supplies values for missing keys by calling a default factory, as
+    :class:`defaultdict` does.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        self._contents = _OrderedDefaultDict(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : _OrderedDefaultDict(state[0]),
+            '_restoration_data' : state[1],
+        })
+
+    def __repr__(self):
+        return """RestorableOrderedDefaultDict{}""".format(repr(self._contents))
+
+
+class RestorableCounter(RestorableDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a :class:`Counter`.
+
+    Counting, :meth:`most_common` and arithmetic are delegated to the wrapped
+    :class:`Counter`; arithmetic between restorable counters and
+    :class:`Counter` objects results in new :class:`RestorableCounter` objects.
+    """
+
+    __slots__ = ()
+
+    _observed_mixin = _ObservedCounter
+
+    def __init__(self, *args, **kwargs):
+        self._contents = Counter(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : Counter(),
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        # the state holds counts, which Counter.update would instead count
+        dict.update(self._contents, restoration_data)
+
+    def _from_contents(self, contents):
+        restorable = RestorableCounter.__new__(_public_class(type(self)))
+        restorable._contents = contents
+        return restorable
+
+    def update(self, iterable = None, **kwargs):
+        self._contents.update(_counter_operand(iterable, iterable), **kwargs)
+
+    def subtract(self, iterable = None, **kwargs):
+        self._contents.subtract(_counter_operand(iterable, iterable), **kwargs)
+
+    def elements(self):
+        return self._contents.elements()
+
+    def most_common(self, n = None):
+        return self._contents.most_common(n)
+
+    def __add__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents + other)
+
+    def __radd__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(other + self._contents)
+
+    def __sub__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents - other)
+
+    def __rsub__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(other - self._contents)
+
+    def __or__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents | other)
+
+    def __ror__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(other | self._contents)
+
+    def __and__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents & other)
+
+    def __rand__(self, other):
+        other = _counter_operand(other)
+        return NotImplemented if other is None else \
+            self._from_contents(other & self._contents)
+
+    def __repr__(self):
+        return """RestorableCounter{}""".format(repr(self._contents))
+
+
+def _counter_operand(other, default = None):
+    """
+    Converts *other* to an operand of native :class:`Counter` operations.
+
+    :param object other: the operand of a :class:`RestorableCounter` operation.
+    :param object default: returned if *other* is not a counter.
+    :return: the wrapped contents of restorable counters, *other* itself if it
+        is a :class:`Counter`, and *default* otherwise.
+    """
+    if isinstance(other, RestorableCounter):
+        return other._contents
+    if isinstance(other, Counter):
+        return other
+    return default
+
+
+class RestorableLRUDict(RestorableDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of an :class:`OrderedDict`
+    holding at most :attr:`capacity` entries in order of recency of use, least
+    recently used first. Adding an entry beyond capacity evicts the least
+    recently used entry; lookups, insertions and evictions take constant time.
+
+    Entries may expire a number of seconds after they are set, either per
+    entry (see :meth:`put`) or by the default :attr:`ttl`. Expiry times are
+    wall-clock times, so that they remain meaningful in another process;
+    expired entries are discarded when next looked up, when iterated over, or
+    by :meth:`expire`, and are therefore still counted by :func:`len` until
+    then.
+
+    Lookups by key count towards :attr:`hits` or :attr:`misses`, and entries
+    evicted due to capacity towards :attr:`evictions`. Recency order, expiry
+    times and counters are all pickled, so that an unpickled cache is warm.
+    """
+
+    __slots__ = ('capacity', 'ttl', 'hits', 'misses', 'evictions',
+        '_expiries', )
+
+    _observed_mixin = None
+
+    _pending_mixin = None
+
+    def __init__(self, capacity, ttl = None, *args, **kwargs):
+        if capacity < 1:
+            raise ValueError('capacity must be positive')
+        self._contents = OrderedDict()
+        self._expiries = dict()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        Restorable.__init__(self)
+        self.update(*args, **kwargs)
+
+    def __copy__(self):
+        copy = Restorable.__copy__(self)
+        if not _native_state(type(self)):
+            return copy
+        copy._expiries = self._expiries.copy()
+        copy.capacity, copy.ttl = self.capacity, self.ttl
+        copy.hits, copy.misses, copy.evictions = \
+            self.hits, self.misses, self.evictions
+        return copy
+
+    def __getstate__(self):
+        expiries = self._expiries
+        return (self.capacity, self.ttl,
+            (self.hits, self.misses, self.evictions),
+            [ (key, value, expiries.get(key))
+                for key, value in _iteritems(self._contents) ])
+
+    def _deepcopy_state(self, memo):
+        if type(self)._requires_restoration:
+            return Restorable._deepcopy_state(self, memo)
+        expiries = self._expiries
+        return (self.capacity, self.ttl,
+            (self.hits, self.misses, self.evictions),
+            [ (deepcopy(key, memo), deepcopy(value, memo), expiries.get(key))
+                for key, value in _iteritems(self._contents) ])
+
+    def __setstate__(self, state):
+        capacity, ttl, (hits, misses, evictions), restoration_data = state
+        Restorable.__setstate__(self, {
+            '_contents' : OrderedDict(),
+            '_expiries' : dict(),
+            'capacity' : capacity,
+            'ttl' : ttl,
+            'hits' : hits,
+            'misses' : misses,
+            'evictions' : evictions,
+            '_restoration_data' : restoration_data,
+        })
+
+    def _pending_state(self, restoration_data):
+        return (self.capacity, self.ttl,
+            (self.hits, self.misses, self.evictions), restoration_data)
+
+    def _out_of_band(self, state):
+        capacity, ttl, counters, entries = state
+        return capacity, ttl, counters, [
+            (key, _out_of_band_value(value), expiry)
+            for key, value, expiry in entries ]
+
+    def _restore(self, restoration_data):
+        contents, expiries = self._contents, self._expiries
+        now = time()
+        for key, value, expiry in restoration_data:
+            if expiry is None:
+                contents[key] = value
+            elif expiry > now:
+                contents[key] = value
+                expiries[key] = expiry
+
+    def __getitem__(self, item):
+        contents = self._contents
+        try:
+            value = contents.pop(item)
+        except KeyError:
+            self.misses += 1
+            raise
+        expiry = self._expiries.get(item)
+        if expiry is not None and expiry <= time():
+            del self._expiries[item]
+            self.misses += 1
+            raise KeyError(item)
+        contents[item] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value, self.ttl)
+
+    def put(self, key, value, ttl = None):
+        """
+        Sets the value of *key*, making it the most recently used entry, and
+        evicts the least recently used entry if over capacity.
+
+        :param float ttl: the number of seconds after which the entry expires,
+            or `None` if it never expires.
+        """
+        contents, expiries = self._contents, self._expiries
+        contents.pop(key, None)
+        contents[key] = value
+        if ttl is None:
+            expiries.pop(key, None)
+        else:
+            expiries[key] = time() + ttl
+        if len(contents) > self.capacity:
+            evicted, _ = contents.popitem(False)
+            expiries.pop(evicted, None)
+            self.evictions += 1
+
+    def expire(self):
+        """
+        Discards all expired entries.
+
+        :return: the number of entries discarded.
+        """
+        contents, expiries = self._contents, self._expiries
+        if not expiries:
+            return 0
+        now = time()
+        expired = [ key for key, expiry in _iteritems(expiries)
+            if expiry <= now ]
+        for key in expired:
+            del contents[key]
+            del expiries[key]
+        return len(expired)
+
+    def __delitem__(self, key):
+        del self._contents[key]
+        self._expiries.pop(key, None)
+
+    def __iter__(self):
+        self.expire()
+        return iter(self._contents)
+
+    def __contains__(self, key):
+        if key not in self._contents:
+            return False
+        expiry = self._expiries.get(key)
+        return expiry is None or expiry > time()
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        self.expire()
+        return self._contents.keys()
+
+    def values(self):
+        self.expire()
+        return self._contents.values()
+
+    def items(self):
+        self.expire()
+        return self._contents.items()
+
+    def iterkeys(self):
+        self.expire()
+        return iter(_iterkeys(self._contents))
+
+    def itervalues(self):
+        self.expire()
+        return iter(_itervalues(self._contents))
+
+    def iteritems(self):
+        self.expire()
+        return iter(_iteritems(self._contents))
+
+    def pop(self, key, *args):
+        value = self._contents.pop(key, *args)
+        self._expiries.pop(key, None)
+        return value
+
+    def popitem(self, last = True):
+        key, value = self._contents.popitem(last)
+        self._expiries.pop(key, None)
+        return key, value
+
+    def clear(self):
+        self._contents.clear()
+        self._expiries.clear()
+
+    def setdefault(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if isinstance(other, RestorableDict):
+                other = other._contents
+            if hasattr(other, 'keys'):
+                other = [ (key, other[key]) for key in other.keys() ]
+            for key, value in other:
+                self[key] = value
+        for key, value in _iteritems(kwargs):
+            self[key] = value
+
+    def __eq__(self, other):
+        # recency of use is not part of the value of the mapping
+        if isinstance(other, (RestorableDict, RestorableFrozenDict)):
+            other = other._contents
+        elif not isinstance(other, dict):
+            if not isinstance(other, Mapping):
+                return NotImplemented
+            other = dict(other.items())
+        return dict.__eq__(self._contents, other)
+
+    def __repr__(self):
+        return """RestorableLRUDict{}""".format(repr(self._contents))
+
+
+class RestorableWeakKeyDict(RestorableDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a
+    :class:`WeakKeyDictionary`, whose entries are discarded once their keys
+    are no longer referenced elsewhere.
+
+    Entries are pickled along with their keys; unpickling holds only weak
+    references to the keys until restoration, so that entries whose keys are
+    not reachable through the rest of the unpickled graph are discarded as
+    soon as the unpickler releases them, and are skipped by restoration.
+    """
+
+    __slots__ = ()
+
+    _observed_mixin = None
+
+    _pending_mixin = None
+
+    def __init__(self, *args, **kwargs):
+        self._contents = WeakKeyDictionary(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __getstate__(self):
+        return [ (key, value) for key, value in _iteritems(self._contents) ]
+
+    def _deepcopy_state(self, memo):
+        """
+        Like :class:`WeakKeyDictionary`, copies only the values; the copy
+        holds weak references to the very same keys.
+        """
+        return [ (key, deepcopy(value, memo))
+            for key, value in self.__getstate__() ]
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : WeakKeyDictionary(),
+            '_restoration_data' : [ (ref(key), value)
+                for key, value in state ],
+        })
+
+    def _pending_state(self, restoration_data):
+        return [ (key(), value) for key, value in restoration_data
+            if key() is not None ]
+
+    def _restore(self, restoration_data):
+        contents = self._contents
+        for key, value in restoration_data:
+            key = key()
+            if key is not None:
+                contents[key] = value
+
+    def __eq__(self, other):
+        if isinstance(other, (RestorableDict, RestorableFrozenDict)):
+            other = other._contents
+        if not isinstance(other, (Mapping, WeakKeyDictionary,
+                WeakValueDictionary)):
+            return NotImplemented
+        return dict(self._contents.items()) == dict(other.items())
+
+    def __repr__(self):
+        return """RestorableWeakKeyDict{}""".format(
+            repr(dict(self._contents.items())))
+
+
+class RestorableWeakValueDict(RestorableDict, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a
+    :class:`WeakValueDictionary`, whose entries are discarded once their values
+    are no longer referenced elsewhere.
+
+    Entries are pickled along with their values; unpickling holds only weak
+    references to the values until restoration, so that entries whose values
+    are not reachable through the rest of the unpickled graph are discarded as
+    soon as the unpickler releases them, and are skipped by restoration.
+    """
+
+    __slots__ = ()
+
+    _observed_mixin = None
+
+    _pending_mixin = None
+
+    def __init__(self, *args, **kwargs):
+        self._contents = WeakValueDictionary(*args, **kwargs)
+        Restorable.__init__(self)
+
+    def __getstate__(self):
+        return [ (key, value) for key, value in _iteritems(self._contents) ]
+
+    def _deepcopy_state(self, memo):
+        """
+        Like :class:`WeakValueDictionary`, copies only the keys; the copy
+        holds weak references to the very same values.
+        """
+        return [ (deepcopy(key, memo), value)
+            for key, value in self.__getstate__() ]
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : WeakValueDictionary(),
+            '_restoration_data' : [ (key, ref(value))
+                for key, value in state ],
+        })
+
+    def _pending_state(self, restoration_data):
+        return [ (key, value()) for key, value in restoration_data
+            if value() is not None ]
+
+    def _restore(self, restoration_data):
+        contents = self._contents
+        for key, value in restoration_data:
+            value = value()
+            if value is not None:
+                contents[key] = value
+
+    def __eq__(self, other):
+        if isinstance(other, (RestorableDict, RestorableFrozenDict)):
+            other = other._contents
+        if not isinstance(other, (Mapping, WeakKeyDictionary,
+                WeakValueDictionary)):
+            return NotImplemented
+        return dict(self._contents.items()) == dict(other.items())
+
+    def __repr__(self):
+        return """RestorableWeakValueDict{}""".format(
+            repr(dict(self._contents.items())))
+
+
+class RestorableFrozenDict(Restorable, object):
+    """
+    A read-only :class:`Mapping` restorable wrapper of a :class:`dict`.
+
+    Frozen mappings are hashable as long as their values are, and may
+    therefore be keys of other (restorable) collections. The hash is computed
+    from the items the first time it is requested after restoration, and is
+    then held in :attr:`_hash` and reused; it is never pickled.
+    """
+
+    __slots__ = ('_hash', )
+
+    _pending_mixin = _PendingMapping
+
+    def __init__(self, *args, **kwargs):
+        self._contents = dict(*args, **kwargs)
+        self._hash = None
+        Restorable.__init__(self)
+
+    def __copy__(self):
+        return self
+
+    def __getstate__(self):
+        return [ (key, value) for key, value in _iteritems(self._contents) ]
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : dict(),
+            '_hash' : None,
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        self._contents.update(restoration_data)
+
+    def _out_of_band(self, state):
+        return [ (key, _out_of_band_value(value)) for key, value in state ]
+
+    def __hash__(self):
+        if self._hash is not None:
+            return self._hash
+        value = hash(frozenset(_iteritems(self._contents)))
+        # contents accessed by their own restoration are still incomplete
+        if not type(self)._requires_restoration:
+            self._hash = value
+        return value
+
+    def __getitem__(self, item):
+        return self._contents[item]
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __contains__(self, key):
+        return key in self._contents
+
+    def get(self, key, default = None):
+        return self._contents.get(key, default)
+
+    def keys(self):
+        return self._contents.keys()
+
+    def values(self):
+        return self._contents.values()
+
+    def items(self):
+        return self._contents.items()
+
+    def iterkeys(self):
+        return iter(_iterkeys(self._contents))
+
+    def itervalues(self):
+        return iter(_itervalues(self._contents))
+
+    def iteritems(self):
+        return iter(_iteritems(self._contents))
+
+    def __eq__(self, other):
+        if isinstance(other, RestorableLRUDict):
+            # which compares regardless of recency of use
+            return NotImplemented
+        if isinstance(other, (RestorableDict, RestorableFrozenDict)):
+            other = other._contents
+        elif not isinstance(other, dict):
+            if not isinstance(other, Mapping):
+                return NotImplemented
+            return self._contents == dict(other.items())
+        return self._contents == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return """RestorableFrozenDict{}""".format(repr(self._contents))
+
+
+class RestorableKeyedDict(Restorable, object):
+    """
+    A :class:`MutableMapping` restorable wrapper of a :class:`dict` which holds
+    its entries by identifier rather than by key: a :attr:`_restorer` object
+    identifies keys, and resolves identifiers back to keys, through the
+    restoration protocol::
+
+        restorer.restoration_key(d, key, value, identifier = None)
+        restorer.restoration_map(d, identifier = None)
+
+    where *d* is the collection, and *identifier* the optional
+    :attr:`_identifier` distinguishing between collections of the same
+    restorer. :meth:`restoration_key` must return a built-in identifier, such
+    as an :class:`int` or :class:`str`, depending on the key alone; *value* is
+    `None` when identifying a key being looked up. :meth:`restoration_map` is
+    given the :class:`dict` of identifiers to values once restored, and must
+    return a :class:`dict` of identifiers to keys.
+
+    Pickled state therefore holds identifiers instead of keys, and neither
+    restoration nor lookups invoke the :meth:`__hash__` and :meth:`__eq__`
+    methods of keys; distinct keys with equal identifiers are the same key.
+    """
+
+    __slots__ = ('_restorer', '_identifier', '_keys', )
+
+    __hash__ = None
+
+    def __init__(self, restorer, identifier = None, *args, **kwargs):
+        self._contents = dict()
+        self._keys = dict()
+        self._restorer = restorer
+        self._identifier = identifier
+        Restorable.__init__(self)
+        self.update(*args, **kwargs)
+
+    def __copy__(self):
+        copy = Restorable.__copy__(self)
+        if not _native_state(type(self)):
+            return copy
+        copy._keys = self._keys.copy()
+        copy._restorer, copy._identifier = self._restorer, self._identifier
+        return copy
+
+    def __getstate__(self):
+        return (self._restorer, self._identifier,
+            [ (key, value) for key, value in _iteritems(self._contents) ])
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : dict(),
+            '_restorer' : state[0],
+            '_identifier' : state[1],
+            '_restoration_data' : state[2],
+        })
+
+    def _pending_state(self, restoration_data):
+        return self._restorer, self._identifier, restoration_data
+
+    def _out_of_band(self, state):
+        restorer, identifier, entries = state
+        return restorer, identifier, [ (key, _out_of_band_value(value))
+            for key, value in entries ]
+
+    def _restore(self, restoration_data):
+        contents = self._contents
+        contents.update(restoration_data)
+        self._keys = self._restorer.restoration_map(contents, self._identifier)
+
+    def _identify(self, key, value = None):
+        return self._restorer.restoration_key(self, key, value,
+            self._identifier)
+
+    def __getitem__(self, item):
+        contents = self._contents
+        return contents[self._identify(item)]
+
+    def __setitem__(self, key, value):
+        contents = self._contents
+        identifier = self._identify(key, value)
+        contents[identifier] = value
+        self._keys[identifier] = key
+
+    def __delitem__(self, key):
+        contents = self._contents
+        identifier = self._identify(key)
+        del contents[identifier]
+        del self._keys[identifier]
+
+    def __iter__(self):
+        contents = self._contents
+        keys = self._keys
+        return (keys[identifier] for identifier in contents)
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __contains__(self, key):
+        contents = self._contents
+        return self._identify(key) in contents
+
+    def get(self, key, default = None):
+        contents = self._contents
+        return contents.get(self._identify(key), default)
+
+    def keys(self):
+        contents = self._contents
+        keys = self._keys
+        return [ keys[identifier] for identifier in contents ]
+
+    def values(self):
+        return self._contents.values()
+
+    def items(self):
+        contents = self._contents
+        keys = self._keys
+        return [ (keys[identifier], value)
+            for identifier, value in _iteritems(contents) ]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return iter(_itervalues(self._contents))
+
+    def iteritems(self):
+        contents = self._contents
+        keys = self._keys
+        return ((keys[identifier], value)
+            for identifier, value in _iteritems(contents))
+
+    def pop(self, key, *args):
+        contents = self._contents
+        identifier = self._identify(key)
+        value = contents.pop(identifier, *args)
+        self._keys.pop(identifier, None)
+        return value
+
+    def popitem(self):
+        identifier, value = self._contents.popitem()
+        return self._keys.pop(identifier), value
+
+    def clear(self):
+        self._contents.clear()
+        self._keys.clear()
+
+    def setdefault(self, key, default = None):
+        contents = self._contents
+        identifier = self._identify(key)
+        if identifier in contents:
+            return contents[identifier]
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                other = [ (key, other[key]) for key in other.keys() ]
+            for key, value in other:
+                self[key] = value
+        for key, value in _iteritems(kwargs):
+            self[key] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return """RestorableKeyedDict{}""".format(repr(dict(self.iteritems())))
+
+
+#: Header of files written by :class:`RestorableMappedDict`: a magic string
+#: followed by the offset and length of the current index.
+_MAPPED_HEADER = Struct('>8sQQ')
+
+_MAPPED_MAGIC = b'RCMAPPED'
+
+
+def _stable_hash(key):
+    """
+    :return: a hash of *key* which, unlike :func:`hash`, is the same in every
+        process, for strings, numbers, and tuples thereof; keys which are
+        equal have equal hashes.
+    :raises TypeError: for keys of any other type.
+    """
+    if isinstance(key, _text):
+        key = key.encode('utf-8')
+    if isinstance(key, bytes):
+        return crc32(key) & 0xffffffff
+    if isinstance(key, _integers):
+        return key
+    if isinstance(key, float):
+        if key.is_integer():
+            return int(key)
+        return crc32(repr(key).encode('ascii')) & 0xffffffff
+    if isinstance(key, tuple):
+        result = 0x345678
+        for item in key:
+            result = crc32(str(_stable_hash(item)).encode('ascii'), result)
+        return result & 0xffffffff
+    raise TypeError(
+        "keys of type {} require a partition function".format(
+            type(key).__name__))
+
+
+class RestorableMappedDict(Restorable, object):
+    """
+    A :class:`MutableMapping` restorable dictionary stored in a file at
+    :attr:`path` rather than in memory, for mappings larger than the memory
+    available.
+
+    Entries are partitioned into shards by the stable hash of their keys, and
+    each shard is pickled independently into the file, which is
+    memory-mapped and unpickled one shard at a time, as keys of the shard are
+    first looked up or iterated over. The wrapped :attr:`_contents` holds the
+    shards loaded so far, least recently used first; once the loaded shards
+    hold more entries than the :attr:`budget`, least recently used shards are
+    evicted, being written back first if changed.
+
+    Shards map the identifiers of keys, which are the keys themselves unless
+    a :attr:`partition` function returns them, to pairs of keys and values.
+    Keys are therefore never hashed by unpickling, so that cycles through the
+    keys of a shard are restored safely, and keys comparing by identity are
+    still found by lookups once their shard is evicted and unpickled anew.
+    Shards are however separate object graphs: objects reachable from several
+    shards are unpickled once per shard.
+
+    Looking up values other than strings, numbers and `None` marks their
+    shard as changed, so that changes made to them in place are written back
+    once the shard is evicted; values held across the eviction of their
+    shard, however, are no longer those of the dictionary.
+
+    Changes are appended to the file, followed by a new index of the shards
+    which becomes current once written by :meth:`flush`, so that the file
+    remains valid, although it grows, across interrupted writes. Pickling
+    flushes the dictionary and holds only its path, partition and budget; a
+    file must be opened by one dictionary at a time, which is why
+    dictionaries are neither copied nor snapshotted.
+
+    Hashes of strings, numbers, and tuples thereof are the same in every
+    process opening the file; keys of any other type require a pickleable
+    :attr:`partition` function, returning such a key (e.g. an identifier)
+    for each key.
+    """
+
+    __slots__ = ('path', 'partition', 'budget', '_file', '_map', '_index',
+        '_resident', '_changed', '_unindexed', )
+
+    __hash__ = None
+
+    def __init__(self, path, shards = 64, partition = None, budget = None,
+            *args, **kwargs):
+        if shards < 1:
+            raise ValueError('shards must be positive')
+        self._contents = OrderedDict()
+        self.path = path
+        self.partition = partition
+        self.budget = budget
+        Restorable.__init__(self)
+        self._open(shards)
+        self.update(*args, **kwargs)
+
+    def __getstate__(self):
+        self.flush()
+        return self.path, self.partition, self.budget
+
+    def __setstate__(self, state):
+        path, partition, budget = state
+        Restorable.__setstate__(self, {
+            '_contents' : OrderedDict(),
+            'path' : path,
+            'partition' : partition,
+            'budget' : budget,
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        self._open(None)
+
+    def _open(self, shards):
+        """
+        Opens the file at :attr:`path`, which is created with *shards* empty
+        shards if it does not exist, unless *shards* is `None`.
+        """
+        try:
+            f = open(self.path, 'r+b')
+        except IOError as e:
+            if shards is None or e.errno != ENOENT:
+                raise
+            f = open(self.path, 'w+b')
+            f.write(_MAPPED_HEADER.pack(_MAPPED_MAGIC, 0, 0))
+            self._file, self._map = f, None
+            self._index = [ (None, 0, 0) ] * shards
+            self._write_index()
+        else:
+            self._file, self._map = f, None
+            magic, offset, length = _MAPPED_HEADER.unpack(
+                self._read(0, _MAPPED_HEADER.size))
+            if magic != _MAPPED_MAGIC:
+                f.close()
+                raise ValueError(
+                    "{} is not a mapped dictionary".format(self.path))
+            self._index = cPickle.loads(self._read(offset, length))
+        self._resident = 0
+        self._changed = set()
+        self._unindexed = False
+
+    def _read(self, offset, length):
+        """
+        :return: *length* bytes at *offset* of the memory-mapped file, which
+            is mapped again if it has grown since.
+        """
+        end = offset + length
+        if self._map is None or end > len(self._map):
+            if self._map is not None:
+                self._map.close()
+            self._file.flush()
+            self._map = mmap(self._file.fileno(), 0, access = ACCESS_READ)
+        return self._map[offset:end]
+
+    def _append(self, value):
+        """
+        Appends *value* pickled to the file.
+
+        :return: the offset and length of the pickled *value*.
+        """
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        f = self._file
+        f.seek(0, 2)
+        offset = f.tell()
+        f.write(data)
+        return offset, len(data)
+
+    def _write_index(self):
+        f = self._file
+        offset, length = self._append(self._index)
+        f.seek(0)
+        f.write(_MAPPED_HEADER.pack(_MAPPED_MAGIC, offset, length))
+        f.flush()
+        self._unindexed = False
+
+    def _write(self, number, shard):
+        """
+        Appends a changed *shard* to the file, and indexes it.
+        """
+        if shard:
+            offset, length = self._append(list(shard.items()))
+        else:
+            offset, length = None, 0
+        self._index[number] = (offset, length, len(shard))
+        self._changed.discard(number)
+        self._unindexed = True
+
+    def _shard(self, key):
+        """
+        :return: the identifier of *key*, along with the number of the shard
+            holding it and the loaded shard.
+        """
+        # restores this dictionary, and thereby its index, if still pending
+        contents = self._contents
+        partition = self.partition
+        identifier = key if partition is None else partition(key)
+        number = _stable_hash(identifier) % len(self._index)
+        return identifier, number, self._load(contents, number)
+
+    def _looked_up(self, number, value):
+        """
+        Marks the shard numbered *number* as changed unless *value*, looked up
+        in it, is immutable.
+
+        :return: *value*.
+        """
+        if type(value) not in _ATOMIC_CLASSES:
+            self._changed.add(number)
+        return value
+
+    def _load(self, contents, number):
+        """
+        :return: the shard numbered *number*, which is unpickled unless already
+            loaded, and becomes the most recently used.
+        """
+        shard = contents.pop(number, None)
+        if shard is None:
+            offset, length, count = self._index[number]
+            if offset is None:
+                shard = dict()
+            else:
+                shard = dict(cPickle.loads(self._read(offset, length)))
+            self._resident += count
+        contents[number] = shard
+        budget = self.budget
+        if budget is not None:
+            while self._resident > budget and len(contents) > 1:
+                evicted = next(iter(contents))
+                evicted_shard = contents[evicted]
+                if evicted in self._changed:
+                    self._write(evicted, evicted_shard)
+                del contents[evicted]
+                self._resident -= len(evicted_shard)
+        return shard
+
+    def _shards(self):
+        contents = self._contents
+        for number in _range(len(self._index)):
+            yield number, self._load(contents, number)
+
+    def flush(self):
+        """
+        Writes the changed shards, followed by a new index, to the file.
+        """
+        contents = self._contents
+        changed = self._changed
+        if not changed and not self._unindexed:
+            return
+        for number in sorted(changed):
+            self._write(number, contents[number])
+        self._write_index()
+
+    def close(self):
+        """
+        Flushes this dictionary and closes its file, after which this
+        dictionary can no longer be used.
+        """
+        self.flush()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+        self._contents.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __copy__(self):
+        raise TypeError('cannot copy a RestorableMappedDict')
+
+    def __deepcopy__(self, memo):
+        raise TypeError('cannot copy a RestorableMappedDict')
+
+    def snapshot(self):
+        raise TypeError('cannot snapshot a RestorableMappedDict')
+
+    def __getitem__(self, item):
+        identifier, number, shard = self._shard(item)
+        try:
+            key, value = shard[identifier]
+        except KeyError:
+            raise KeyError(item)
+        return self._looked_up(number, value)
+
+    def __setitem__(self, key, value):
+        identifier, number, shard = self._shard(key)
+        entry = shard.get(identifier)
+        if entry is None:
+            self._resident += 1
+        else:
+            key = entry[0]
+        shard[identifier] = (key, value)
+        self._changed.add(number)
+
+    def __delitem__(self, key):
+        identifier, number, shard = self._shard(key)
+        try:
+            del shard[identifier]
+        except KeyError:
+            raise KeyError(key)
+        self._changed.add(number)
+        self._resident -= 1
+
+    def __iter__(self):
+        for number, shard in self._shards():
+            for key, value in _itervalues(shard):
+                yield key
+
+    def __len__(self):
+        contents = self._contents
+        return sum(len(contents[number]) if number in contents else count
+            for number, (offset, length, count) in enumerate(self._index))
+
+    def __contains__(self, key):
+        identifier, number, shard = self._shard(key)
+        return identifier in shard
+
+    def get(self, key, default = None):
+        identifier, number, shard = self._shard(key)
+        entry = shard.get(identifier)
+        return default if entry is None else self._looked_up(number, entry[1])
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for number, shard in self._shards():
+            for key, value in _itervalues(shard):
+                yield self._looked_up(number, value)
+
+    def iteritems(self):
+        for number, shard in self._shards():
+            for key, value in _itervalues(shard):
+                yield key, self._looked_up(number, value)
+
+    def pop(self, key, *args):
+        identifier, number, shard = self._shard(key)
+        entry = shard.pop(identifier, None)
+        if entry is None:
+            if args:
+                return args[0]
+            raise KeyError(key)
+        self._changed.add(number)
+        self._resident -= 1
+        return entry[1]
+
+    def popitem(self):
+        for number, shard in self._shards():
+            if shard:
+                self._changed.add(number)
+                self._resident -= 1
+                return shard.popitem()[1]
+        raise KeyError('popitem(): dictionary is empty')
+
+    def clear(self):
+        contents = self._contents
+        contents.clear()
+        self._resident = 0
+        for number in _range(len(self._index)):
+            contents[number] = dict()
+        self._changed = set(contents)
+
+    def setdefault(self, key, default = None):
+        identifier, number, shard = self._shard(key)
+        entry = shard.get(identifier)
+        if entry is not None:
+            return self._looked_up(number, entry[1])
+        shard[identifier] = (key, default)
+        self._changed.add(number)
+        self._resident += 1
+        return default
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                other = [ (key, other[key]) for key in other.keys() ]
+            for key, value in other:
+                self[key] = value
+        for key, value in _iteritems(kwargs):
+            self[key] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        # comparing does not change values, nor therefore shards
+        for number, shard in self._shards():
+            for key, value in _itervalues(shard):
+                if key not in other or other[key] != value:
+                    return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return """RestorableMappedDict({})""".format(repr(self.path))
+
+
+class RestorableShardedDict(Restorable, object):
+    """
+    A :class:`MutableMapping` restorable dictionary whose entries are
+    partitioned into a fixed number of :class:`RestorableDict` shards, by the
+    same stable hash of their keys, or of their :attr:`partition`, as
+    :class:`RestorableMappedDict`, so that the shards of large dictionaries
+    can be checkpointed in parallel by :func:`dump_sharded`, and recovered by
+    :func:`load_sharded`.
+
+    Pickled as usual, the dictionary holds its shards, all of which are
+    pickled along with it; each shard is restored upon its own first access.
+    """
+
+    __slots__ = ('partition', )
+
+    __hash__ = None
+
+    def __init__(self, shards = 16, partition = None, *args, **kwargs):
+        if shards < 1:
+            raise ValueError('shards must be positive')
+        self._contents = [ RestorableDict() for _ in _range(shards) ]
+        self.partition = partition
+        Restorable.__init__(self)
+        self.update(*args, **kwargs)
+
+    def __getstate__(self):
+        return self.partition, self._contents
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : [],
+            'partition' : state[0],
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        self._contents.extend(restoration_data[1])
+
+    def _shard(self, key):
+        """
+        :return: the shard holding *key*.
+        """
+        contents = self._contents
+        partition = self.partition
+        return contents[_stable_hash(key if partition is None
+            else partition(key)) % len(contents)]
+
+    def __copy__(self):
+        cls = _public_class(type(self))
+        if not _native_state(cls):
+            return Restorable.__copy__(self)
+        copy = cls.__new__(cls)
+        copy._contents = [ shard.__copy__() for shard in self._contents ]
+        copy.partition = self.partition
+        return copy
+
+    def snapshot(self):
+        raise TypeError('cannot snapshot a RestorableShardedDict')
+
+    def __getitem__(self, item):
+        return self._shard(item)[item]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def __iter__(self):
+        for shard in self._contents:
+            for key in shard:
+                yield key
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._contents)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def get(self, key, default = None):
+        return self._shard(key).get(key, default)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for shard in self._contents:
+            for value in shard.itervalues():
+                yield value
+
+    def iteritems(self):
+        for shard in self._contents:
+            for item in shard.iteritems():
+                yield item
+
+    def pop(self, key, *args):
+        return self._shard(key).pop(key, *args)
+
+    def popitem(self):
+        for shard in self._contents:
+            if shard:
+                return shard.popitem()
+        raise KeyError('popitem(): dictionary is empty')
+
+    def clear(self):
+        for shard in self._contents:
+            shard.clear()
+
+    def setdefault(self, key, default = None):
+        return self._shard(key).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                other = [ (key, other[key]) for key in other.keys() ]
+            for key, value in other:
+                self[key] = value
+        for key, value in _iteritems(kwargs):
+            self[key] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for key, value in self.iteritems():
+            if key not in other or other[key] != value:
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return """RestorableShardedDict{}""".format(repr(dict(self.items())))
+
+
+def dump_sharded(sharded, directory, processes = None, protocol = None):
+    """
+    Pickles each shard of the :class:`RestorableShardedDict` *sharded* into its
+    own file in *directory*, followed by an index of the shards, in a pool of
+    *processes* forked from the current process, so that the time taken
+    decreases with the number of cores. Where processes cannot be forked, the
+    shards are pickled in the current process instead.
+
+    Each checkpoint is a generation of files tagged with a random name. The
+    index naming the generation is written under a temporary name and replaces
+    the previous one last, after which the shards of other generations are
+    removed, so that an interrupted checkpoint leaves the previous one intact.
+
+    Shards are separate pickles, which would otherwise unpickle objects
+    reachable from several shards once per shard, breaking cycles across
+    shards. Instead, the object graph is walked beforehand, and each object
+    reachable from the shards is owned by the first shard from which it is
+    reached: it is pickled in full by its owner, and as a reference to it by
+    all other shards, which :func:`load_sharded` resolves. References to
+    *sharded* itself, and to its shards, are resolved likewise. This applies
+    to objects pickled with their class and state alone, which is the case for
+    instances of most classes and for restorable collections; other objects,
+    such as tuples, are unpickled once per shard from which they are reached,
+    unless they are mutable, in which case they cannot be pickled.
+
+    :param RestorableShardedDict sharded: the dictionary to pickle.
+    :param str directory: the directory to pickle into, which is created if
+        it does not exist.
+    :param int processes: the number of processes; the number of cores by
+        default.
+    :param int protocol: the pickle protocol, at least 2; the highest by
+        default.
+    :raises ValueError: if *protocol* is less than 2, or if an unhashable
+        object, such as a :class:`list`, which cannot be owned by a shard, is
+        reachable from several shards.
+    """
+    if protocol is None:
+        protocol = cPickle.HIGHEST_PROTOCOL
+    elif 0 <= protocol < 2:
+        raise ValueError('pickle protocol 2 or later is required')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    shards = sharded._contents
+    generation = hexlify(os.urandom(8)).decode('ascii')
+    dump = shards, directory, generation, _shard_owners(sharded), protocol
+    processes = min(processes or _cpu_count, len(shards))
+    pool = _fork_pool(processes, dump) if processes > 1 else None
+    if pool is None:
+        for number in _range(len(shards)):
+            _dump_shard(number, *dump)
+    else:
+        try:
+            pool.map(_dump_worker_shard, _range(len(shards)), 1)
+        finally:
+            pool.terminate()
+            pool.join()
+    index = len(shards), sharded.partition, generation
+    _write_replacing(os.path.join(directory, 'index.pickle'),
+        lambda f: cPickle.dump(index, f, protocol))
+    current = set(_shard_name(number, generation)
+        for number in _range(len(shards)))
+    for name in os.listdir(directory):
+        if name not in current and _SHARD_NAME.match(name):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
+
+
+def load_sharded(directory):
+    """
+    Unpickles a :class:`RestorableShardedDict` pickled by :func:`dump_sharded`
+    from *directory*, resolving the references between its shards.
+
+    Shards are unpickled one after the other in the current process, since
+    objects referenced across shards must be created in the same process, and
+    unpickling does not run in parallel within one; the time taken is instead
+    kept to unpickling, as each shard is restored upon its own first access, or
+    all of them at once within a :func:`restoring` context.
+
+    :param str directory: the directory pickled into by :func:`dump_sharded`.
+    :return: the unpickled dictionary.
+    :raises UnpicklingError: if a shard belongs to another generation than
+        the index, or if objects referenced across shards are defined by none.
+    """
+    with open(os.path.join(directory, 'index.pickle'), 'rb') as f:
+        count, partition, generation = cPickle.load(f)
+    # created first, so that references to it from the shards resolve to it
+    sharded = RestorableShardedDict.__new__(RestorableShardedDict)
+    shards = []
+    objects = _tracking.shard_objects = { (-1, 0) : sharded }
+    defined = _tracking.shard_definitions = set([ id(sharded) ])
+    try:
+        for number in _range(count):
+            path = os.path.join(directory, _shard_name(number, generation))
+            with open(path, 'rb') as f:
+                if cPickle.load(f) != (number, generation):
+                    raise UnpicklingError('{} does not belong to generation '
+                        '{}'.format(path, generation))
+                shards.append(_ShardUnpickler(f).load())
+    finally:
+        del _tracking.shard_objects, _tracking.shard_definitions
+    undefined = sorted(key for key, obj in _iteritems(objects)
+        if id(obj) not in defined)
+    if undefined:
+        raise UnpicklingError('objects {} of generation {} are referenced but '
+            'not defined'.format(undefined, generation))
+    sharded._contents = shards
+    sharded.partition = partition
+    return sharded
+
+#: The shards, directory, generation, owners, and protocol of the
+#: :func:`dump_sharded` of a worker process, set by :func:`_init_dump_worker`
+#: once forked.
+_worker_dump = None
+
+#: The names of the shard files of any generation.
+_SHARD_NAME = re.compile(r'shard-\d+-[0-9a-f]+\.pickle$')
+
+
+def _shard_name(number, generation):
+    return 'shard-{}-{}.pickle'.format(number, generation)
+
+
+def _write_replacing(path, write):
+    """
+    Calls *write* with a temporary file, which then replaces the file at
+    *path*.
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        write(f)
+    _replace(temporary, path)
+
+
+def _dump_shard(number, shards, directory, generation, owners, protocol):
+    # named after a generation which no index names yet, hence not replacing
+    with open(os.path.join(directory, _shard_name(number, generation)),
+            'wb') as f:
+        cPickle.dump((number, generation), f, protocol)
+        _ShardPickler(f, protocol, number, owners).dump(shards[number])
+
+
+def _init_dump_worker(*dump):
+    global _worker_dump
+    _worker_dump = dump
+
+
+def _dump_worker_shard(number):
+    _dump_shard(number, *_worker_dump)
+
+
+def _fork_pool(processes, dump):
+    """
+    :return: a :class:`multiprocessing.Pool` of *processes* forked from the
+        current process, which inherit the arguments *dump* of
+        :func:`_dump_shard` without pickling them, or `None` if processes
+        cannot be forked.
+    """
+    if get_context is None:
+        if os.name != 'posix':
+            return None
+        return Pool(processes, _init_dump_worker, dump)
+    try:
+        context = get_context('fork')
+    except ValueError:
+        return None
+    return context.Pool(processes, _init_dump_worker, dump)
+
+
+#: The classes of weak dictionaries, whose referents are walked explicitly.
+_WEAK_CLASSES = (WeakKeyDictionary, WeakValueDictionary, )
+
+
+def _shard_owners(sharded):
+    """
+    Walks the object graph reachable from the shards of the
+    :class:`RestorableShardedDict` *sharded*, one shard after the other.
+
+    :return: a :class:`dict` from the identities of the objects which can be
+        owned by a shard, to the number of the first shard from which they are
+        reached, their index within the shard, and their class. *sharded*
+        itself is owned by no shard, numbered -1, and each shard is the first
+        object of its own.
+    :raises ValueError: if an unhashable object which cannot be owned is
+        reachable from several shards.
+    """
+    shards = sharded._contents
+    owners = { id(sharded) : (-1, 0, _public_class(type(sharded))) }
+    for number, shard in enumerate(shards):
+        owners[id(shard)] = (number, 0, _public_class(type(shard)))
+    # the last shard from which objects which cannot be owned are reached
+    reached = { id(shards) : -1 }
+    # from classes to whether they are skipped, owned, or reached, and their
+    # public class
+    kinds = dict()
+    # filtered out ahead, including the classes of all objects
+    skipped = _ATOMIC_CLASSES.union((type, ))
+    for number, shard in enumerate(shards):
+        index = 1
+        objects = [shard]
+        while objects:
+            # one level of the graph at a time, to call gc once per level
+            referents = gc.get_referents(*objects)
+            objects = []
+            for referent in compress(referents, map(not_, map(
+                    skipped.__contains__, map(type, referents)))):
+                key = id(referent)
+                if key in owners:
+                    continue
+                cls = type(referent)
+                kind = kinds.get(cls)
+                if kind is None:
+                    kind = kinds[cls] = _shard_kind(cls)
+                owned, public = kind
+                if owned:
+                    owners[key] = (number, index, public)
+                    index += 1
+                elif owned is None:
+                    continue
+                else:
+                    first = reached.get(key)
+                    if first == number:
+                        continue
+                    if first is not None and public.__hash__ is None:
+                        raise ValueError('{} reachable from several shards '
+                            'cannot be pickled'.format(public.__name__))
+                    reached[key] = number
+                objects.append(referent)
+                if cls in _WEAK_CLASSES:
+                    # pickled along with their referents, which gc does not
+                    # report, and are the referents of this list in turn
+                    objects.append(list(chain.from_iterable(referent.items())))
+    return owners
+
+
+def _shard_kind(cls):
+    """
+    :return: `None` if objects of class *cls* are pickled by name, and need
+        not be owned, otherwise whether they can be owned by a shard, along
+        with the public class of *cls*.
+    """
+    if issubclass(cls, _OPAQUE_CLASSES):
+        return None, cls
+    cls = _public_class(cls)
+    return _ownable(cls), cls
+
+
+def _ownable(cls):
+    """
+    :return: `True` if objects of class *cls* are pickled with their class and
+        state alone, and can therefore be created before their state is
+        unpickled.
+    """
+    if cls in _ATOMIC_CLASSES or cls in dispatch_table or \
+            issubclass(cls, (list, tuple, dict, set, frozenset) +
+                _OPAQUE_CLASSES):
+        return False
+    for name in ('__getnewargs__', '__getnewargs_ex__'):
+        if _defining_class(cls, name) is not None:
+            return False
+    return _defining_class(cls, '__reduce__') is object and \
+        _defining_class(cls, '__reduce_ex__') in (object, Restorable)
+
+
+def _defining_class(cls, name):
+    """
+    :return: the class of the method resolution order of *cls* which defines
+        the attribute *name*, or `None`.
+    """
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            return base
+    return None
+
+
+class _ShardPickler(Pickler, object):
+    """
+    Pickles a shard for :func:`dump_sharded`, as a reference any object owned
+    by another shard, and in full, along with its creation, any object owned by
+    this shard the first time it occurs.
+    """
+
+    def __init__(self, file, protocol, number, owners):
+        Pickler.__init__(self, file, protocol)
+        self._protocol = protocol
+        self._number = number
+        self._owners = owners
+        self._defined = set()
+
+    if version_info >= (3, 8):
+
+        # only invoked for objects other than built-in values and containers,
+        # unlike persistent_id, which is invoked for every object
+        def reducer_override(self, obj):
+            owner = self._owners.get(id(obj))
+            if owner is None:
+                return NotImplemented
+            if owner[0] != self._number:
+                return _shard_object, owner
+            reduction = obj.__reduce_ex__(self._protocol)
+            return _define_shard_object, owner, \
+                reduction[2] if len(reduction) > 2 else None, None, None, \
+                _set_state
+
+    else:
+
+        def persistent_id(self, obj):
+            if type(obj) is _Creation:
+                return obj.pid
+            owner = self._owners.get(id(obj))
+            if owner is None:
+                return None
+            if owner[0] != self._number or id(obj) in self._defined:
+                return owner
+            self._defined.add(id(obj))
+            reduction = obj.__reduce_ex__(self._protocol)
+            return _Creation(owner), \
+                reduction[2] if len(reduction) > 2 else None
+
+
+class _ShardUnpickler(Unpickler, object):
+    """
+    Unpickles a shard for :func:`load_sharded`, whose objects owned by any
+    shard are created by :func:`_shard_object`.
+    """
+
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple) and len(pid) == 2:
+            obj, state = pid
+            _tracking.shard_definitions.add(id(obj))
+            _set_state(obj, state)
+            return obj
+        try:
+            number, index, cls = pid
+        except (TypeError, ValueError):
+            cls = None
+        if not isinstance(cls, type):
+            raise UnpicklingError('unsupported persistent id: {!r}'.format(
+                pid))
+        return _shard_object(number, index, cls)
+
+
+def _shard_object(number, index, cls):
+    """
+    :return: the object numbered *index* owned by shard *number* of the current
+        :func:`load_sharded`, which is created as an uninitialized object of
+        class *cls* upon its first reference or definition, whichever comes
+        first.
+    """
+    objects = _tracking.shard_objects
+    obj = objects.get((number, index))
+    if obj is None:
+        obj = objects[number, index] = cls.__new__(cls)
+    return obj
+
+
+def _define_shard_object(number, index, cls):
+    """
+    :return: the object returned by :func:`_shard_object`, noting that it is
+        defined by shard *number* rather than only referenced.
+    """
+    obj = _shard_object(number, index, cls)
+    _tracking.shard_definitions.add(id(obj))
+    return obj
+
+
+def _set_state(obj, state):
+    """
+    Sets the *state* of *obj*, as returned by its :meth:`__reduce_ex__`, in the
+    same way as unpickling does.
+    """
+    if state is None:
+        return
+    setstate = getattr(obj, '__setstate__', None)
+    if setstate is not None:
+        setstate(state)
+        return
+    slots = None
+    if isinstance(state, tuple) and len(state) == 2:
+        state, slots = state
+    if state:
+        obj.__dict__.update(state)
+    if slots:
+        for name, value in _iteritems(slots):
+            setattr(obj, name, value)
+
+
+class RestorableSet(Restorable, object):
+    """
+    A :class:`MutableSet` restorable wrapper of a :class:`set`.
+
+    Implements the entire :class:`MutableSet` interface by delegation to the
+    wrapped :class:`set`, and is registered as a virtual subclass of
+    :class:`MutableSet` instead of inheriting from it, so that it need not
+    carry a per-instance :attr:`__dict__`.
+    """
+
+    __slots__ = ()
+
+    __hash__ = None
+
+    _observed_mixin = _ObservedSet
+
+    _pending_mixin = _PendingSet
+
+    def __init__(self, *args):
+        self._contents = set(*args)
+        Restorable.__init__(self)
+
+    def __getstate__(self):
+        return list(self._contents)
+
+    def _deepcopy_state(self, memo):
+        if type(self)._requires_restoration:
+            return Restorable._deepcopy_state(self, memo)
+        return [ deepcopy(element, memo) for element in self._contents ]
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : set(),
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        self._contents.update(restoration_data)
+
+    def _delta(self, elements):
+        contents = self._contents
+        return ([ element for element in elements if element in contents ],
+            [ element for element in elements if element not in contents ])
+
+    def _apply_delta(self, changes):
+        added, removed = changes
+        self._contents.difference_update(removed)
+        self._contents.update(added)
+
+    def _from_contents(self, contents):
+        restorable = RestorableSet.__new__(_public_class(type(self)))
+        restorable._contents = contents
+        return restorable
+
+    def __contains__(self, x):
+        return x in self._contents
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def __len__(self):
+        return len(self._contents)
+
+    def add(self, value):
+        return self._contents.add(value)
+
+    def discard(self, value):
+        return self._contents.discard(value)
+
+    def remove(self, value):
+        self._contents.remove(value)
+
+    def pop(self):
+        return self._contents.pop()
+
+    def clear(self):
+        self._contents.clear()
+
+    def isdisjoint(self, other):
+        return self._contents.isdisjoint(_set_operand(other, Iterable))
+
+    def __le__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents <= other
+
+    def __lt__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents < other
+
+    def __ge__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents >= other
+
+    def __gt__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents > other
+
+    def __eq__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents == other
+
+    def __ne__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents != other
+
+    def __and__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents & other)
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents | other)
+
+    __ror__ = __or__
+
+    def __xor__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents ^ other)
+
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents - other)
+
+    def __rsub__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(other - self._contents)
+
+    def __iand__(self, other):
+        self._contents &= _set_operand(other, Iterable)
+        return self
+
+    def __ior__(self, other):
+        self._contents |= _set_operand(other, Iterable)
+        return self
+
+    def __ixor__(self, other):
+        self._contents ^= _set_operand(other, Iterable)
+        return self
+
+    def __isub__(self, other):
+        self._contents -= _set_operand(other, Iterable)
+        return self
+
+    def __repr__(self):
+        return """RestorableSet{}""".format(repr(self._contents))
+
+
+class RestorableFrozenSet(Restorable, object):
+    """
+    A :class:`Set` restorable wrapper of a :class:`frozenset`.
+
+    Frozen sets are hashable, and may therefore be keys of other (restorable)
+    collections or elements of other (restorable) sets. The hash is computed
+    the first time it is requested after restoration, and is then held in
+    :attr:`_hash` and reused; it is never pickled. Frozen sets are equal to,
+    and hash like, :class:`frozenset` objects of the same elements.
+    """
+
+    __slots__ = ('_hash', )
+
+    _pending_mixin = _PendingSet
+
+    def __init__(self, *args):
+        self._contents = frozenset(*args)
+        self._hash = None
+        Restorable.__init__(self)
+
+    def __copy__(self):
+        return self
+
+    def __getstate__(self):
+        return list(self._contents)
+
+    def _deepcopy_state(self, memo):
+        if type(self)._requires_restoration:
+            return Restorable._deepcopy_state(self, memo)
+        return [ deepcopy(element, memo) for element in self._contents ]
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : frozenset(),
+            '_hash' : None,
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        self._contents = frozenset(restoration_data)
+
+    def _from_contents(self, contents):
+        restorable = RestorableFrozenSet.__new__(type(self))
+        restorable._contents = frozenset(contents)
+        restorable._hash = None
+        return restorable
+
+    def __hash__(self):
+        if self._hash is not None:
+            return self._hash
+        value = hash(self._contents)
+        # contents accessed by their own restoration are still incomplete
+        if not type(self)._requires_restoration:
+            self._hash = value
+        return value
+
+    def __contains__(self, x):
+        return x in self._contents
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def __len__(self):
+        return len(self._contents)
+
+    def isdisjoint(self, other):
+        return self._contents.isdisjoint(_set_operand(other, Iterable))
+
+    def __le__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents <= other
+
+    def __lt__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents < other
+
+    def __ge__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents >= other
+
+    def __gt__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents > other
+
+    def __eq__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents == other
+
+    def __ne__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else self._contents != other
+
+    def __and__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents & other)
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents | other)
+
+    __ror__ = __or__
+
+    def __xor__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents ^ other)
+
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(self._contents - other)
+
+    def __rsub__(self, other):
+        other = _set_operand(other, Iterable)
+        return NotImplemented if other is None else \
+            self._from_contents(other - self._contents)
+
+    def __repr__(self):
+        return """RestorableFrozenSet{}""".format(repr(self._contents))
+
+
+def _set_operand(other, required):
+    """
+    Converts *other* to an operand of native :class:`set` operations.
+
+    :param object other: the operand of a :class:`RestorableSet` or
+        :class:`RestorableFrozenSet` operation.
+    :param type required: the Abstract Base Class *other* must be an instance
+        of, either :class:`Set` or :class:`Iterable`.
+    :return: the wrapped contents of restorable sets, *other* itself if it is
+        a :class:`set` or :class:`frozenset`, a new :class:`set` of its
+        elements if it is an instance of *required*, and `None` otherwise.
+    """
+    if isinstance(other, (RestorableSet, RestorableFrozenSet)):
+        return other._contents
+    if isinstance(other, (set, frozenset)):
+        return other
+    if isinstance(other, required):
+        return set(other)
+    return None
+
+
+class RestorableOrderedSet(Restorable, object):
+    """
+    A :class:`MutableSet` restorable wrapper which remembers the order in which
+    elements were first added, wrapping the keys of an :class:`OrderedDict`.
+
+    Membership, :meth:`add`, :meth:`discard`, :meth:`pop`, and
+    :meth:`move_to_end` towards the end take constant time, as does
+    :meth:`move_to_end` towards the beginning where :class:`OrderedDict`
+    supports it (Python 3); iteration follows insertion order. The pickled
+    state is the list of elements in order.
+
+    Equality with another :class:`RestorableOrderedSet` is order-sensitive,
+    whereas equality with any other :class:`Set` is not.
+    """
+
+    __slots__ = ()
+
+    __hash__ = None
+
+    _observed_mixin = _ObservedOrderedSet
+
+    _pending_mixin = _PendingSet
+
+    def __init__(self, iterable = ()):
+        self._contents = OrderedDict()
+        for element in iterable:
+            self._contents[element] = None
+        Restorable.__init__(self)
+
+    def __getstate__(self):
+        return list(self._contents)
+
+    def _deepcopy_state(self, memo):
+        if type(self)._requires_restoration:
+            return Restorable._deepcopy_state(self, memo)
+        return [ deepcopy(element, memo) for element in self._contents ]
+
+    def __setstate__(self, state):
+        Restorable.__setstate__(self, {
+            '_contents' : OrderedDict(),
+            '_restoration_data' : state,
+        })
+
+    def _restore(self, restoration_data):
+        contents = self._contents
+        for element in restoration_data:
+            contents[element] = None
+
+    def _delta(self, elements):
+        contents = self._contents
+        return ([ element for element in elements if element in contents ],
+            [ element for element in elements if element not in contents ])
+
+    def _apply_delta(self, changes):
+        contents = self._contents
+        added, removed = changes
+        for element in removed:
+            contents.pop(element, None)
+        for element in added:
+            contents[element] = None
+
+    def _from_iterable(self, iterable):
+        restorable = RestorableOrderedSet.__new__(_public_class(type(self)))
+        RestorableOrderedSet.__init__(restorable, iterable)
+        return restorable
+
+    def __contains__(self, x):
+        return x in self._contents
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def __reversed__(self):
+        return reversed(self._contents)
+
+    def __len__(self):
+        return len(self._contents)
+
+    def add(self, value):
+        self._contents[value] = None
+
+    def discard(self, value):
+        self._contents.pop(value, None)
+
+    def remove(self, value):
+        del self._contents[value]
+
+    def pop(self, last = True):
+        """
+        Removes and returns the last element, or the first if *last* is
+        `False`.
+
+        :raises KeyError: if the set is empty.
+        """
+        if not self._contents:
+            raise KeyError('pop from an empty set')
+        return self._contents.popitem(last)[0]
+
+    def move_to_end(self, value, last = True):
+        """
+        Moves an existing element to the end, or to the beginning if *last* is
+        `False`.
+
+        :raises KeyError: if the element is not present.
+        """
+        contents = self._contents
+        if hasattr(contents, 'move_to_end'):
+            contents.move_to_end(value, last)
+        elif last:
+            contents[value] = contents.pop(value)
+        else:
+            del contents[value]
+            elements = list(contents)
+            contents.clear()
+            contents[value] = None
+            for element in elements:
+                contents[element] = None
+
+    def clear(self):
+        self._contents.clear()
+
+    def isdisjoint(self, other):
+        contents = self._contents
+        return not any(element in contents for element in other)
+
+    def __le__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else \
+            _ordered_set_view(self) <= other
+
+    def __lt__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else \
+            _ordered_set_view(self) < other
+
+    def __ge__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else \
+            _ordered_set_view(self) >= other
+
+    def __gt__(self, other):
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else \
+            _ordered_set_view(self) > other
+
+    def __eq__(self, other):
+        if isinstance(other, RestorableOrderedSet):
+            return self._contents == other._contents
+        other = _set_operand(other, Set)
+        return NotImplemented if other is None else \
+            _ordered_set_view(self) == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __and__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        other = _set_operand(other, Iterable)
+        return self._from_iterable(element for element in self._contents
+            if element in other)
+
+    def __rand__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        contents = self._contents
+        return self._from_iterable(element for element in other
+            if element in contents)
+
+    def __or__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        result = self._from_iterable(self._contents)
+        result |= other
+        return result
+
+    def __ror__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        result = self._from_iterable(other)
+        result |= self
+        return result
+
+    def __sub__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        other = _set_operand(other, Iterable)
+        return self._from_iterable(element for element in self._contents
+            if element not in other)
+
+    def __rsub__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        contents = self._contents
+        return self._from_iterable(element for element in other
+            if element not in contents)
+
+    def __xor__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        result = self._from_iterable(self._contents)
+        result ^= other
+        return result
+
+    def __rxor__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        result = self._from_iterable(other)
+        result ^= self
+        return result
+
+    def __iand__(self, other):
+        other = _set_operand(other, Iterable)
+        contents = self._contents
+        for element in [ element for element in contents
+                if element not in other ]:
+            del contents[element]
+        return self
+
+    def __ior__(self, other):
+        contents = self._contents
+        for element in other:
+            contents[element] = None
+        return self
+
+    def __ixor__(self, other):
+        if other is self:
+            self.clear()
+            return self
+        contents = self._contents
+        for element in RestorableOrderedSet(other):
+            if element in contents:
+                del contents[element]
+            else:
+                contents[element] = None
+        return self
+
+    def __isub__(self, other):
+        if other is self:
+            self.clear()
+            return self
+        contents = self._contents
+        for element in other:
+            contents.pop(element, None)
+        return self
+
+    def __repr__(self):
+        return """RestorableOrderedSet{}""".format(repr(list(self._contents)))
+
+
+def _ordered_set_view(restorable):
+    """
+    :return: a :class:`set` view of the elements of a
+        :class:`RestorableOrderedSet`, for order-insensitive comparisons.
+    """
+    return _viewkeys(restorable._contents)
+
 
+MutableMapping.register(RestorableDict)
+MutableMapping.register(RestorableKeyedDict)
+MutableMapping.register(RestorableMappedDict)
+MutableMapping.register(RestorableShardedDict)
+Mapping.register(RestorableFrozenDict)
+MutableSet.register(RestorableSet)
+MutableSet.register(RestorableOrderedSet)
+Set.register(RestorableFrozenSet)
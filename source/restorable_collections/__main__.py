@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# This document is free and open-source software, subject to the OSI-approved
+# BSD license below.
+#
+# Copyright (c) 2014 Alexis Petrounias <www.petrounias.org>,
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# * Neither the name of the author nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Analyzes an object graph from the command line, reporting as JSON every
+built-in collection which does not survive pickling; see
+:func:`restorable_collections.find_cyclic_collections`. The object graph is
+either unpickled from a file, or imported from a module::
+
+    python -m restorable_collections graph.pickle
+    python -m restorable_collections package.module:graph
+"""
+
+__status__ = "Stable"
+__version__ = "1.0.0"
+__maintainer__ = (u"Alexis Petrounias <www.petrounias.org>", )
+__author__ = (u"Alexis Petrounias <www.petrounias.org>", )
+
+# Python
+import json, os, sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+from importlib import import_module
+
+# Python Restorable Collections
+from restorable_collections import RestorableUnpickler, find_cyclic_collections
+
+
+def load(source, call = False):
+    """
+    :param str source: the path of a file pickled with :mod:`pickle` or
+        :class:`RestorablePickler`, or the name of an object in the form
+        ``module:name``.
+    :param bool call: whether to call the named object, and analyze its result.
+    :return: the object graph to analyze.
+    """
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            return RestorableUnpickler(f).load()
+    module, _, name = source.partition(':')
+    obj = import_module(module)
+    for attribute in name.split('.') if name else ():
+        obj = getattr(obj, attribute)
+    return obj() if call else obj
+
+
+def main(argv = None):
+    """
+    Command line interface, see ``--help``.
+    """
+    parser = ArgumentParser(prog = 'python -m restorable_collections',
+        description = "Reports built-in collections whose keys refer back to "
+            "them, which require restorable wrapping, as JSON.")
+    parser.add_argument('source',
+        help = "pickle file, or object in the form module:name")
+    parser.add_argument('--call', action = 'store_true',
+        help = "call the named object, and analyze its result")
+    parser.add_argument('--output', default = None,
+        help = "file to write the JSON report to (default: standard output)")
+    arguments = parser.parse_args(argv)
+
+    report = [ OrderedDict((
+        ('path', found.path),
+        ('type', type(found.collection).__name__),
+        ('size', found.size),
+        ('keys', len(found.keys)),
+    )) for found in find_cyclic_collections(load(arguments.source,
+        arguments.call), arguments.source + ('()' if arguments.call else '')) ]
+
+    if arguments.output is None:
+        json.dump(report, sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+#
+# This document is free and open-source software, subject to the OSI-approved
+# BSD license below.
+#
+# Copyright (c) 2014 Alexis Petrounias <www.petrounias.org>,
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# * Neither the name of the author nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks for :mod:`restorable_collections`, built on the
+:mod:`restorable_collections_tests.helpers` classes.
+
+Measures the duration and peak memory of pickling and unpickling graphs
+featuring no cycles, self cycles, and mutual cycles, the duration of deep
+copying them, the latency of the first
+access to an unpickled collection (which triggers its restoration), and the
+steady-state cost of operations on every restorable wrapper compared with the
+Python collection it wraps. Results are reported as JSON, so that reports of
+different releases can be compared with one another.
+
+Run from the command line with::
+
+    python -m restorable_collections_benchmarks --output report.json
+
+Peak memory is measured with :mod:`tracemalloc` and is reported as `null` where
+it is not available.
+"""
+
+__status__ = "Stable"
+__version__ = "1.0.0"
+__maintainer__ = (u"Alexis Petrounias <www.petrounias.org>", )
+__author__ = (u"Alexis Petrounias <www.petrounias.org>", )
+
+# Python
+import atexit, gc, json, os, platform, shutil, sys
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict, defaultdict
+from copy import deepcopy
+from tempfile import mkdtemp
+from timeit import default_timer
+from weakref import WeakKeyDictionary, WeakValueDictionary
+
+# Python 2 and 3
+try:
+    import cPickle
+except ImportError:
+    import pickle as cPickle
+try:
+    _range = xrange
+except NameError:
+    _range = range
+
+# Optional
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Python Restorable Collections
+import restorable_collections
+from restorable_collections import RestorableDict, RestorableDefaultDict, \
+    RestorableOrderedDict, RestorableOrderedDefaultDict, RestorableCounter, \
+    RestorableSet, RestorableOrderedSet, RestorableFrozenSet, \
+    RestorableFrozenDict, RestorableWeakKeyDict, RestorableWeakValueDict, \
+    RestorableLRUDict, RestorableKeyedDict, RestorableMappedDict, \
+    RestorableShardedDict
+from restorable_collections_tests.helpers import Group, C
+
+
+def no_cycle_graph(size):
+    """
+    :return: a :class:`Group` whose first element points to *size* other
+        elements, none of which point to anything.
+    """
+    g = Group("no_cycle")
+    hub = C(-1)
+    g.elements.append(hub)
+    for v in _range(size):
+        c = C(v)
+        g.elements.append(c)
+        hub.add(c, v)
+    return g
+
+
+def self_cycle_graph(size):
+    """
+    :return: a :class:`Group` whose first element points to itself and to
+        *size* - 1 other elements, none of which point to anything.
+    """
+    g = Group("self_cycle")
+    hub = C(-1)
+    g.elements.append(hub)
+    hub.add(hub, -1)
+    for v in _range(size - 1):
+        c = C(v)
+        g.elements.append(c)
+        hub.add(c, v)
+    return g
+
+
+def mutual_cycle_graph(size):
+    """
+    :return: a :class:`Group` whose first element points to *size* other
+        elements, all of which point back to it.
+    """
+    g = Group("mutual_cycle")
+    hub = C(-1)
+    g.elements.append(hub)
+    for v in _range(size):
+        c = C(v)
+        g.elements.append(c)
+        hub.add(c, v)
+        c.add(hub, v)
+    return g
+
+GRAPHS = OrderedDict((
+    ('no_cycle', no_cycle_graph),
+    ('self_cycle', self_cycle_graph),
+    ('mutual_cycle', mutual_cycle_graph),
+))
+
+class Key(object):
+    """
+    An integer key which can be weakly referenced, for weak dictionaries.
+    """
+
+    __slots__ = ('v', '__weakref__', )
+
+    def __init__(self, v):
+        self.v = v
+
+    def __hash__(self):
+        return hash(self.v)
+
+    def __eq__(self, other):
+        return self.v == other.v
+
+
+class KeyRestorer(object):
+    """
+    Restorer of :class:`RestorableKeyedDict` objects whose keys are their own
+    identifiers.
+    """
+
+    def restoration_key(self, d, key, value, identifier = None):
+        return key
+
+    def restoration_map(self, d, identifier = None):
+        return dict((key, key) for key in d)
+
+
+def mapped_dict(items):
+    """
+    :return: a :class:`RestorableMappedDict` holding *items*, whose file is
+        created in a new temporary directory, removed when the interpreter
+        exits.
+    """
+    directory = mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    return RestorableMappedDict(os.path.join(directory, 'mapped'), 64, None,
+        None, items)
+
+#: Restorable wrappers and the Python collections they wrap, as pairs of
+#: factories of collections holding the given items (or elements), along with
+#: the kind of operations they support and the factory of their keys.
+COLLECTIONS = OrderedDict((
+    ('RestorableDict', (RestorableDict, dict, 'mapping', int)),
+    ('RestorableDefaultDict', (lambda items: RestorableDefaultDict(int, items),
+        lambda items: defaultdict(int, items), 'mapping', int)),
+    ('RestorableOrderedDict', (RestorableOrderedDict, OrderedDict,
+        'mapping', int)),
+    ('RestorableOrderedDefaultDict', (
+        lambda items: RestorableOrderedDefaultDict(int, items),
+        lambda items: defaultdict(int, items), 'mapping', int)),
+    ('RestorableCounter', (lambda items: RestorableCounter(dict(items)),
+        lambda items: Counter(dict(items)), 'mapping', int)),
+    ('RestorableFrozenDict', (RestorableFrozenDict, dict, 'frozen_mapping',
+        int)),
+    ('RestorableWeakKeyDict', (RestorableWeakKeyDict, WeakKeyDictionary,
+        'mapping', Key)),
+    ('RestorableWeakValueDict', (RestorableWeakValueDict,
+        WeakValueDictionary, 'mapping', Key)),
+    ('RestorableLRUDict', (lambda items: RestorableLRUDict(len(items), None,
+        items), OrderedDict, 'mapping', int)),
+    ('RestorableKeyedDict', (lambda items: RestorableKeyedDict(KeyRestorer(),
+        None, items), dict, 'mapping', int)),
+    ('RestorableMappedDict', (mapped_dict, dict, 'mapping', int)),
+    ('RestorableShardedDict', (lambda items: RestorableShardedDict(16, None,
+        items), dict, 'mapping', int)),
+    ('RestorableSet', (RestorableSet, set, 'set', int)),
+    ('RestorableOrderedSet', (RestorableOrderedSet, set, 'set', int)),
+    ('RestorableFrozenSet', (RestorableFrozenSet, frozenset, 'frozen_set',
+        int)),
+))
+
+
+def timed(fn, repeat = 1):
+    """
+    Invokes *fn* *repeat* times.
+
+    :return: the result of the last invocation and the shortest duration of
+        any invocation, in seconds.
+    """
+    best = None
+    for _ in _range(repeat):
+        gc.collect()
+        started = default_timer()
+        result = fn()
+        duration = default_timer() - started
+        if best is None or duration < best:
+            best = duration
+    return result, best
+
+
+def peak_memory(fn):
+    """
+    Invokes *fn* once while tracing memory allocations.
+
+    :return: the peak memory allocated during the invocation, in bytes, or
+        `None` if :mod:`tracemalloc` is not available.
+    """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def graph_benchmarks(sizes, protocols, repeat = 3, memory = True):
+    """
+    Benchmarks deep copying, and pickling, unpickling, and first access to the
+    collections of the graphs of :data:`GRAPHS` of the given *sizes*, for each
+    of the given pickle *protocols*.
+
+    :return: an iterator over result records.
+    """
+    for name, make_graph in GRAPHS.items():
+        for size in sizes:
+            g = make_graph(size)
+            _, duration = timed(lambda: deepcopy(g), repeat)
+            yield OrderedDict((('benchmark', 'deepcopy'), ('graph', name),
+                ('size', size), ('seconds', duration), ))
+            for protocol in protocols:
+                record = [ ('graph', name), ('size', size),
+                    ('protocol', protocol), ]
+
+                dumps = lambda: cPickle.dumps(g, protocol)
+                data, duration = timed(dumps, repeat)
+                yield OrderedDict([ ('benchmark', 'dumps'), ] + record + [
+                    ('seconds', duration), ('bytes', len(data)),
+                    ('peak_memory', peak_memory(dumps) if memory else None), ])
+
+                loads = lambda: cPickle.loads(data)
+                gu, duration = timed(loads, repeat)
+                yield OrderedDict([ ('benchmark', 'loads'), ] + record + [
+                    ('seconds', duration),
+                    ('peak_memory', peak_memory(loads) if memory else None), ])
+
+                hub = gu.elements[0]
+                for attribute in ('restorable_plain', 'restorable_ordered',
+                        'restorable_default', 'restorable_ordered_default', ):
+                    restorable = getattr(hub, attribute)
+                    key = next(iter(restorable._restoration_data))[0]
+                    started = default_timer()
+                    restorable[key]
+                    duration = default_timer() - started
+                    yield OrderedDict([ ('benchmark', 'first_access'), ] +
+                        record + [ ('collection', type(restorable).__name__),
+                            ('seconds', duration), ])
+                del gu
+
+
+def steady_state_benchmarks(sizes, operations = 100000,
+        protocol = cPickle.HIGHEST_PROTOCOL):
+    """
+    Benchmarks the steady-state cost per operation of every wrapper of
+    :data:`COLLECTIONS` holding integer keys (wrapped by :class:`Key` for weak
+    dictionaries), once unpickled and restored, compared with the Python
+    collection it wraps. Each operation is performed at least *operations*
+    times.
+
+    :return: an iterator over result records.
+    """
+    for name, (restorable_factory, builtin_factory, kind, make_key) in \
+            COLLECTIONS.items():
+        for size in sizes:
+            keys = [ make_key(v) for v in _range(size) ]
+            loops = max(1, operations // size)
+            if kind.endswith('mapping'):
+                contents = [ (key, key) for key in keys ]
+            else:
+                contents = keys
+            builtin = builtin_factory(contents)
+            # unpickled along with its keys, which weak dictionaries require
+            # to be referenced for as long as they are benchmarked
+            unpickled_keys, restorable = cPickle.loads(cPickle.dumps(
+                (keys, restorable_factory(contents)), protocol))
+            keys[0] in restorable
+
+            performed = float(size * loops)
+            for operation, perform in _operations(kind, keys, loops):
+                _, duration = timed(lambda: perform(restorable), 3)
+                _, builtin_duration = timed(lambda: perform(builtin), 3)
+                yield OrderedDict((('benchmark', 'steady_state'),
+                    ('collection', name), ('operation', operation),
+                    ('size', size),
+                    ('nanoseconds', duration / performed * 1e9),
+                    ('builtin_nanoseconds',
+                        builtin_duration / performed * 1e9),
+                    ('ratio', duration / builtin_duration
+                        if builtin_duration else None)))
+
+
+def _operations(kind, keys, loops):
+    """
+    :return: pairs of operation names and functions performing the operation
+        *loops* times for each of *keys* on a given collection.
+    """
+    def get(collection):
+        for _ in _range(loops):
+            for key in keys:
+                collection[key]
+
+    def contains(collection):
+        for _ in _range(loops):
+            for key in keys:
+                key in collection
+
+    def set_item(collection):
+        for _ in _range(loops):
+            for key in keys:
+                collection[key] = key
+
+    def add(collection):
+        for _ in _range(loops):
+            for key in keys:
+                collection.add(key)
+
+    def iterate(collection):
+        for _ in _range(loops):
+            for key in collection:
+                pass
+
+    if kind == 'mapping':
+        return (('get', get), ('contains', contains), ('set', set_item),
+            ('iterate', iterate), )
+    if kind == 'frozen_mapping':
+        return (('get', get), ('contains', contains), ('iterate', iterate), )
+    if kind == 'set':
+        return (('contains', contains), ('set', add), ('iterate', iterate), )
+    return (('contains', contains), ('iterate', iterate), )
+
+
+def run(sizes = (10, 1000, 100000), protocols = None, repeat = 3,
+        memory = True, operations = 100000):
+    """
+    Runs all benchmarks.
+
+    :param sizes: the numbers of entries of benchmarked graphs and collections.
+    :param protocols: the pickle protocols to benchmark; all protocols by
+        default.
+    :param int repeat: the number of times each pickling and unpickling is
+        repeated, of which the shortest duration is reported.
+    :param bool memory: whether to measure peak memory.
+    :param int operations: the minimum number of times each steady-state
+        operation is performed.
+    :return: the report, as a JSON-serializable :class:`dict`.
+    """
+    if protocols is None:
+        protocols = range(cPickle.HIGHEST_PROTOCOL + 1)
+    results = list(graph_benchmarks(sizes, protocols, repeat, memory))
+    results.extend(steady_state_benchmarks(sizes, operations))
+    return OrderedDict((
+        ('restorable_collections', restorable_collections.__version__),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('results', results),
+    ))
+
+#: The fields which identify a result record across reports.
+IDENTIFYING_FIELDS = ('benchmark', 'graph', 'collection', 'operation', 'size',
+    'protocol', )
+
+#: The fields of a result record which are measurements.
+MEASUREMENT_FIELDS = ('seconds', 'nanoseconds', 'bytes', 'peak_memory', )
+
+
+def compare(previous, current):
+    """
+    Compares the results of two reports, as produced by :func:`run`.
+
+    :return: an iterator over the identifying fields of every result record
+        present in both reports, along with the ratios of the current to the
+        previous measurements.
+    """
+    identify = lambda record: tuple(record.get(field)
+        for field in IDENTIFYING_FIELDS)
+    previous_results = dict((identify(record), record)
+        for record in previous['results'])
+    for record in current['results']:
+        previous_record = previous_results.get(identify(record))
+        if previous_record is None:
+            continue
+        ratios = OrderedDict()
+        for field in MEASUREMENT_FIELDS:
+            if record.get(field) is not None and previous_record.get(field):
+                ratios[field] = record[field] / float(previous_record[field])
+        yield OrderedDict((field, record[field])
+            for field in IDENTIFYING_FIELDS if field in record), ratios
+
+
+def main(argv = None):
+    """
+    Command line interface, see ``--help``.
+    """
+    parser = ArgumentParser(prog = 'python -m restorable_collections_benchmarks',
+        description = "Benchmarks restorable collections and reports as JSON.")
+    parser.add_argument('--sizes', default = '10,1000,100000',
+        help = "comma-separated numbers of entries (default: %(default)s)")
+    parser.add_argument('--protocols', default = None,
+        help = "comma-separated pickle protocols (default: all)")
+    parser.add_argument('--repeat', type = int, default = 3,
+        help = "repetitions of each measurement (default: %(default)s)")
+    parser.add_argument('--operations', type = int, default = 100000,
+        help = "minimum steady-state operations (default: %(default)s)")
+    parser.add_argument('--no-memory', action = 'store_true',
+        help = "skip peak memory measurements")
+    parser.add_argument('--output', default = None,
+        help = "file to write the JSON report to (default: standard output)")
+    parser.add_argument('--compare', default = None,
+        help = "JSON report of a previous run to compare against")
+    arguments = parser.parse_args(argv)
+
+    report = run(
+        sizes = [ int(size) for size in arguments.sizes.split(',') ],
+        protocols = [ int(protocol) for protocol in
+            arguments.protocols.split(',') ] if arguments.protocols else None,
+        repeat = arguments.repeat,
+        memory = not arguments.no_memory,
+        operations = arguments.operations)
+
+    if arguments.output is None:
+        json.dump(report, sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            previous = json.load(f)
+        for identity, ratios in compare(previous, report):
+            sys.stderr.write("{} {}\n".format(
+                ' '.join('{}={}'.format(field, value)
+                    for field, value in identity.items()),
+                ' '.join('{}={:.3f}'.format(field, ratio)
+                    for field, ratio in ratios.items())))
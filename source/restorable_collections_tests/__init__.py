@@ -41,11 +41,59 @@ __maintainer__ = (u"Alexis Petrounias <www.petrounias.org>", )
 __author__ = (u"Alexis Petrounias <www.petrounias.org>", )
 
 # Python
-import pickle, cPickle
-from unittest import TestCase
+import copy, gc, json, os, pickle, shutil, sys
+from collections import Counter, OrderedDict, defaultdict
+from functools import partial
+from io import BytesIO
+from tempfile import mkdtemp
+from threading import Event, Thread
+from unittest import TestCase, skipIf
+
+# Python 2 and 3
+try:
+    import cPickle
+except ImportError:
+    import pickle as cPickle
+try:
+    from collections.abc import Hashable, ItemsView, KeysView, Mapping, \
+        MutableMapping, MutableSet, Set, ValuesView
+except ImportError:
+    from collections import Hashable, ItemsView, KeysView, Mapping, \
+        MutableMapping, MutableSet, Set, ValuesView
+try:
+    getswitchinterval, setswitchinterval = \
+        sys.getswitchinterval, sys.setswitchinterval
+    SHORTEST_SWITCH_INTERVAL = 1e-6
+except AttributeError:
+    getswitchinterval, setswitchinterval = \
+        sys.getcheckinterval, sys.setcheckinterval
+    SHORTEST_SWITCH_INTERVAL = 1
+
+
+def plain_keys(mapping):
+    """
+    :return: the keys of a plain *mapping* in order, without looking them up,
+        which iterating over ordered dictionaries does in Python 3.
+    """
+    if sys.version_info[0] < 3:
+        return list(mapping)
+    return list(dict.__iter__(mapping))
 
 # Python Restorable Collections
-from helpers import Group, C, D
+from restorable_collections import RestorableDict, RestorableOrderedDict, \
+    RestorableDefaultDict, RestorableOrderedDefaultDict, RestorableCounter, \
+    RestorableFrozenDict, RestorableSet, RestorableOrderedSet, \
+    RestorableFrozenSet, RestorableWeakKeyDict, RestorableWeakValueDict, \
+    RestorableLRUDict, RestorableKeyedDict, RestorationDelta, apply_deltas, \
+    RestorationSnapshot, RestorableMappedDict, restoring, \
+    restoring_load, restoring_loads, Restoration, ThreadPoolExecutor, \
+    enable_instrumentation, disable_instrumentation, restoration_statistics, \
+    PickleBuffer, OUT_OF_BAND_THRESHOLD, RestorablePickler, \
+    RestorableUnpickler, find_cyclic_collections, RestorableShardedDict, \
+    dump_sharded, load_sharded
+from restorable_collections.__main__ import main as analyze
+from restorable_collections_tests.helpers import Group, C, D, c_factory, \
+    c_partition, cyclic_group, TaggedDict
 
 
 class RestorableCollectionsTestCase(TestCase):
@@ -79,6 +127,8 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertTrue(c2 in c1.restorable_plain)
         self.assertTrue(c2 in c1.restorable_ordered)
         self.assertTrue(c2 in c1.restorable_default)
+        self.assertTrue(c2 in c1.restorable_ordered_default)
+        self.assertTrue(c2 in c1.restorable_keyed)
 
         gu = self.pickle_and_unpickle(g)
 
@@ -87,12 +137,14 @@ class RestorableCollectionsTestCase(TestCase):
 
         # check existence of keys directly
 
-        self.assertTrue(c2u in c1u.plain.keys())
-        self.assertTrue(c2u in c1u.plain_ordered.keys())
-        self.assertTrue(c2u in c1u.plain_default.keys())
-        self.assertTrue(c2u in c1u.restorable_plain.keys())
-        self.assertTrue(c2u in c1u.restorable_ordered.keys())
-        self.assertTrue(c2u in c1u.restorable_default.keys())
+        self.assertTrue(c2u in list(c1u.plain.keys()))
+        self.assertTrue(c2u in plain_keys(c1u.plain_ordered))
+        self.assertTrue(c2u in list(c1u.plain_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_plain.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_ordered.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_ordered_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_keyed.keys()))
 
         # check direct key-based lookup
 
@@ -102,18 +154,25 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertEqual(c2u, c1u.restorable_plain[c2u][0])
         self.assertEqual(c2u, c1u.restorable_ordered[c2u][0])
         self.assertEqual(c2u, c1u.restorable_default[c2u][0])
+        self.assertEqual(c2u, c1u.restorable_ordered_default[c2u][0])
+        self.assertEqual(c2u, c1u.restorable_keyed[c2u][0])
 
         # check key lookup with key directly from keys()
 
-        self.assertEqual(c2u, c1u.plain[c1u.plain.keys()[0]][0])
-        self.assertEqual(c2u, c1u.plain_ordered[c1u.plain_ordered.keys()[0]][0])
-        self.assertEqual(c2u, c1u.plain_default[c1u.plain_default.keys()[0]][0])
+        self.assertEqual(c2u, c1u.plain[list(c1u.plain)[0]][0])
+        self.assertEqual(c2u, c1u.plain_ordered[plain_keys(c1u.plain_ordered)[0]][0])
+        self.assertEqual(c2u, c1u.plain_default[list(c1u.plain_default)[0]][0])
+        self.assertEqual(c2u,
+            c1u.restorable_plain[list(c1u.restorable_plain)[0]][0])
         self.assertEqual(c2u,
-            c1u.restorable_plain[c1u.restorable_plain.keys()[0]][0])
+            c1u.restorable_ordered[list(c1u.restorable_ordered)[0]][0])
         self.assertEqual(c2u,
-            c1u.restorable_ordered[c1u.restorable_ordered.keys()[0]][0])
+            c1u.restorable_default[list(c1u.restorable_default)[0]][0])
         self.assertEqual(c2u,
-            c1u.restorable_default[c1u.restorable_default.keys()[0]][0])
+            c1u.restorable_ordered_default[
+                list(c1u.restorable_ordered_default)[0]][0])
+        self.assertEqual(c2u,
+            c1u.restorable_keyed[list(c1u.restorable_keyed)[0]][0])
 
 
     def test_dict_self_cycle(self):
@@ -133,6 +192,8 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertTrue(c1 in c1.restorable_plain)
         self.assertTrue(c1 in c1.restorable_ordered)
         self.assertTrue(c1 in c1.restorable_default)
+        self.assertTrue(c1 in c1.restorable_ordered_default)
+        self.assertTrue(c1 in c1.restorable_keyed)
 
         gu = self.pickle_and_unpickle(g)
 
@@ -143,21 +204,25 @@ class RestorableCollectionsTestCase(TestCase):
 
         # key c1u
 
-        self.assertTrue(c1u in c1u.plain.keys())
-        self.assertTrue(c1u in c1u.plain_ordered.keys())
-        self.assertTrue(c1u in c1u.plain_default.keys())
-        self.assertTrue(c1u in c1u.restorable_plain.keys())
-        self.assertTrue(c1u in c1u.restorable_ordered.keys())
-        self.assertTrue(c1u in c1u.restorable_default.keys())
+        self.assertTrue(c1u in list(c1u.plain.keys()))
+        self.assertTrue(c1u in plain_keys(c1u.plain_ordered))
+        self.assertTrue(c1u in list(c1u.plain_default.keys()))
+        self.assertTrue(c1u in list(c1u.restorable_plain.keys()))
+        self.assertTrue(c1u in list(c1u.restorable_ordered.keys()))
+        self.assertTrue(c1u in list(c1u.restorable_default.keys()))
+        self.assertTrue(c1u in list(c1u.restorable_ordered_default.keys()))
+        self.assertTrue(c1u in list(c1u.restorable_keyed.keys()))
 
         # key c2u
 
-        self.assertTrue(c2u in c1u.plain.keys())
-        self.assertTrue(c2u in c1u.plain_ordered.keys())
-        self.assertTrue(c2u in c1u.plain_default.keys())
-        self.assertTrue(c2u in c1u.restorable_plain.keys())
-        self.assertTrue(c2u in c1u.restorable_ordered.keys())
-        self.assertTrue(c2u in c1u.restorable_default.keys())
+        self.assertTrue(c2u in list(c1u.plain.keys()))
+        self.assertTrue(c2u in plain_keys(c1u.plain_ordered))
+        self.assertTrue(c2u in list(c1u.plain_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_plain.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_ordered.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_ordered_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_keyed.keys()))
 
         # check direct key-based lookup
 
@@ -177,6 +242,8 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertEqual(c1u, c1u.restorable_plain[c1u][0])
         self.assertEqual(c1u, c1u.restorable_ordered[c1u][0])
         self.assertEqual(c1u, c1u.restorable_default[c1u][0])
+        self.assertEqual(c1u, c1u.restorable_ordered_default[c1u][0])
+        self.assertEqual(c1u, c1u.restorable_keyed[c1u][0])
 
         # key c2u
 
@@ -192,46 +259,60 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertEqual(c2u, c1u.restorable_plain[c2u][0])
         self.assertEqual(c2u, c1u.restorable_ordered[c2u][0])
         self.assertEqual(c2u, c1u.restorable_default[c2u][0])
+        self.assertEqual(c2u, c1u.restorable_ordered_default[c2u][0])
+        self.assertEqual(c2u, c1u.restorable_keyed[c2u][0])
 
         # check key lookup with key directly from keys()
 
         # key c1u
 
         # fails because c1u hash changed during unpickling
-        self.assertRaises(KeyError, lambda: c1u.plain[c1u.plain.keys()[0]][0])
+        self.assertRaises(KeyError, lambda: c1u.plain[list(c1u.plain)[0]][0])
 
         # fails because c1u hash changed during unpickling
         self.assertRaises(KeyError,
-            lambda: c1u.plain_ordered[c1u.plain_ordered.keys()[0]][0])
+            lambda: c1u.plain_ordered[plain_keys(c1u.plain_ordered)[0]][0])
 
         # succeeds because it is the previously-created duplicate key!
         self.assertEqual(0,
-            c1u.plain_default[c1u.plain_default.keys()[0]][0].v)
+            c1u.plain_default[list(c1u.plain_default)[0]][0].v)
 
         self.assertEqual(c1u,
-            c1u.restorable_plain[c1u.restorable_plain.keys()[0]][0])
+            c1u.restorable_plain[list(c1u.restorable_plain)[0]][0])
+        self.assertEqual(c1u,
+            c1u.restorable_ordered[list(c1u.restorable_ordered)[0]][0])
+        self.assertEqual(c1u,
+            c1u.restorable_default[list(c1u.restorable_default)[0]][0])
         self.assertEqual(c1u,
-            c1u.restorable_ordered[c1u.restorable_ordered.keys()[0]][0])
+            c1u.restorable_ordered_default[
+                list(c1u.restorable_ordered_default)[0]][0])
         self.assertEqual(c1u,
-            c1u.restorable_default[c1u.restorable_default.keys()[0]][0])
+            c1u.restorable_keyed[list(c1u.restorable_keyed)[0]][0])
 
         # key c2u
 
         # succeeds because c2u does not have a cycle to itself
-        self.assertEqual(c2u, c1u.plain[c1u.plain.keys()[1]][0])
+        self.assertEqual(c2u, c1u.plain[list(c1u.plain)[1]][0])
 
         # succeeds because c2u does not have a cycle to itself
-        self.assertEqual(c2u, c1u.plain_ordered[c1u.plain_ordered.keys()[1]][0])
+        self.assertEqual(c2u,
+            c1u.plain_ordered[plain_keys(c1u.plain_ordered)[1]][0])
 
         # succeeds but is the previously-created duplicate key, not c2u!
-        self.assertEqual(0, c1u.plain_default[c1u.plain_default.keys()[1]][0].v)
+        self.assertEqual(2, list(c1u.plain_default).count(c1u))
+        self.assertEqual(0, c1u.plain_default[c1u][0].v)
 
         self.assertEqual(c2u,
-            c1u.restorable_plain[c1u.restorable_plain.keys()[1]][0])
+            c1u.restorable_plain[list(c1u.restorable_plain)[1]][0])
+        self.assertEqual(c2u,
+            c1u.restorable_ordered[list(c1u.restorable_ordered)[1]][0])
         self.assertEqual(c2u,
-            c1u.restorable_ordered[c1u.restorable_ordered.keys()[1]][0])
+            c1u.restorable_default[list(c1u.restorable_default)[1]][0])
         self.assertEqual(c2u,
-            c1u.restorable_default[c1u.restorable_default.keys()[1]][0])
+            c1u.restorable_ordered_default[
+                list(c1u.restorable_ordered_default)[1]][0])
+        self.assertEqual(c2u,
+            c1u.restorable_keyed[list(c1u.restorable_keyed)[1]][0])
 
     def test_dict_mutual_cycle(self):
 
@@ -250,6 +331,8 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertTrue(c2 in c1.restorable_plain)
         self.assertTrue(c2 in c1.restorable_ordered)
         self.assertTrue(c2 in c1.restorable_default)
+        self.assertTrue(c2 in c1.restorable_ordered_default)
+        self.assertTrue(c2 in c1.restorable_keyed)
 
         self.assertTrue(c1 in c2.plain)
         self.assertTrue(c1 in c2.plain_ordered)
@@ -257,6 +340,8 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertTrue(c1 in c2.restorable_plain)
         self.assertTrue(c1 in c2.restorable_ordered)
         self.assertTrue(c1 in c2.restorable_default)
+        self.assertTrue(c1 in c2.restorable_ordered_default)
+        self.assertTrue(c1 in c2.restorable_keyed)
 
         gu = self.pickle_and_unpickle(g)
 
@@ -267,21 +352,25 @@ class RestorableCollectionsTestCase(TestCase):
 
         # key c2u
 
-        self.assertTrue(c2u in c1u.plain.keys())
-        self.assertTrue(c2u in c1u.plain_ordered.keys())
-        self.assertTrue(c2u in c1u.plain_default.keys())
-        self.assertTrue(c2u in c1u.restorable_plain.keys())
-        self.assertTrue(c2u in c1u.restorable_ordered.keys())
-        self.assertTrue(c2u in c1u.restorable_default.keys())
+        self.assertTrue(c2u in list(c1u.plain.keys()))
+        self.assertTrue(c2u in plain_keys(c1u.plain_ordered))
+        self.assertTrue(c2u in list(c1u.plain_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_plain.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_ordered.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_ordered_default.keys()))
+        self.assertTrue(c2u in list(c1u.restorable_keyed.keys()))
 
         # key c1u
 
-        self.assertTrue(c1u in c2u.plain.keys())
-        self.assertTrue(c1u in c2u.plain_ordered.keys())
-        self.assertTrue(c1u in c2u.plain_default.keys())
-        self.assertTrue(c1u in c2u.restorable_plain.keys())
-        self.assertTrue(c1u in c2u.restorable_ordered.keys())
-        self.assertTrue(c1u in c2u.restorable_default.keys())
+        self.assertTrue(c1u in list(c2u.plain.keys()))
+        self.assertTrue(c1u in plain_keys(c2u.plain_ordered))
+        self.assertTrue(c1u in list(c2u.plain_default.keys()))
+        self.assertTrue(c1u in list(c2u.restorable_plain.keys()))
+        self.assertTrue(c1u in list(c2u.restorable_ordered.keys()))
+        self.assertTrue(c1u in list(c2u.restorable_default.keys()))
+        self.assertTrue(c1u in list(c2u.restorable_ordered_default.keys()))
+        self.assertTrue(c1u in list(c2u.restorable_keyed.keys()))
 
         # check direct key-based lookup
 
@@ -293,6 +382,8 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertEqual(c2u, c1u.restorable_plain[c2u][0])
         self.assertEqual(c2u, c1u.restorable_ordered[c2u][0])
         self.assertEqual(c2u, c1u.restorable_default[c2u][0])
+        self.assertEqual(c2u, c1u.restorable_ordered_default[c2u][0])
+        self.assertEqual(c2u, c1u.restorable_keyed[c2u][0])
 
         # key c1u
 
@@ -311,40 +402,52 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertEqual(c1u, c2u.restorable_plain[c1u][0])
         self.assertEqual(c1u, c2u.restorable_ordered[c1u][0])
         self.assertEqual(c1u, c2u.restorable_default[c1u][0])
+        self.assertEqual(c1u, c2u.restorable_ordered_default[c1u][0])
+        self.assertEqual(c1u, c2u.restorable_keyed[c1u][0])
 
         # check key lookup with key directly from keys()
 
         # key c2u, succeed because c2u added to c1u after __setstate__
 
-        self.assertEqual(c2u, c1u.plain[c1u.plain.keys()[0]][0])
-        self.assertEqual(c2u, c1u.plain_ordered[c1u.plain_ordered.keys()[0]][0])
-        self.assertEqual(c2u, c1u.plain_default[c1u.plain_default.keys()[0]][0])
+        self.assertEqual(c2u, c1u.plain[list(c1u.plain)[0]][0])
+        self.assertEqual(c2u, c1u.plain_ordered[plain_keys(c1u.plain_ordered)[0]][0])
+        self.assertEqual(c2u, c1u.plain_default[list(c1u.plain_default)[0]][0])
+        self.assertEqual(c2u,
+            c1u.restorable_plain[list(c1u.restorable_plain)[0]][0])
+        self.assertEqual(c2u,
+            c1u.restorable_ordered[list(c1u.restorable_ordered)[0]][0])
         self.assertEqual(c2u,
-            c1u.restorable_plain[c1u.restorable_plain.keys()[0]][0])
+            c1u.restorable_default[list(c1u.restorable_default)[0]][0])
         self.assertEqual(c2u,
-            c1u.restorable_ordered[c1u.restorable_ordered.keys()[0]][0])
+            c1u.restorable_ordered_default[
+                list(c1u.restorable_ordered_default)[0]][0])
         self.assertEqual(c2u,
-            c1u.restorable_default[c1u.restorable_default.keys()[0]][0])
+            c1u.restorable_keyed[list(c1u.restorable_keyed)[0]][0])
 
         # key c1u
 
         # fails because c1u hash changed during unpickling
-        self.assertRaises(KeyError, lambda: c2u.plain[c2u.plain.keys()[0]][0])
+        self.assertRaises(KeyError, lambda: c2u.plain[list(c2u.plain)[0]][0])
 
         # fails because c1u hash changed during unpickling
         self.assertRaises(KeyError,
-            lambda: c2u.plain_ordered[c2u.plain_ordered.keys()[0]][0])
+            lambda: c2u.plain_ordered[plain_keys(c2u.plain_ordered)[0]][0])
 
         # succeeds but is the previously-created duplicate key, not c2u!
-        self.assertEqual(0, c2u.plain_default[c2u.plain_default.keys()[0]][0].v)
+        self.assertEqual(0, c2u.plain_default[list(c2u.plain_default)[0]][0].v)
 
         self.assertEqual(c1u,
-            c2u.restorable_plain[c2u.restorable_plain.keys()[0]][0])
+            c2u.restorable_plain[list(c2u.restorable_plain)[0]][0])
         self.assertEqual(c1u,
-            c2u.restorable_ordered[c2u.restorable_ordered.keys()[0]][0])
+            c2u.restorable_ordered[list(c2u.restorable_ordered)[0]][0])
 
         self.assertEqual(c1u,
-            c2u.restorable_default[c2u.restorable_default.keys()[0]][0])
+            c2u.restorable_default[list(c2u.restorable_default)[0]][0])
+        self.assertEqual(c1u,
+            c2u.restorable_ordered_default[
+                list(c2u.restorable_ordered_default)[0]][0])
+        self.assertEqual(c1u,
+            c2u.restorable_keyed[list(c2u.restorable_keyed)[0]][0])
 
 
     def test_set_no_cycle(self):
@@ -359,6 +462,7 @@ class RestorableCollectionsTestCase(TestCase):
 
         self.assertTrue(d2 in d1.plain)
         self.assertTrue(d2 in d1.restorable_plain)
+        self.assertTrue(d2 in d1.restorable_ordered)
 
         gu = self.pickle_and_unpickle(g)
 
@@ -369,11 +473,14 @@ class RestorableCollectionsTestCase(TestCase):
 
         self.assertTrue(d2u in d1u.plain)
         self.assertTrue(d2u in d1u.restorable_plain)
+        self.assertTrue(d2u in d1u.restorable_ordered)
 
         # check element taken from elements
 
         self.assertTrue(list(d1u.plain)[0] in d1u.plain)
         self.assertTrue(list(d1u.restorable_plain)[0] in d1u.restorable_plain)
+        self.assertTrue(
+            list(d1u.restorable_ordered)[0] in d1u.restorable_ordered)
 
 
     def test_set_self_cycle(self):
@@ -389,6 +496,7 @@ class RestorableCollectionsTestCase(TestCase):
 
         self.assertTrue(d1 in d1.plain)
         self.assertTrue(d1 in d1.restorable_plain)
+        self.assertTrue(d1 in d1.restorable_ordered)
 
         gu = self.pickle_and_unpickle(g)
 
@@ -401,6 +509,7 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertFalse(d1u in d1u.plain)
 
         self.assertTrue(d1u in d1u.restorable_plain)
+        self.assertTrue(d1u in d1u.restorable_ordered)
 
         # check element taken from elements
 
@@ -411,7 +520,12 @@ class RestorableCollectionsTestCase(TestCase):
 
         self.assertTrue(list(d1u.plain)[1] in d1u.plain)
         self.assertTrue(list(d1u.restorable_plain)[0] in d1u.restorable_plain)
+        self.assertTrue(
+            list(d1u.restorable_ordered)[0] in d1u.restorable_ordered)
         self.assertTrue(list(d1u.restorable_plain)[1] in d1u.restorable_plain)
+        self.assertTrue(
+            list(d1u.restorable_ordered)[1] in d1u.restorable_ordered)
+        self.assertEqual([d1u, d2u], list(d1u.restorable_ordered))
 
 
     def test_set_mutual_cycle(self):
@@ -427,8 +541,10 @@ class RestorableCollectionsTestCase(TestCase):
 
         self.assertTrue(d2 in d1.plain)
         self.assertTrue(d2 in d1.restorable_plain)
+        self.assertTrue(d2 in d1.restorable_ordered)
         self.assertTrue(d1 in d2.plain)
         self.assertTrue(d1 in d2.restorable_plain)
+        self.assertTrue(d1 in d2.restorable_ordered)
 
         gu = self.pickle_and_unpickle(g)
 
@@ -441,11 +557,13 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertTrue(d2u in d1u.plain)
 
         self.assertTrue(d2u in d1u.restorable_plain)
+        self.assertTrue(d2u in d1u.restorable_ordered)
 
         # fails because d1u hash changed during unpickling
         self.assertFalse(d1u in d2u.plain)
 
         self.assertTrue(d1u in d2u.restorable_plain)
+        self.assertTrue(d1u in d2u.restorable_ordered)
 
         # check element taken from elements
 
@@ -453,11 +571,15 @@ class RestorableCollectionsTestCase(TestCase):
         self.assertTrue(list(d1u.plain)[0] in d1u.plain)
 
         self.assertTrue(list(d1u.restorable_plain)[0] in d1u.restorable_plain)
+        self.assertTrue(
+            list(d1u.restorable_ordered)[0] in d1u.restorable_ordered)
 
         # fails because d1u hash changed during unpickling
         self.assertFalse(list(d2u.plain)[0] in d2u.plain)
 
         self.assertTrue(list(d2u.restorable_plain)[0] in d2u.restorable_plain)
+        self.assertTrue(
+            list(d2u.restorable_ordered)[0] in d2u.restorable_ordered)
 
 
 class CPickleRestorableCollectionsTestCase(RestorableCollectionsTestCase):
@@ -469,3 +591,2216 @@ class CPickleRestorableCollectionsTestCase(RestorableCollectionsTestCase):
     def setUp(self):
         self.pickle = cPickle
 
+
+
+class RestorationLifeCycleTestCase(TestCase):
+    """
+    Tests the life-cycle of :class:`Restorable` objects: unpickled objects are
+    pending restoration until first access of their wrapped contents, after
+    which they no longer intercept attribute access.
+    """
+
+    def test_never_pickled(self):
+
+        c1 = C(42)
+
+        self.assertFalse(c1.restorable_plain._requires_restoration)
+        self.assertTrue(type(c1.restorable_plain) is RestorableDict)
+        self.assertTrue(type(c1.restorable_plain).__getattribute__ is
+            object.__getattribute__)
+
+    def test_restoration_switches_class(self):
+
+        c1 = C(42)
+        c1.add(c1, 'a')
+
+        c1u = pickle.loads(pickle.dumps(c1))
+
+        for restorable, cls in ((c1u.restorable_plain, RestorableDict),
+                (c1u.restorable_ordered, RestorableOrderedDict),
+                (c1u.restorable_default, RestorableDefaultDict), ):
+            self.assertTrue(restorable._requires_restoration)
+            self.assertTrue(isinstance(restorable, cls))
+            self.assertFalse(type(restorable) is cls)
+            self.assertEqual(c1u, restorable[c1u][0])
+            self.assertFalse(restorable._requires_restoration)
+            self.assertTrue(type(restorable) is cls)
+            self.assertTrue(restorable._restoration_data is None)
+
+    def test_pickle_empty(self):
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for restorable in (RestorableDict(), RestorableOrderedDict(),
+                    RestorableDefaultDict(c_factory), RestorableSet(), ):
+                restorable = pickle.loads(pickle.dumps(restorable, protocol))
+                self.assertEqual(0, len(restorable))
+
+    def test_pickle_pending(self):
+
+        d1 = D(42)
+        d1.add(d1)
+
+        d1u = pickle.loads(pickle.dumps(d1))
+        self.assertTrue(d1u.restorable_plain._requires_restoration)
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            d1uu = cPickle.loads(cPickle.dumps(d1u, protocol))
+            self.assertTrue(type(d1uu.restorable_plain) is not RestorableSet)
+            self.assertTrue(d1uu in d1uu.restorable_plain)
+            self.assertTrue(type(d1uu.restorable_plain) is RestorableSet)
+
+    def test_pending_reads(self):
+
+        e = [ C(v) for v in range(3) ]
+        for c in e:
+            c.add(c, c.v)
+        mappings = (RestorableDict, RestorableOrderedDict, RestorableCounter,
+            RestorableFrozenDict)
+        sets = (RestorableSet, RestorableOrderedSet, RestorableFrozenSet)
+        restorables = [ cls({ c : c.v for c in e }) for cls in mappings ] + \
+            [ RestorableDefaultDict(c_factory, { c : c.v for c in e }) ] + \
+            [ cls(e) for cls in sets ]
+
+        for restorable in pickle.loads(pickle.dumps(restorables)):
+            self.assertEqual(3, len(restorable))
+            keys = list(restorable)
+            self.assertEqual([0, 1, 2], sorted(c.v for c in keys))
+            if isinstance(restorable, Mapping):
+                self.assertEqual(keys, list(restorable.keys()))
+                self.assertEqual(keys, list(restorable.iterkeys()))
+                values = list(restorable.values())
+                self.assertEqual([ c.v for c in keys ], values)
+                self.assertEqual(values, list(restorable.itervalues()))
+                self.assertEqual(list(zip(keys, values)),
+                    list(restorable.items()))
+                self.assertEqual(list(restorable.items()),
+                    list(restorable.iteritems()))
+                self.assertTrue(0 in restorable.values())
+                self.assertFalse(3 in restorable.values())
+                if sys.version_info[0] >= 3:
+                    # views, as of restored dictionaries
+                    views = (restorable.keys(), restorable.values(),
+                        restorable.items())
+                    self.assertTrue(isinstance(views[0], KeysView))
+                    self.assertTrue(isinstance(views[1], ValuesView))
+                    self.assertTrue(isinstance(views[2], ItemsView))
+                    self.assertEqual(3, len(views[1]))
+                    self.assertTrue(restorable._requires_restoration)
+                    self.assertEqual(set(keys[:1]),
+                        views[0] & set([keys[0], C(3)]))
+                    self.assertFalse(restorable._requires_restoration)
+                    self.assertEqual(set(keys), set(views[0]))
+                    self.assertEqual(set(values), set(views[1]))
+                    self.assertTrue((keys[1], 1) in views[2])
+                    if isinstance(restorable, MutableMapping):
+                        del restorable[keys[1]]
+                        self.assertEqual(2, len(views[2]))
+                    continue
+            self.assertTrue(restorable._requires_restoration)
+            self.assertTrue(keys[0] in restorable) # lookups restore
+            self.assertFalse(restorable._requires_restoration)
+            self.assertEqual(3, len(restorable))
+            self.assertEqual(set(keys), set(restorable))
+
+        # other collections restore as before
+        lru = pickle.loads(pickle.dumps(RestorableLRUDict(3, None, [ (1, 1) ])))
+        self.assertEqual(1, len(lru))
+        self.assertFalse(lru._requires_restoration)
+
+    def test_repickle_pending(self):
+
+        g = Group('group')
+        c1, c2 = C(42), C(67)
+        g.elements.extend((c1, c2))
+        for c, key, value in ((c1, c1, 'a'), (c1, c2, 'b'), (c2, c1, 'a')):
+            for r in (c.restorable_plain, c.restorable_ordered,
+                    c.restorable_default, c.restorable_ordered_default,
+                    c.restorable_keyed):
+                r[key] = (key, value) # cycles through the keys
+        c1.restorable_lru = RestorableLRUDict(2, None, [ (c2, 1) ])
+        c1.restorable_weak = RestorableWeakKeyDict({ c2 : 1 })
+        c1.restorable_frozen = RestorableFrozenSet([ c1 ])
+
+        def pending(c):
+            return [ r for r in (c.restorable_plain, c.restorable_ordered,
+                c.restorable_default, c.restorable_ordered_default,
+                c.restorable_keyed) if r._requires_restoration ]
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            gu = pickle.loads(pickle.dumps(g, protocol))
+            guu = cPickle.loads(cPickle.dumps(gu, protocol))
+            c1u, c2u = gu.elements
+            self.assertEqual(5, len(pending(c1u)))
+            self.assertEqual(5, len(pending(c2u)))
+            for r in (c1u.restorable_lru, c1u.restorable_weak,
+                    c1u.restorable_frozen):
+                self.assertTrue(r._requires_restoration)
+            c1uu, c2uu = guu.elements
+            self.assertEqual(5, len(pending(c1uu)))
+            self.assertEqual((c2uu, 'b'), c1uu.restorable_plain[c2uu])
+            self.assertEqual((c1uu, 'a'), c2uu.restorable_keyed[c1uu])
+            self.assertEqual(c_factory,
+                c1uu.restorable_default._contents.default_factory)
+            self.assertEqual(1, c1uu.restorable_lru[c2uu])
+            self.assertEqual(1, c1uu.restorable_weak[c2uu])
+            self.assertTrue(c1uu in c1uu.restorable_frozen)
+
+    def test_repickle_pending_subclass(self):
+
+        c1, c2 = C(42), C(67)
+        tagged = TaggedDict('tag', [ (c1, 1), (c2, 2) ])
+        c1.owner = c2.owner = tagged # cycles through the keys
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            pending = pickle.loads(pickle.dumps(tagged, protocol))
+            self.assertTrue(pending._requires_restoration)
+            repickled = cPickle.loads(cPickle.dumps(pending, protocol))
+            self.assertEqual('tag', repickled.tag)
+            self.assertEqual([1, 2], sorted(repickled.values()))
+            for key in repickled:
+                self.assertTrue(key.owner is repickled)
+                self.assertEqual({ 42 : 1, 67 : 2 }[key.v], repickled[key])
+            self.assertEqual(TaggedDict, type(repickled))
+            shallow = copy.copy(pickle.loads(pickle.dumps(tagged, protocol)))
+            self.assertEqual(('tag', 2), (shallow.tag, len(shallow)))
+
+
+
+class MappingProtocolTestCase(TestCase):
+    """
+    Tests the :class:`MutableMapping` protocol of all restorable dictionary
+    wrappers after unpickling, against the wrapped Python collection.
+    """
+
+    def check_mapping_protocol(self, restorable, plain):
+
+        c1 = C(42)
+        c1.restorable = restorable # forms cycle
+        c2 = C(67)
+        restorable[c1] = 'a'
+        restorable[c2] = 'b'
+
+        g = pickle.loads(pickle.dumps((c1, c2, restorable)))
+        c1u, c2u, restorable = g
+        plain[c1u] = 'a'
+        plain[c2u] = 'b'
+
+        self.assertTrue(c1u in restorable)
+        self.assertFalse(C(0) in restorable)
+        self.assertEqual('a', restorable.get(c1u))
+        self.assertEqual(None, restorable.get(C(0)))
+        self.assertEqual(list(plain.keys()), list(restorable.keys()))
+        self.assertEqual(list(plain.values()), list(restorable.values()))
+        self.assertEqual(list(plain.items()), list(restorable.items()))
+        self.assertEqual(list(plain.keys()), list(restorable.iterkeys()))
+        self.assertEqual(list(plain.values()), list(restorable.itervalues()))
+        self.assertEqual(list(plain.items()), list(restorable.iteritems()))
+        self.assertTrue(restorable == plain)
+        self.assertFalse(restorable != plain)
+        self.assertTrue(restorable == RestorableDict(plain))
+        self.assertFalse(restorable == None)
+
+        self.assertEqual('b', restorable.pop(c2u))
+        self.assertEqual('c', restorable.pop(c2u, 'c'))
+        self.assertRaises(KeyError, lambda: restorable.pop(c2u))
+        self.assertEqual('a', restorable.setdefault(c1u, 'c'))
+        self.assertEqual('c', restorable.setdefault(c2u, 'c'))
+        self.assertEqual(2, len(restorable))
+        self.assertTrue(restorable.popitem() in ((c1u, 'a'), (c2u, 'c')))
+        self.assertEqual(1, len(restorable))
+
+        restorable.update(RestorableDict(((c2u, 'd'), )), e = 'f')
+        self.assertEqual('d', restorable[c2u])
+        self.assertEqual('f', restorable['e'])
+        restorable.update([(c2u, 'g')])
+        self.assertEqual('g', restorable[c2u])
+
+        restorable.clear()
+        self.assertEqual(0, len(restorable))
+        self.assertFalse(restorable == plain)
+
+    def test_dict(self):
+        self.check_mapping_protocol(RestorableDict(), dict())
+
+    def test_default_dict(self):
+        self.check_mapping_protocol(RestorableDefaultDict(c_factory),
+            defaultdict(c_factory))
+
+    def test_ordered_dict(self):
+        self.check_mapping_protocol(RestorableOrderedDict(), OrderedDict())
+
+    def test_ordered_dict_order(self):
+
+        restorable = RestorableOrderedDict((k, k) for k in 'abc')
+        restorable = pickle.loads(pickle.dumps(restorable))
+
+        self.assertEqual(list('cba'), list(reversed(restorable)))
+        self.assertEqual(('a', 'a'), restorable.popitem(last = False))
+        self.assertEqual(('c', 'c'), restorable.popitem())
+        self.assertFalse(restorable == RestorableOrderedDict(b = 'b', a = 'a'))
+
+
+class RestorationAssertions(object):
+    """
+    Mix-in of :class:`TestCase` providing assertions on groups created by
+    :func:`cyclic_group`.
+    """
+
+    def assert_restored(self, gu):
+        for c in gu.elements:
+            for restorable in (c.restorable_plain, c.restorable_ordered,
+                    c.restorable_default, ):
+                self.assertFalse(restorable._requires_restoration)
+                self.assertTrue(restorable._restoration_data is None)
+        c1u, c2u = gu.elements
+        self.assertEqual(c1u, c1u.restorable_plain[c1u][0])
+        self.assertEqual(c2u, c1u.restorable_ordered[c2u][0])
+        self.assertEqual(c1u, c2u.restorable_default[c1u][0])
+
+
+class BatchRestorationTestCase(RestorationAssertions, TestCase):
+    """
+    Tests eager restoration of all :class:`Restorable` objects unpickled within
+    a :func:`restoring` context.
+    """
+
+    def test_restoring(self):
+
+        with restoring() as restoration:
+            gu = pickle.loads(pickle.dumps(cyclic_group()))
+            self.assertEqual(10, len(restoration.restorables))
+            self.assertTrue(gu.elements[0].restorable_plain._requires_restoration)
+
+        self.assertEqual([], restoration.restorables)
+        self.assert_restored(gu)
+
+    def test_restoring_exception(self):
+
+        def load():
+            with restoring():
+                gu.append(pickle.loads(pickle.dumps(cyclic_group())))
+                raise ValueError()
+
+        gu = []
+        self.assertRaises(ValueError, load)
+        self.assertTrue(gu[0].elements[0].restorable_plain._requires_restoration)
+
+        gu = pickle.loads(pickle.dumps(cyclic_group()))
+        self.assertTrue(gu.elements[0].restorable_plain._requires_restoration)
+
+    def test_restoring_loads(self):
+        self.assert_restored(restoring_loads(cPickle.dumps(cyclic_group())))
+
+    def test_restoring_load(self):
+        self.assert_restored(restoring_load(
+            BytesIO(cPickle.dumps(cyclic_group(), 2))))
+
+
+class ConcurrentRestorationTestCase(TestCase):
+    """
+    Tests that a freshly unpickled :class:`Restorable` accessed concurrently by
+    many threads is restored precisely once, and that no thread observes it
+    partially restored.
+    """
+
+    threads = 16
+
+    def setUp(self):
+        self.switch_interval = getswitchinterval()
+        setswitchinterval(SHORTEST_SWITCH_INTERVAL)
+
+    def tearDown(self):
+        setswitchinterval(self.switch_interval)
+
+    def test_concurrent_restoration(self):
+
+        c = C(0)
+        for v in range(2000):
+            c.restorable_plain[C(v)] = v
+        c.restorable_plain[c] = c # forms cycle
+
+        for attempt in range(5):
+            cu = cPickle.loads(cPickle.dumps(c, 2))
+            keys = [ key for key, value in
+                cu.restorable_plain._restoration_data ]
+            start = Event()
+            failures = []
+
+            def hammer():
+                start.wait()
+                try:
+                    for key in keys:
+                        if key not in cu.restorable_plain:
+                            failures.append(key)
+                    if len(cu.restorable_plain) != len(keys):
+                        failures.append(len(cu.restorable_plain))
+                except Exception as e:
+                    failures.append(e)
+
+            threads = [ Thread(target = hammer) for _ in range(self.threads) ]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([], failures)
+            self.assertTrue(type(cu.restorable_plain) is RestorableDict)
+
+
+class DeferredExecutor(object):
+    """
+    Executor which only runs submitted tasks when :meth:`run` is invoked.
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, fn, *args):
+        self.tasks.append((fn, args))
+
+    def run(self):
+        for fn, args in self.tasks:
+            fn(*args)
+        self.tasks = []
+
+
+class BackgroundRestorationTestCase(RestorationAssertions, TestCase):
+    """
+    Tests restoration of all :class:`Restorable` objects unpickled within a
+    :func:`restoring` context by an executor.
+    """
+
+    def test_foreground_access(self):
+
+        executor = DeferredExecutor()
+        with restoring(executor = executor) as restoration:
+            gu = pickle.loads(pickle.dumps(cyclic_group()))
+
+        warm = []
+        restoration.add_done_callback(warm.append)
+        self.assertFalse(restoration.done())
+        self.assertFalse(restoration.wait(0))
+        self.assertEqual(1, len(executor.tasks))
+
+        c1u = gu.elements[0]
+        self.assertTrue(c1u.restorable_plain._requires_restoration)
+        self.assertEqual(c1u, c1u.restorable_plain[c1u][0])
+        self.assertFalse(c1u.restorable_plain._requires_restoration)
+        self.assertTrue(c1u.restorable_ordered._requires_restoration)
+
+        executor.run()
+        self.assertTrue(restoration.done())
+        self.assertTrue(restoration.wait(0))
+        self.assertEqual([restoration], warm)
+        self.assert_restored(gu)
+
+    def test_chunks(self):
+
+        gu = pickle.loads(pickle.dumps(cyclic_group()))
+        restoration = Restoration()
+        for c in gu.elements:
+            restoration.restorables.extend((c.restorable_plain,
+                c.restorable_ordered, c.restorable_default))
+
+        executor = DeferredExecutor()
+        restoration.restore_in_background(executor, chunk_size = 4)
+
+        self.assertEqual(2, len(executor.tasks))
+        fn, args = executor.tasks.pop()
+        fn(*args)
+        self.assertFalse(restoration.done())
+        executor.run()
+        self.assertTrue(restoration.done())
+        self.assert_restored(gu)
+
+    @skipIf(ThreadPoolExecutor is None, "concurrent.futures not available")
+    def test_thread_pool(self):
+
+        with restoring(background = True) as restoration:
+            gu = pickle.loads(pickle.dumps(cyclic_group()))
+
+        self.assertTrue(restoration.wait(10))
+        self.assert_restored(gu)
+
+
+class InstrumentationTestCase(TestCase):
+    """
+    Tests the counters and timings of restoration maintained while
+    instrumentation is enabled.
+    """
+
+    def tearDown(self):
+        disable_instrumentation()
+
+    def test_disabled(self):
+
+        self.assertEqual(None, restoration_statistics())
+        gu = pickle.loads(pickle.dumps(cyclic_group()))
+        self.assertEqual(gu.elements[0], gu.elements[0].restorable_plain[
+            gu.elements[0]][0])
+        self.assertEqual(None, disable_instrumentation())
+
+    def test_enabled(self):
+
+        restorations = []
+        statistics = enable_instrumentation(
+            lambda cls, size, duration: restorations.append((cls, size)))
+        self.assertTrue(statistics is restoration_statistics())
+
+        gu = pickle.loads(pickle.dumps(cyclic_group()))
+        c1u, c2u = gu.elements
+
+        self.assertEqual(10, statistics.unpickled)
+        self.assertEqual(10, statistics.pending)
+        self.assertEqual(0, statistics.restored)
+        self.assertEqual(2, statistics.classes[RestorableDict].pending)
+
+        self.assertEqual(c1u, c1u.restorable_plain[c1u][0])
+        self.assertEqual(c1u, c2u.restorable_ordered[c1u][0])
+
+        self.assertEqual([(RestorableDict, 2), (RestorableOrderedDict, 1)],
+            restorations)
+        self.assertEqual(8, statistics.pending)
+        self.assertEqual(2, statistics.restored)
+        self.assertEqual(3, statistics.entries)
+        self.assertEqual(2, sum(statistics.histogram))
+        self.assertTrue(statistics.time >= 0)
+        self.assertEqual(1, statistics.classes[RestorableDict].pending)
+        self.assertEqual(1, statistics.classes[RestorableDict].restored)
+        self.assertEqual(2, statistics.classes[RestorableDict].entries)
+        self.assertEqual(1, statistics.classes[RestorableOrderedDict].restored)
+        self.assertEqual(0, statistics.classes[RestorableDefaultDict].restored)
+
+        self.assertTrue(statistics is disable_instrumentation())
+        self.assertEqual(c2u, c1u.restorable_default[c2u][0])
+        self.assertEqual(2, statistics.restored)
+
+    def test_entries(self):
+
+        statistics = enable_instrumentation()
+        sharded = pickle.loads(pickle.dumps(
+            RestorableShardedDict(4, None, { i : i for i in range(10) })))
+        self.assertEqual(10, len(sharded))
+        self.assertEqual(10,
+            statistics.classes[RestorableShardedDict].entries)
+
+        directory = mkdtemp()
+        try:
+            with RestorableMappedDict(os.path.join(directory, 'mapped'), 2,
+                    None, None, { i : i for i in range(10) }) as m:
+                mu = pickle.loads(pickle.dumps(m))
+            self.assertEqual(10, len(mu))
+            mu.close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(10, statistics.classes[RestorableMappedDict].entries)
+
+        # deltas applied to pending objects count towards their class
+        d = RestorableDict({ 0 : 0 })
+        d.track_changes()
+        d.clear()
+        d[1] = 1
+        du = pickle.loads(pickle.dumps(RestorableDict()))
+        du.apply_delta(d.dump_delta())
+        self.assertEqual({ 1 : 1 }, du)
+        # four shards, and twice the unpickled dictionary
+        self.assertEqual(6, statistics.classes[RestorableDict].unpickled)
+        self.assertEqual(1, statistics.classes[RestorableDict].restored)
+        self.assertEqual(1, statistics.classes[RestorableDict].entries)
+        self.assertFalse(any(cls._requires_restoration
+            for cls in statistics.classes))
+
+
+class BenchmarksTestCase(TestCase):
+    """
+    Tests that :mod:`restorable_collections_benchmarks` runs and produces
+    comparable reports.
+    """
+
+    def test_run(self):
+
+        from restorable_collections_benchmarks import COLLECTIONS, GRAPHS, \
+            compare, run
+
+        report = run(sizes = (3, ), protocols = (0, 2, ), repeat = 1,
+            memory = False, operations = 30)
+        benchmarks = set(record['benchmark'] for record in report['results'])
+        self.assertEqual(set(('deepcopy', 'dumps', 'loads', 'first_access',
+            'steady_state', )), benchmarks)
+        self.assertEqual(len(GRAPHS) * (2 * 6 + 1) + 55,
+            len(report['results']))
+        self.assertEqual(set(COLLECTIONS), set(record['collection']
+            for record in report['results']
+            if record['benchmark'] == 'steady_state'))
+        # every restorable collection class is benchmarked
+        import restorable_collections
+        self.assertEqual(set(COLLECTIONS), set(name
+            for name, cls in vars(restorable_collections).items()
+            if name.startswith('Restorable') and isinstance(cls, type) and
+                issubclass(cls, restorable_collections.Restorable) and
+                cls is not restorable_collections.Restorable))
+
+        report = json.loads(json.dumps(report))
+        comparison = list(compare(report, report))
+        self.assertEqual(len(report['results']), len(comparison))
+        for identity, ratios in comparison:
+            for ratio in ratios.values():
+                self.assertEqual(1.0, ratio)
+
+
+class CompactRestorableTestCase(TestCase):
+    """
+    Tests that restorable wrappers carry no per-instance :attr:`__dict__`,
+    remain instances of the corresponding Abstract Base Classes, and unpickle
+    streams written by version 1.0.0.
+    """
+
+    #: Tuple of a RestorableDict, RestorableDefaultDict, RestorableOrderedDict,
+    #: and RestorableSet, pickled by version 1.0.0 with protocols 0 and 2.
+    streams = (
+        b"(ccopy_reg\n_reconstructor\np1\n(crestorable_collections\n"
+        b"RestorableDict\np2\nc__builtin__\nobject\np3\nNtRp4\n(lp5\n(I1\n"
+        b"S'a'\ntp6\nabg1\n(crestorable_collections\nRestorableDefaultDict\n"
+        b"p7\ng3\nNtRp8\n(c__builtin__\nint\np9\n(lp10\n(I2\nI3\ntp11\natbg1\n"
+        b"(crestorable_collections\nRestorableOrderedDict\np12\ng3\nNtRp13\n"
+        b"(lp14\n(I4\nS'b'\ntp15\na(I5\nS'c'\ntp16\nabg1\n"
+        b"(crestorable_collections\nRestorableSet\np17\ng3\nNtRp18\n(lp19\nI6\n"
+        b"abtp20\n.",
+        b"\x80\x02(crestorable_collections\nRestorableDict\nq\x01)\x81q\x02]q"
+        b"\x03K\x01U\x01a\x86q\x04abcrestorable_collections\n"
+        b"RestorableDefaultDict\nq\x05)\x81q\x06c__builtin__\nint\nq\x07]q\x08K"
+        b"\x02K\x03\x86q\ta\x86bcrestorable_collections\nRestorableOrderedDict\n"
+        b"q\n)\x81q\x0b]q\x0c(K\x04U\x01b\x86q\rK\x05U\x01c\x86q\x0eebc"
+        b"restorable_collections\nRestorableSet\nq\x0f)\x81q\x10]q\x11K\x06abtq"
+        b"\x12.",
+    )
+
+    def test_no_dict(self):
+
+        for restorable in (RestorableDict(), RestorableDefaultDict(),
+                RestorableOrderedDict(), RestorableOrderedDefaultDict(),
+                RestorableCounter(), RestorableFrozenDict(),
+                RestorableWeakKeyDict(), RestorableWeakValueDict(),
+                RestorableLRUDict(1), RestorableKeyedDict(C(0)),
+                RestorableSet(), RestorableOrderedSet(),
+                RestorableFrozenSet(), ):
+            self.assertFalse(hasattr(restorable, '__dict__'))
+            restorable = pickle.loads(pickle.dumps(restorable))
+            self.assertFalse(hasattr(restorable, '__dict__'))
+            len(restorable)
+            self.assertFalse(hasattr(restorable, '__dict__'))
+
+    def test_abstract_base_classes(self):
+
+        for restorable in (RestorableDict(), RestorableDefaultDict(),
+                RestorableOrderedDict(), RestorableOrderedDefaultDict(),
+                RestorableCounter(), RestorableWeakKeyDict(),
+                RestorableWeakValueDict(), RestorableLRUDict(1),
+                RestorableKeyedDict(C(0)), ):
+            self.assertTrue(isinstance(restorable, MutableMapping))
+            restorable = pickle.loads(pickle.dumps(restorable))
+            self.assertTrue(isinstance(restorable, MutableMapping))
+        self.assertTrue(isinstance(RestorableSet(), MutableSet))
+        self.assertTrue(isinstance(
+            pickle.loads(pickle.dumps(RestorableSet())), MutableSet))
+
+    def test_version_1_0_0_streams(self):
+
+        for stream in self.streams:
+            for module in (pickle, cPickle, ):
+                d, dd, od, s = module.loads(stream)
+                self.assertEqual({ 1 : 'a' }, d)
+                self.assertEqual({ 2 : 3 }, dd)
+                self.assertEqual(0, dd[7])
+                self.assertEqual([(4, 'b'), (5, 'c')], list(od.items()))
+                self.assertEqual(set([6]), s)
+
+
+class SetProtocolTestCase(TestCase):
+    """
+    Tests the :class:`MutableSet` protocol of :class:`RestorableSet` after
+    unpickling, against :class:`set`.
+    """
+
+    def setUp(self):
+        d1 = D(42)
+        d1.add(d1) # cycle to itself
+        d2 = D(67)
+        d1.add(d2)
+        self.d1u = pickle.loads(pickle.dumps(d1))
+        self.d2u, = [ d for d in self.d1u.restorable_plain if d is not self.d1u ]
+        self.s = self.d1u.restorable_plain
+
+    def test_comparisons(self):
+
+        s, d1u, d2u = self.s, self.d1u, self.d2u
+        self.assertTrue(s == set([d1u, d2u]))
+        self.assertTrue(set([d1u, d2u]) == s)
+        self.assertTrue(s == RestorableSet([d1u, d2u]))
+        self.assertFalse(s != frozenset([d1u, d2u]))
+        self.assertTrue(s <= set([d1u, d2u]))
+        self.assertTrue(s > set([d1u]))
+        self.assertTrue(s >= RestorableSet([d2u]))
+        self.assertFalse(s < set([d1u, d2u]))
+        self.assertFalse(s == [d1u, d2u])
+        self.assertTrue(s.isdisjoint([D(0)]))
+        self.assertFalse(s.isdisjoint([d1u]))
+
+    def test_operators(self):
+
+        s, d1u, d2u = self.s, self.d1u, self.d2u
+        d0 = D(0)
+        for result, expected in (
+                (s & set([d1u]), set([d1u])),
+                (set([d1u]) & s, set([d1u])),
+                (s | [d0], set([d0, d1u, d2u])),
+                (s - set([d1u]), set([d2u])),
+                (set([d1u]) - s, set()),
+                (s ^ RestorableSet([d1u]), set([d2u])), ):
+            self.assertTrue(isinstance(result, RestorableSet))
+            self.assertEqual(expected, result)
+
+    def test_mutations(self):
+
+        s, d1u, d2u = self.s, self.d1u, self.d2u
+        s -= set([d2u])
+        self.assertEqual(set([d1u]), s)
+        s |= RestorableSet([d2u])
+        self.assertEqual(set([d1u, d2u]), s)
+        s &= [d2u]
+        self.assertEqual(set([d2u]), s)
+        s ^= set([d1u, d2u])
+        self.assertEqual(set([d1u]), s)
+        self.assertTrue(s is self.d1u.restorable_plain)
+
+        s.remove(d1u)
+        self.assertRaises(KeyError, s.remove, d1u)
+        s.add(d2u)
+        self.assertEqual(d2u, s.pop())
+        s.add(d1u)
+        s.clear()
+        self.assertEqual(0, len(s))
+
+
+class OrderedSetTestCase(TestCase):
+    """
+    Tests the ordering and :class:`MutableSet` protocol of
+    :class:`RestorableOrderedSet` after unpickling.
+    """
+
+    def setUp(self):
+        self.elements = [ D(v) for v in range(5) ]
+        for d in self.elements:
+            d.add(d) # cycle to itself
+        restorable = RestorableOrderedSet(self.elements)
+        self.elements, self.s = pickle.loads(pickle.dumps(
+            (self.elements, restorable)))
+
+    def test_order(self):
+
+        s, e = self.s, self.elements
+        self.assertEqual(e, list(s))
+        self.assertEqual(e[::-1], list(reversed(s)))
+        self.assertEqual(e[4], s.pop())
+        self.assertEqual(e[0], s.pop(last = False))
+        s.move_to_end(e[1])
+        self.assertEqual([e[2], e[3], e[1]], list(s))
+        s.move_to_end(e[3], last = False)
+        self.assertEqual([e[3], e[2], e[1]], list(s))
+        s.add(e[0])
+        s.add(e[3])
+        self.assertEqual([e[3], e[2], e[1], e[0]], list(s))
+        self.assertRaises(KeyError, s.move_to_end, e[4])
+        s.clear()
+        self.assertRaises(KeyError, s.pop)
+
+    def test_protocol(self):
+
+        s, e = self.s, self.elements
+        self.assertTrue(isinstance(s, MutableSet))
+        self.assertTrue(e[0] in s)
+        self.assertFalse(D(0) in s)
+        self.assertEqual(5, len(s))
+
+        self.assertTrue(s == set(e))
+        self.assertTrue(s == RestorableOrderedSet(e))
+        self.assertFalse(s == RestorableOrderedSet(e[::-1]))
+        self.assertTrue(s != RestorableOrderedSet(e[::-1]))
+        self.assertTrue(s >= set(e[:2]))
+        self.assertTrue(set(e[:2]) < s)
+        self.assertTrue(s.isdisjoint([D(0)]))
+
+        self.assertEqual(e[1:3], list(s & [e[2], e[1]]))
+        self.assertEqual([e[2], e[1]], list([e[2], e[1]] & s))
+        self.assertEqual(e[::2], list(s - e[1::2]))
+        self.assertEqual(e + [e[0].v], list(s | [e[0], e[0].v]))
+        self.assertEqual(e[2:] + [0], list(s ^ (e[:2] + [0])))
+        self.assertTrue(isinstance(s & [], RestorableOrderedSet))
+
+        s.discard(e[0])
+        s.discard(e[0])
+        self.assertRaises(KeyError, s.remove, e[0])
+        s -= [e[1]]
+        s |= [e[0]]
+        self.assertEqual([e[2], e[3], e[4], e[0]], list(s))
+        s &= set(e[3:])
+        self.assertEqual([e[3], e[4]], list(s))
+        s ^= [e[4], e[1]]
+        self.assertEqual([e[3], e[1]], list(s))
+        self.assertEqual("RestorableOrderedSet[D(3), D(1)]", repr(s))
+
+    def test_pickle(self):
+
+        s = RestorableOrderedSet('cab')
+        self.assertEqual(list('cab'), s.__getstate__())
+        self.assertEqual(list('cab'), list(pickle.loads(pickle.dumps(s))))
+
+
+class OrderedDefaultDictTestCase(TestCase):
+    """
+    Tests the ordering and default factory of
+    :class:`RestorableOrderedDefaultDict` after unpickling.
+    """
+
+    def setUp(self):
+        self.elements = [ C(v) for v in range(5) ]
+        restorable = RestorableOrderedDefaultDict(list)
+        for c in self.elements:
+            c.owner = restorable # cycle through the key
+            restorable[c].append(c.v)
+        self.elements, self.d = pickle.loads(pickle.dumps(
+            (self.elements, restorable)))
+
+    def test_order(self):
+
+        d, e = self.d, self.elements
+        self.assertEqual(e, list(d.keys()))
+        self.assertEqual(e[::-1], list(reversed(d)))
+        self.assertEqual((e[4], [4]), d.popitem())
+        self.assertEqual((e[0], [0]), d.popitem(last = False))
+        d[e[0]].append(5)
+        self.assertEqual([e[1], e[2], e[3], e[0]], list(d.keys()))
+        self.assertEqual([5], d[e[0]])
+        contents = d._contents
+        items = list(contents.items())[::-1]
+        self.assertNotEqual(contents, OrderedDict(items))
+        self.assertEqual(contents, dict(items))
+        self.assertEqual(contents.copy(), contents)
+        d.clear()
+        self.assertRaises(KeyError, d.popitem, last = False)
+
+    def test_default_factory(self):
+
+        d, e = self.d, self.elements
+        self.assertEqual([3], d[e[3]])
+        c = C(5)
+        self.assertEqual([], d[c])
+        self.assertEqual(e + [c], list(d.keys()))
+        self.assertTrue(isinstance(d, MutableMapping))
+        self.assertEqual(
+            OrderedDict([ (k, [k.v]) for k in e ] + [ (c, []) ]), d)
+        self.assertRaises(KeyError,
+            RestorableOrderedDefaultDict()._contents.__getitem__, c)
+        self.assertRaises(TypeError, RestorableOrderedDefaultDict, 1)
+        d = RestorableOrderedDefaultDict(list, [ (2, [1]) ])
+        self.assertTrue('_OrderedDefaultDict' not in repr(d))
+        self.assertTrue(repr(d._contents).startswith(
+            'OrderedDefaultDict({!r}, '.format(list)))
+        self.assertTrue('[1]' in repr(d))
+        self.assertTrue(repr(RestorableOrderedDefaultDict()).endswith(
+            'OrderedDefaultDict(None, {})'.format(
+                '{}' if sys.version_info >= (3, 7) else '[]')))
+
+    def test_repickle(self):
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for module in (pickle, cPickle, ):
+                e, d = module.loads(module.dumps((self.elements, self.d),
+                    protocol))
+                self.assertEqual(e, list(d.keys()))
+                self.assertTrue(e[0].owner is d)
+                self.assertEqual([], d[C(5)])
+                d = RestorableOrderedDefaultDict(list, [ (2, [1]), (1, [2]) ])
+                contents = module.loads(module.dumps(d._contents, protocol))
+                self.assertEqual(d._contents, contents)
+                self.assertEqual([2, 1], list(contents.keys()))
+                self.assertEqual([], contents[3])
+
+
+class CounterTestCase(TestCase):
+    """
+    Tests counting, :meth:`most_common` and arithmetic of
+    :class:`RestorableCounter` after unpickling.
+    """
+
+    def setUp(self):
+        self.elements = [ C(v) for v in range(4) ]
+        restorable = RestorableCounter()
+        for c in self.elements:
+            c.owner = restorable # cycle through the key
+            restorable.update([c] * c.v)
+        self.elements, self.counter = pickle.loads(pickle.dumps(
+            (self.elements, restorable)))
+
+    def test_counting(self):
+
+        counter, e = self.counter, self.elements
+        self.assertTrue(type(counter)._requires_restoration)
+        self.assertTrue(e[0].owner is counter)
+        self.assertEqual(3, counter[e[3]])
+        self.assertFalse(type(counter)._requires_restoration)
+        self.assertEqual(0, counter[C(4)])
+        self.assertFalse(C(4) in counter)
+        self.assertEqual(3, len(counter))
+
+        counter.update([e[1], e[0], e[1]])
+        self.assertEqual(3, counter[e[1]])
+        counter.update(RestorableCounter({ e[2] : 2 }))
+        counter.update(RestorableDict({ e[2] : 1 }), x = 1)
+        self.assertEqual(5, counter[e[2]])
+        self.assertEqual(1, counter['x'])
+        counter.subtract(Counter({ e[2] : 1 }))
+        counter.subtract(['x', 'x'])
+        self.assertEqual(4, counter[e[2]])
+        self.assertEqual(-1, counter['x'])
+
+        self.assertEqual([(e[2], 4)], counter.most_common(1))
+        self.assertEqual([(e[2], 4), (e[1], 3), (e[3], 3)],
+            sorted(counter.most_common(3),
+                key = lambda item: (-item[1], item[0].v)))
+        self.assertEqual(5, len(counter.most_common()))
+        self.assertEqual(Counter([e[0]] + [e[1]] * 3 + [e[2]] * 4 +
+            [e[3]] * 3), Counter(counter.elements()))
+
+    def test_arithmetic(self):
+
+        counter, e = self.counter, self.elements
+        other = Counter({ e[1] : 2, e[3] : 1, 'x' : 1 })
+        for operand in (other, RestorableCounter(other), ):
+            for result, expected in (
+                    (counter + operand, { e[1] : 3, e[2] : 2, e[3] : 4,
+                        'x' : 1 }),
+                    (operand + counter, { e[1] : 3, e[2] : 2, e[3] : 4,
+                        'x' : 1 }),
+                    (counter - operand, { e[2] : 2, e[3] : 2 }),
+                    (operand - counter, { e[1] : 1, 'x' : 1 }),
+                    (counter | operand, { e[1] : 2, e[2] : 2, e[3] : 3,
+                        'x' : 1 }),
+                    (operand | counter, { e[1] : 2, e[2] : 2, e[3] : 3,
+                        'x' : 1 }),
+                    (counter & operand, { e[1] : 1, e[3] : 1 }),
+                    (operand & counter, { e[1] : 1, e[3] : 1 }), ):
+                self.assertTrue(isinstance(result, RestorableCounter))
+                self.assertEqual(expected, result)
+        counter += other
+        self.assertTrue(isinstance(counter, RestorableCounter))
+        self.assertEqual(4, counter[e[3]])
+        self.assertRaises(TypeError, lambda: counter + { e[1] : 1 })
+
+    def test_repickle(self):
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for module in (pickle, cPickle, ):
+                e, counter = module.loads(module.dumps(
+                    (self.elements, self.counter), protocol))
+                self.assertTrue(e[0].owner is counter)
+                self.assertEqual([(e[3], 3)], counter.most_common(1))
+                self.assertEqual(0, counter[e[0]])
+                self.assertEqual(3, len(counter))
+
+
+class FrozenTestCase(TestCase):
+    """
+    Tests hashing, equality and read-only access of
+    :class:`RestorableFrozenSet` and :class:`RestorableFrozenDict` used as keys
+    of restorable collections within cycles.
+    """
+
+    def setUp(self):
+        self.elements = [ C(v) for v in range(3) ]
+        e = self.elements
+        fs = RestorableFrozenSet(e[:2])
+        fd = RestorableFrozenDict({ e[0] : 0, e[2] : 2 })
+        for c in e:
+            c.restorable_plain[fs] = c.v # cycle through the frozen set
+            c.restorable_ordered[fd] = c.v # cycle through the frozen dict
+        self.elements, self.fs, self.fd = pickle.loads(pickle.dumps(
+            (e, fs, fd)))
+
+    def test_keys(self):
+
+        e, fs, fd = self.elements, self.fs, self.fd
+        self.assertTrue(type(fs)._requires_restoration)
+        self.assertEqual(1, e[1].restorable_plain[fs])
+        self.assertEqual(2, e[2].restorable_ordered[fd])
+        self.assertEqual(0, e[0].restorable_plain[frozenset(e[:2])])
+        self.assertEqual(0, e[0].restorable_ordered[
+            RestorableFrozenDict({ e[0] : 0, e[2] : 2 })])
+        self.assertEqual(fs, list(e[2].restorable_plain)[0])
+        self.assertEqual(fd, list(e[1].restorable_ordered)[0])
+
+    def test_hash(self):
+
+        fs, fd = self.fs, self.fd
+        self.assertEqual(None, fs._hash)
+        self.assertEqual(hash(frozenset(self.elements[:2])), hash(fs))
+        self.assertEqual(hash(fs), fs._hash)
+        self.assertEqual(None, fd._hash)
+        self.assertEqual(hash(frozenset(fd.items())), hash(fd))
+        self.assertEqual(hash(fd), fd._hash)
+        self.assertFalse(type(fd)._requires_restoration)
+        self.assertRaises(TypeError, hash, RestorableFrozenDict(a = []))
+
+    def test_protocol(self):
+
+        e, fs, fd = self.elements, self.fs, self.fd
+        self.assertTrue(isinstance(fs, Set))
+        self.assertFalse(isinstance(fs, MutableSet))
+        self.assertTrue(isinstance(fs, Hashable))
+        self.assertTrue(isinstance(fd, Mapping))
+        self.assertFalse(isinstance(fd, MutableMapping))
+        self.assertTrue(isinstance(fd, Hashable))
+
+        self.assertTrue(fs == set(e[:2]))
+        self.assertTrue(fs == RestorableSet(e[:2]))
+        self.assertTrue(fs <= RestorableFrozenSet(e))
+        self.assertEqual(frozenset(e), fs | set(e[2:]))
+        self.assertTrue(isinstance(set(e) - fs, RestorableFrozenSet))
+        self.assertEqual(set(e[2:]), set(e) - fs)
+        self.assertEqual(set(e[:1]), RestorableSet(e[:1]) & fs)
+        self.assertFalse(hasattr(fs, 'add'))
+
+        self.assertTrue(fd == { e[0] : 0, e[2] : 2 })
+        self.assertTrue(fd == RestorableDict({ e[0] : 0, e[2] : 2 }))
+        self.assertTrue(RestorableDict({ e[0] : 0, e[2] : 2 }) == fd)
+        self.assertTrue(fd != OrderedDict([ (e[0], 0) ]))
+        self.assertEqual(2, fd.get(e[2]))
+        self.assertEqual(2, len(fd))
+        with self.assertRaises(TypeError):
+            fd[e[1]] = 1
+        self.assertFalse(hasattr(fd, 'pop'))
+
+    def test_repickle(self):
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for module in (pickle, cPickle, ):
+                e, fs, fd = module.loads(module.dumps(
+                    (self.elements, self.fs, self.fd), protocol))
+                self.assertEqual(fd, list(e[0].restorable_ordered)[0])
+                self.assertEqual(1, e[1].restorable_plain[fs])
+                self.assertEqual(frozenset(e[:2]), fs)
+
+
+class WeakDictTestCase(TestCase):
+    """
+    Tests that :class:`RestorableWeakKeyDict` and
+    :class:`RestorableWeakValueDict` keep only the entries whose referents are
+    reachable through the rest of the unpickled graph.
+    """
+
+    def setUp(self):
+        self.elements = [ C(v) for v in range(3) ]
+        self.weak_keys = RestorableWeakKeyDict(
+            (c, c.v) for c in self.elements)
+        self.weak_values = RestorableWeakValueDict(
+            (c.v, c) for c in self.elements)
+        for c in self.elements:
+            c.owner = (self.weak_keys, self.weak_values) # cycles
+
+    def test_unreachable(self):
+
+        e = self.elements
+        eu, wk, wv = pickle.loads(pickle.dumps(
+            (e[:2], self.weak_keys, self.weak_values)))
+        gc.collect()
+        self.assertTrue(type(wk)._requires_restoration)
+        self.assertEqual(eu, sorted(wk.keys(), key = lambda c: c.v))
+        self.assertEqual({ 0 : eu[0], 1 : eu[1] }, wv)
+        self.assertEqual(1, wk[eu[1]])
+        self.assertTrue(eu[0] is wv[0])
+        self.assertFalse(2 in wv)
+
+    def test_collected(self):
+
+        e = self.elements
+        eu, wk, wv = pickle.loads(pickle.dumps(
+            (e, self.weak_keys, self.weak_values)))
+        del eu[1]
+        gc.collect()
+        self.assertTrue(type(wv)._requires_restoration)
+        self.assertEqual(set([0, 2]), set(wk.values()))
+        self.assertEqual(set([0, 2]), set(wv.keys()))
+        self.assertTrue(wv == RestorableDict(list(zip((0, 2), eu))))
+        del eu[:]
+        gc.collect()
+        self.assertEqual(0, len(wk))
+        self.assertEqual({}, wv)
+
+    def test_mapping(self):
+
+        e = self.elements
+        wk, wv = self.weak_keys, self.weak_values
+        self.assertEqual(dict((c, c.v) for c in e), wk)
+        self.assertTrue(wk != RestorableDict())
+        wk[e[0]] = 5
+        self.assertEqual(5, wk.pop(e[0]))
+        self.assertEqual(e[1], wv.get(1))
+        wv.update(RestorableDict({ 4 : e[0] }))
+        self.assertTrue(wv[4] is e[0])
+
+
+class LRUDictTestCase(TestCase):
+    """
+    Tests eviction, expiry and counters of :class:`RestorableLRUDict`, and that
+    they survive pickling.
+    """
+
+    def setUp(self):
+        self.elements = [ C(v) for v in range(5) ]
+        self.lru = RestorableLRUDict(3)
+        for c in self.elements:
+            c.owner = self.lru # cycle through the key
+
+    def test_eviction(self):
+
+        lru, e = self.lru, self.elements
+        self.assertRaises(ValueError, RestorableLRUDict, 0)
+        for c in e[:3]:
+            lru[c] = c.v
+        self.assertEqual(0, lru[e[0]])
+        lru[e[3]] = 3
+        self.assertEqual([e[2], e[0], e[3]], list(lru.keys()))
+        self.assertEqual(None, lru.get(e[1]))
+        self.assertRaises(KeyError, lambda: lru[e[4]])
+        lru.update([ (e[4], 4) ])
+        self.assertEqual([e[0], e[3], e[4]], list(lru.keys()))
+        self.assertEqual((1, 2, 2), (lru.hits, lru.misses, lru.evictions))
+        self.assertEqual(3, lru.setdefault(e[3], 5))
+        self.assertEqual((e[0], 0), lru.popitem(last = False))
+        self.assertEqual([e[4], e[3]], list(lru.keys()))
+        self.assertEqual(4, lru.pop(e[4]))
+        self.assertTrue(e[3] in lru)
+        self.assertFalse(e[4] in lru)
+
+    def test_expiry(self):
+
+        lru, e = self.lru, self.elements
+        lru.ttl = 3600
+        lru[e[0]] = 0
+        lru.put(e[1], 1, ttl = 0)
+        lru.put(e[2], 2, ttl = None)
+        self.assertTrue(e[0] in lru)
+        self.assertFalse(e[1] in lru)
+        self.assertEqual(3, len(lru))
+        self.assertRaises(KeyError, lambda: lru[e[1]])
+        self.assertEqual(2, len(lru))
+        self.assertEqual(1, lru.misses)
+        lru.put(e[1], 1, ttl = 0)
+        self.assertEqual([e[0], e[2]], list(lru.keys()))
+        lru.put(e[1], 1, ttl = 0)
+        self.assertEqual(1, lru.expire())
+        self.assertEqual(set([e[0]]), set(lru._expiries))
+
+    def test_repickle(self):
+
+        lru, e = self.lru, self.elements
+        lru.put(e[0], 0, ttl = 3600)
+        lru.put(e[1], 1, ttl = 0)
+        lru[e[2]] = 2
+        lru[e[0]]
+        lru.get(e[4])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for module in (pickle, cPickle, ):
+                eu, lu = module.loads(module.dumps((e, lru), protocol))
+                self.assertTrue(eu[0].owner is lu)
+                self.assertEqual((3, None, 1, 1, 0), (lu.capacity, lu.ttl,
+                    lu.hits, lu.misses, lu.evictions))
+                self.assertEqual([eu[2], eu[0]], list(lu.keys()))
+                self.assertEqual(lru._expiries[e[0]], lu._expiries[eu[0]])
+                lu[eu[3]] = 3
+                lu[eu[4]] = 4
+                self.assertEqual([eu[0], eu[3], eu[4]], list(lu.keys()))
+                self.assertEqual(1, lu.evictions)
+
+    def test_mapping(self):
+
+        lru, e = self.lru, self.elements
+        lru.update({ e[0] : 0 }, x = 'x')
+        lru.update(RestorableDict({ e[1] : 1 }))
+        self.assertEqual([e[0], 'x', e[1]], list(lru.keys()))
+        other = RestorableLRUDict(3, None, lru)
+        other.update(lru)
+        self.assertEqual([e[0], 'x', e[1]], list(other.keys()))
+        self.assertEqual((0, 0), (lru.hits, other.hits))
+        self.assertEqual(lru, other)
+        other[e[0]]
+        self.assertEqual(['x', e[1], e[0]], list(other.keys()))
+        self.assertTrue(lru == other)
+        self.assertFalse(lru != other)
+        self.assertEqual(OrderedDict([ (e[1], 1), (e[0], 0), ('x', 'x') ]),
+            other)
+        self.assertEqual(other, { e[0] : 0, e[1] : 1, 'x' : 'x' })
+        # symmetrically with ordered restorable collections
+        for ordered in (RestorableOrderedDict, RestorableFrozenDict):
+            d = ordered([ (e[0], 0), ('x', 'x'), (e[1], 1) ])
+            self.assertTrue(d == other)
+            self.assertTrue(other == d)
+            self.assertFalse(d != other)
+            self.assertFalse(other != d)
+        other[e[0]] = 5
+        self.assertNotEqual(lru, other)
+        self.assertNotEqual(d, other)
+        self.assertNotEqual(other, d)
+
+
+class KeyedDictTestCase(TestCase):
+    """
+    Tests that :class:`RestorableKeyedDict` pickles identifiers instead of keys
+    and neither restores nor looks up entries by hashing keys.
+    """
+
+    def setUp(self):
+        self.c1, self.c2 = cyclic_group().elements
+
+    def test_identifiers(self):
+
+        c1, c2 = self.c1, self.c2
+        self.assertEqual([(42, (c1, 'a')), (67, (c2, 'b'))],
+            sorted(c1.restorable_keyed.__getstate__()[2]))
+        self.assertTrue(c1 is c1.restorable_keyed.__getstate__()[0])
+        self.assertEqual('restorable_keyed',
+            c1.restorable_keyed.__getstate__()[1])
+
+    def test_no_hashing(self):
+
+        c1u, c2u = pickle.loads(pickle.dumps((self.c1, self.c2)))
+        hash_method = C.__hash__
+        def unhashable(c):
+            raise AssertionError('hashed {}'.format(c))
+        C.__hash__ = unhashable
+        try:
+            self.assertEqual((c2u, 'b'), c1u.restorable_keyed[c2u])
+            self.assertEqual((c1u, 'a'), c1u.restorable_keyed[C(42)])
+            self.assertEqual((c1u, 'a'), c2u.restorable_keyed[c1u])
+            self.assertTrue(c1u in list(c1u.restorable_keyed.keys()))
+            self.assertFalse(C(3) in c1u.restorable_keyed)
+        finally:
+            C.__hash__ = hash_method
+
+    def test_mapping(self):
+
+        c1u, c2u = pickle.loads(pickle.dumps((self.c1, self.c2)))
+        keyed = c1u.restorable_keyed
+        self.assertTrue(isinstance(keyed, MutableMapping))
+        self.assertEqual({ c1u : (c1u, 'a'), c2u : (c2u, 'b') }, keyed)
+        self.assertTrue(RestorableDict(keyed) == keyed)
+        self.assertEqual(2, len(keyed))
+        self.assertEqual((c2u, 'b'), keyed.pop(c2u))
+        self.assertEqual(None, keyed.get(c2u))
+        self.assertEqual(5, keyed.setdefault(c2u, 5))
+        del keyed[c1u]
+        self.assertEqual([(c2u, 5)], list(keyed.items()))
+        keyed.update([ (c1u, 1) ])
+        self.assertEqual(set([1, 5]), set(keyed.itervalues()))
+        self.assertEqual(set([c1u, c2u]), set(keyed))
+        keyed.clear()
+        self.assertRaises(KeyError, keyed.popitem)
+
+    def test_update(self):
+
+        c1u, c2u = pickle.loads(pickle.dumps((self.c1, self.c2)))
+        keyed = c1u.restorable_keyed
+        keyed.update({ c1u : 1 })
+        keyed.update(RestorableDict({ c2u : 2 }))
+        self.assertEqual({ c1u : 1, c2u : 2 }, keyed)
+        keyed.update(c2u.restorable_keyed)
+        self.assertEqual({ c1u : (c1u, 'a'), c2u : 2 }, keyed)
+        keyed.update(keyed)
+        keyed.update([ (C(67), 3) ])
+        self.assertEqual((2, 3), (len(keyed), keyed[c2u]))
+
+
+class ChangeTrackingTestCase(TestCase):
+    """
+    Tests that collections tracking their changes dump deltas of only the
+    changed keys (or elements), which rebuild the collection when applied to
+    an earlier snapshot.
+    """
+
+    def assertDeltas(self, restorable, mutations):
+        """
+        Asserts that applying the deltas dumped after each of *mutations* to
+        the unpickled snapshot of *restorable* results in *restorable*, and
+        returns the deltas.
+        """
+        snapshot = pickle.dumps(restorable)
+        restorable.track_changes()
+        deltas = []
+        for mutate in mutations:
+            mutate(restorable)
+            deltas.append(pickle.dumps(restorable.dump_delta()))
+        deltas = [ pickle.loads(delta) for delta in deltas ]
+        self.assertEqual(restorable,
+            apply_deltas(pickle.loads(snapshot), deltas))
+        return deltas
+
+    def test_dict(self):
+
+        def first(d):
+            d[4] = 'd'
+            del d[1]
+            d[4] = 'e'
+            d.pop(5, None)
+        def second(d):
+            d.update({ 2 : 'B' }, x = 'x')
+            d.setdefault(3, 'C')
+            d.setdefault(6, 'f')
+        d = RestorableDict({ 1 : 'a', 2 : 'b', 3 : 'c' })
+        deltas = self.assertDeltas(d, (first, second, lambda d: None))
+        self.assertEqual(([(4, 'e')], [1]), deltas[0].changes)
+        self.assertEqual(None, deltas[0].state)
+        self.assertEqual((set([(2, 'B'), ('x', 'x'), (6, 'f')]), []),
+            (set(deltas[1].changes[0]), deltas[1].changes[1]))
+        self.assertEqual(([], []), deltas[2].changes)
+
+    def test_state(self):
+
+        def clear(d):
+            d.clear()
+            d[1] = 'z'
+        deltas = self.assertDeltas(RestorableDefaultDict(list, { 1 : [] }),
+            (lambda d: d[2].append(2), clear, lambda d: d.popitem(), ))
+        self.assertEqual(([(2, [2])], []), deltas[0].changes)
+        self.assertEqual((list, [(1, 'z')]), deltas[1].state)
+        self.assertEqual(([], [1]), deltas[2].changes)
+
+    def test_ordered(self):
+
+        def remove(d):
+            d.pop(1)
+            d[1] = 'a'
+        deltas = self.assertDeltas(RestorableOrderedDict([ (1, 'a'),
+            (2, 'b') ]), (lambda d: d.update([ (3, 'c'), (2, 'B') ]),
+            remove, lambda d: d.popitem(last = False), ))
+        self.assertEqual(([(3, 'c'), (2, 'B')], []), deltas[0].changes)
+        self.assertEqual([(2, 'B'), (3, 'c'), (1, 'a')], deltas[1].state)
+        self.assertEqual([(3, 'c'), (1, 'a')], deltas[2].state)
+
+        s = RestorableOrderedSet([1, 2, 3])
+        deltas = self.assertDeltas(s, (lambda s: s.add(4),
+            lambda s: s.move_to_end(1), lambda s: s.discard(5)))
+        self.assertEqual(([4], []), deltas[0].changes)
+        self.assertEqual([2, 3, 4, 1], deltas[1].state)
+        self.assertEqual(([], []), deltas[2].changes)
+
+    def test_popitem(self):
+
+        for cls in (RestorableDict, RestorableCounter, RestorableOrderedDict):
+            untracked = cls(OrderedDict((v, v) for v in range(20)))
+            tracked = cls(OrderedDict((v, v) for v in range(20)))
+            tracked.track_changes()
+            with tracked.snapshot() as snapshot:
+                popped = [ untracked.popitem() for _ in range(5) ]
+                self.assertEqual(popped,
+                    [ tracked.popitem() for _ in range(5) ])
+                self.assertEqual(untracked, tracked)
+                self.assertEqual(dict((v, v) for v in range(20)),
+                    pickle.loads(pickle.dumps(snapshot)))
+            delta = tracked.dump_delta()
+            if cls is RestorableOrderedDict:
+                self.assertEqual(list(untracked.items()), delta.state)
+            else:
+                self.assertEqual(([], [ key for key, _ in popped ]),
+                    delta.changes)
+        tracked = RestorableDict()
+        tracked.track_changes()
+        self.assertRaises(KeyError, tracked.popitem)
+        self.assertRaises(TypeError, RestorableDict({ 1 : 1 }).popitem, False)
+
+    def test_counter_and_set(self):
+
+        def count(c):
+            c.update(iter('abca'))
+            c.subtract({ 'b' : 1 })
+        deltas = self.assertDeltas(RestorableCounter('ab'), (count, ))
+        self.assertEqual((set([('a', 3), ('b', 1), ('c', 1)]), []),
+            (set(deltas[0].changes[0]), deltas[0].changes[1]))
+
+        def mutate(s):
+            s.add(4)
+            s.remove(1)
+            s.discard(7)
+        deltas = self.assertDeltas(RestorableSet([1, 2, 3]),
+            (mutate, lambda s: s.pop(), lambda s: s.__ior__(set([8])), ))
+        self.assertEqual(([4], [1]), deltas[0].changes)
+        self.assertEqual(1, len(deltas[1].changes[1]))
+        self.assertFalse(deltas[2].state is None)
+
+    def test_life_cycle(self):
+
+        e = [ C(v) for v in range(3) ]
+        d = RestorableDict((c, c.v) for c in e)
+        for c in e:
+            c.owner = d # cycle through the key
+        e, d = pickle.loads(pickle.dumps((e, d)))
+        self.assertRaises(ValueError, d.dump_delta)
+        self.assertTrue(type(d)._requires_restoration)
+        d.track_changes()
+        self.assertFalse(type(d)._requires_restoration)
+        self.assertTrue(type(d)._observed)
+        self.assertTrue(isinstance(d, RestorableDict))
+        self.assertRaises(TypeError, d.apply_delta, RestorationDelta())
+        d[e[0]] = 5
+        d.track_changes()
+        self.assertEqual(([], []), d.dump_delta().changes)
+
+        e, du = pickle.loads(pickle.dumps((e, d)))
+        self.assertTrue(e[0].owner is du)
+        self.assertEqual(RestorableDict, type(du)._restored_class)
+        self.assertEqual(5, du[e[0]])
+        self.assertEqual(RestorableDict, type(du))
+
+        d.track_changes(False)
+        self.assertEqual(RestorableDict, type(d))
+        self.assertRaises(ValueError, d.dump_delta)
+        s = RestorableSet([1])
+        s.track_changes()
+        self.assertEqual(RestorableSet, type(s | set([2])))
+
+    def test_unsupported(self):
+
+        for restorable in (RestorableLRUDict(1), RestorableWeakKeyDict(),
+                RestorableKeyedDict(C(0)), RestorableFrozenSet(), ):
+            self.assertRaises(TypeError, restorable.track_changes)
+            self.assertRaises(ValueError, restorable.dump_delta)
+
+
+class SnapshotTestCase(TestCase):
+    """
+    Tests that snapshots pickle the contents at the time of the snapshot while
+    their collections keep changing, including concurrently.
+    """
+
+    def test_mapping(self):
+
+        e = [ C(v) for v in range(4) ]
+        d = RestorableDefaultDict(list, ((c, [c.v]) for c in e[:3]))
+        for c in e:
+            c.owner = d # cycle through the key
+        snapshot = d.snapshot()
+        self.assertTrue(isinstance(snapshot, RestorationSnapshot))
+        self.assertTrue(type(d)._observed)
+        d[e[0]] = [5]
+        d[e[0]] = [6]
+        del d[e[1]]
+        d[e[3]].append(3)
+        d.update({ e[1] : [7] })
+        e, du = pickle.loads(pickle.dumps((e, snapshot)))
+        self.assertEqual(RestorableDefaultDict, type(du)._restored_class)
+        self.assertTrue(e[0].owner is not du)
+        self.assertEqual(dict((c, [c.v]) for c in e[:3]), du)
+        self.assertEqual([], du[e[3]])
+        self.assertEqual({ e[0] : [6], e[1] : [7], e[2] : [2], e[3] : [3] },
+            e[0].owner)
+        snapshot.release()
+        self.assertEqual(RestorableDefaultDict, type(d))
+        self.assertRaises(ValueError, pickle.dumps, snapshot)
+
+    def test_set_and_counter(self):
+
+        s = RestorableSet([1, 2])
+        with s.snapshot() as snapshot:
+            s.add(3)
+            s.remove(1)
+            s.pop()
+            self.assertEqual(set([1, 2]), pickle.loads(pickle.dumps(snapshot)))
+        self.assertEqual(RestorableSet, type(s))
+
+        c = RestorableCounter('abc')
+        with c.snapshot() as snapshot:
+            c.update('aad')
+            c.subtract({ 'b' : 1 })
+            self.assertEqual(Counter('abc'),
+                pickle.loads(pickle.dumps(snapshot)))
+
+    def test_copy_before_clearing(self):
+
+        d = RestorableOrderedDict([ (1, 'a'), (2, 'b'), (3, 'c') ])
+        s = RestorableOrderedSet([1, 2, 3])
+        d.track_changes()
+        for restorable in (d, s):
+            with restorable.snapshot() as snapshot:
+                restorable.pop(1)
+                self.assertEqual(None, snapshot._restorable)
+                restorable.clear()
+                copied = pickle.loads(pickle.dumps(snapshot))
+                self.assertEqual([1, 2, 3], list(copied))
+        self.assertTrue(type(d)._observed)
+        self.assertEqual(RestorableOrderedSet, type(s))
+
+        lru = RestorableLRUDict(2)
+        lru[1] = 'a'
+        snapshot = lru.snapshot()
+        lru[2] = 'b'
+        self.assertEqual(RestorableLRUDict, type(lru))
+        self.assertEqual([1], list(pickle.loads(pickle.dumps(snapshot)).keys()))
+        snapshot.release()
+
+    def test_read(self):
+
+        d = RestorableDefaultDict(list, { 1 : [1], 2 : [2] })
+        snapshot = d.snapshot()
+        d[1] = [5]
+        del d[2]
+        d[3].append(3)
+        self.assertEqual(([1], [2]), (snapshot[1], snapshot[2]))
+        self.assertRaises(KeyError, lambda: snapshot[3])
+        self.assertEqual(None, snapshot.get(3))
+        self.assertTrue(2 in snapshot)
+        self.assertFalse(3 in snapshot)
+        self.assertTrue(type(d)._observed)
+        self.assertEqual([1, 2], sorted(snapshot))
+        self.assertEqual(2, len(snapshot))
+        self.assertEqual(RestorableDefaultDict, type(d))
+        d[1] = [6]
+        self.assertEqual([1], snapshot[1])
+        self.assertEqual({ 1 : [1], 2 : [2] },
+            pickle.loads(pickle.dumps(snapshot)))
+
+        for s in (RestorableSet([1, 2]), RestorableOrderedSet([1, 2]),
+                RestorableFrozenSet([1, 2])):
+            with s.snapshot() as snapshot:
+                if not isinstance(s, RestorableFrozenSet):
+                    s.discard(1)
+                    s.add(3)
+                self.assertTrue(1 in snapshot)
+                self.assertFalse(3 in snapshot)
+                self.assertRaises(TypeError, lambda: snapshot[1])
+                self.assertEqual([1, 2], sorted(snapshot))
+
+        c = RestorableCounter({ 'a' : 1 })
+        with c.snapshot() as snapshot:
+            c['a'] += 1
+            self.assertEqual(1, snapshot['a'])
+            self.assertRaises(KeyError, lambda: snapshot['b'])
+            c.clear()
+            self.assertEqual(1, snapshot['a'])
+            self.assertEqual(['a'], list(snapshot))
+
+    def test_concurrent_writers(self):
+
+        size = 5000
+        d = RestorableDict((key, key) for key in range(size))
+        def write(round, started, stopped):
+            # every value written is new, so a single write changes d
+            key = 0
+            while not stopped.is_set():
+                d[key % (2 * size)] = (round, key)
+                d.pop((key + 7) % size, None)
+                key += 1
+                if key == 100:
+                    started.set()
+        interval = getswitchinterval()
+        setswitchinterval(SHORTEST_SWITCH_INTERVAL)
+        try:
+            for round in range(3):
+                expected = dict(d.items())
+                with d.snapshot() as snapshot:
+                    started, stopped = Event(), Event()
+                    writer = Thread(target = write,
+                        args = (round, started, stopped))
+                    writer.start()
+                    try:
+                        started.wait()
+                        data = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+                    finally:
+                        stopped.set()
+                        writer.join()
+                    self.assertNotEqual(expected, d)
+                    self.assertEqual(expected, pickle.loads(data))
+        finally:
+            setswitchinterval(interval)
+
+
+class CopyTestCase(TestCase):
+    """
+    Tests shallow and deep copies of all restorable collections, including deep
+    copies of cycles through their keys.
+    """
+
+    def restorables(self, e):
+        return (RestorableDict({ e[0] : 0 }),
+            RestorableDefaultDict(list, { e[0] : [0] }),
+            RestorableOrderedDict([ (e[0], 0) ]),
+            RestorableOrderedDefaultDict(list, [ (e[0], [0]) ]),
+            RestorableCounter([e[0]]), RestorableFrozenDict({ e[0] : 0 }),
+            RestorableLRUDict(2, None, [ (e[0], 0) ]),
+            RestorableKeyedDict(e[1], None, [ (e[0], (e[0], 0)) ]),
+            RestorableWeakKeyDict({ e[0] : 0 }),
+            RestorableWeakValueDict({ 0 : e[0] }),
+            RestorableSet([e[0]]), RestorableOrderedSet([e[0]]),
+            RestorableFrozenSet([e[0]]), )
+
+    def test_shallow(self):
+
+        e = [ C(0), C(1) ]
+        for restorable in self.restorables(e):
+            for original in (restorable,
+                    pickle.loads(pickle.dumps(restorable))):
+                shallow = copy.copy(original)
+                self.assertEqual(original, shallow)
+                if isinstance(original, (RestorableFrozenSet,
+                        RestorableFrozenDict)):
+                    self.assertTrue(shallow is original)
+                    continue
+                self.assertEqual(type(restorable), type(shallow))
+                self.assertFalse(shallow._contents is original._contents)
+        lru = RestorableLRUDict(2)
+        lru[e[0]] = 0
+        shallow = copy.copy(lru)
+        shallow[e[1]] = 1
+        shallow[e[0]]
+        self.assertEqual((0, 0), (lru.hits, lru.evictions))
+        self.assertEqual([e[0]], list(lru.keys()))
+        self.assertEqual([e[1], e[0]], list(shallow.keys()))
+
+    def test_deep(self):
+
+        e = [ C(0), C(1) ]
+        for restorable in self.restorables(e):
+            deep = copy.deepcopy(restorable)
+            self.assertEqual(type(restorable), type(deep))
+            self.assertEqual(len(restorable), len(deep))
+            if isinstance(restorable, RestorableWeakKeyDict):
+                self.assertTrue(next(iter(deep)) is e[0])
+            elif isinstance(restorable, RestorableWeakValueDict):
+                self.assertTrue(next(deep.itervalues()) is e[0])
+            else:
+                self.assertFalse(next(iter(deep)) is e[0])
+
+    def test_deep_cycles(self):
+
+        e = [ C(v) for v in range(3) ]
+        d = RestorableDict((c, c.v) for c in e)
+        s = RestorableSet(e)
+        for c in e:
+            c.owner = (d, s) # cycles through the keys
+
+        du, su = copy.deepcopy((d, s))
+        self.assertFalse(type(du)._requires_restoration)
+        self.assertEqual(3, len(du))
+        for c in du:
+            self.assertTrue(c.owner[0] is du)
+            self.assertTrue(c in su)
+
+        # copying starts from a key, whose copy is incomplete while the
+        # collections are being copied
+        c0 = copy.deepcopy(e[0])
+        du, su = c0.owner
+        self.assertTrue(type(du)._requires_restoration)
+        self.assertEqual(0, du[c0])
+        self.assertTrue(c0 in su)
+        self.assertEqual(set([0, 1, 2]), set(c.v for c in su))
+
+    def test_deep_pending(self):
+
+        e = [ C(v) for v in range(2) ]
+        for restorable in self.restorables(e):
+            eu, pending = pickle.loads(pickle.dumps((e, restorable)))
+            eu_copy, deep = copy.deepcopy((eu, pending))
+            self.assertTrue(type(pending)._requires_restoration)
+            self.assertEqual(len(restorable), len(deep))
+            self.assertEqual(type(restorable),
+                getattr(type(deep), '_restored_class', type(deep)))
+            if not isinstance(restorable, (RestorableWeakKeyDict,
+                    RestorableWeakValueDict)):
+                self.assertTrue(next(iter(deep)) is eu_copy[0])
+
+        lru = RestorableLRUDict(2)
+        lru.put(e[0], [0], ttl = 3600)
+        lru[e[1]] = [1]
+        lru[e[0]]
+        deep = copy.deepcopy(lru)
+        self.assertEqual((2, 1), (deep.capacity, deep.hits))
+        keys = list(deep.keys())
+        self.assertEqual([1, 0], [ c.v for c in keys ])
+        self.assertEqual(set([keys[1]]), set(deep._expiries))
+        self.assertEqual([0], deep[keys[1]])
+        self.assertFalse(deep[keys[1]] is lru[e[0]])
+        d = copy.deepcopy(RestorableDefaultDict(list, { 1 : [1] }))
+        self.assertEqual(([1], []), (d[1], d[2]))
+
+    def test_subclass_state(self):
+
+        e = [ C(0), C(1) ]
+        tagged = TaggedDict('tag', { e[0] : [0] })
+        shallow = copy.copy(tagged)
+        self.assertEqual(TaggedDict, type(shallow))
+        self.assertEqual('tag', shallow.tag)
+        self.assertEqual(tagged, shallow)
+        self.assertTrue(shallow[e[0]] is tagged[e[0]])
+        shallow[e[1]] = [1]
+        self.assertEqual(1, len(tagged))
+        deep = copy.deepcopy(tagged)
+        self.assertEqual(TaggedDict, type(deep))
+        self.assertEqual('tag', deep.tag)
+        self.assertEqual([0], next(iter(deep.values())))
+        self.assertFalse(next(iter(deep)) is e[0])
+
+
+class MappedDictTestCase(TestCase):
+    """
+    Tests the file-backed :class:`RestorableMappedDict`, including eviction of
+    shards and restoration of cycles through the keys of shards.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'mapped')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mapping(self):
+
+        expected = { 'k{}'.format(i) : i for i in range(100) }
+        expected.update({ i : 'v{}'.format(i) for i in range(100) })
+        with RestorableMappedDict(self.path, 8, None, None, expected) as m:
+            self.assertEqual(200, len(m))
+            self.assertEqual(expected, m)
+            self.assertEqual(0, m['k0'])
+            self.assertTrue(1.0 in m)
+            self.assertFalse('missing' in m)
+            self.assertEqual(None, m.get('missing'))
+            del m['k1']
+            del expected['k1']
+            self.assertEqual(2, m.pop('k2'))
+            del expected['k2']
+            self.assertEqual('_', m.pop('k2', '_'))
+            self.assertEqual(3, m.setdefault('k3', None))
+            self.assertEqual((1, 2), m.setdefault((1, 2), (1, 2)))
+            expected[(1, 2)] = (1, 2)
+            key, value = m.popitem()
+            self.assertEqual(expected.pop(key), value)
+            self.assertEqual(expected, m)
+            self.assertEqual(set(expected.items()), set(m.items()))
+        with RestorableMappedDict(self.path) as m:
+            self.assertEqual(expected, m)
+            m.clear()
+            self.assertEqual(0, len(m))
+        with RestorableMappedDict(self.path) as m:
+            self.assertEqual({}, m)
+        with RestorableMappedDict(self.path) as m:
+            m['k'] = 1
+            unpickled = pickle.loads(pickle.dumps(m))
+        # looked up before anything else restores it
+        self.assertTrue('k' in unpickled)
+        self.assertEqual(1, unpickled['k'])
+        unpickled.close()
+        self.assertRaises(TypeError, m.__setitem__, object(), None)
+        self.assertRaises(ValueError, RestorableMappedDict, __file__)
+        self.assertTrue(isinstance(m, MutableMapping))
+
+    def test_budget(self):
+
+        expected = { i : 'v' * 100 for i in range(1000) }
+        m = RestorableMappedDict(self.path, 16, None, 200, expected)
+        self.assertTrue(len(m._contents) < 16)
+        self.assertEqual(expected, m)
+        self.assertTrue(sum(len(shard)
+            for shard in m._contents.values()) <= 200 + 1000 // 16)
+        m.flush()
+        size = os.path.getsize(self.path)
+        m.flush()
+        self.assertEqual(size, os.path.getsize(self.path))
+        m[0] = 'changed'
+        expected[0] = 'changed'
+        self.assertEqual(expected, dict(m.iteritems()))
+        m.close()
+        self.assertTrue(os.path.getsize(self.path) > size)
+        m = RestorableMappedDict(self.path, 16, None, 1)
+        self.assertEqual(1000, len(m))
+        self.assertEqual(0, len(m._contents))
+        self.assertEqual('changed', m[0])
+        self.assertEqual(1, len(m._contents))
+        self.assertEqual(expected, m)
+        self.assertEqual(1, len(m._contents))
+        m.close()
+
+    def test_eviction(self):
+
+        keys = [ C(v) for v in range(8) ] # equal only to themselves
+        m = RestorableMappedDict(self.path, 8, c_partition, 1)
+        for c in keys:
+            m[c] = [c.v]
+        self.assertEqual(2, len(m._contents))
+        for c in keys:
+            self.assertEqual([c.v], m[c])
+            self.assertTrue(c in m)
+        self.assertFalse(keys[0] in list(m))
+        self.assertEqual(8, len(m))
+
+        m[keys[0]].append('changed')
+        m.get(keys[1]).append('changed')
+        m.setdefault(keys[2], None).append('changed')
+        for c in keys[3:]:
+            m[c]
+        self.assertEqual([0, 'changed'], m[keys[0]])
+        self.assertEqual([1, 'changed'], m[keys[1]])
+        self.assertEqual([2, 'changed'], m[keys[2]])
+        m[keys[3]] = 3
+        self.assertEqual(3, m.pop(keys[3]))
+        del m[keys[4]]
+        self.assertRaises(KeyError, m.__delitem__, keys[4])
+        self.assertEqual(6, len(m))
+        m.close()
+
+        m = RestorableMappedDict(self.path, 8, c_partition)
+        self.assertEqual([[0, 'changed'], [1, 'changed'], [2, 'changed'],
+            [5], [6], [7]], sorted(m.values(), key = lambda v: v[0]))
+        m.close()
+
+    def test_cycles(self):
+
+        g = cyclic_group()
+        m = RestorableMappedDict(self.path, 1, c_partition)
+        for c in g.elements:
+            # built-in dictionaries unpickled through cycles are corrupt and
+            # cannot be pickled again once looking up c rewrites its shard
+            del c.plain, c.plain_ordered, c.plain_default
+            m[c] = c
+        m.close()
+
+        m = RestorableMappedDict(self.path, 1, c_partition)
+        self.assertEqual(2, len(m))
+        c1, c2 = sorted(m, key = c_partition)
+        self.assertTrue(m[c1] is c1)
+        self.assertTrue(m[c2] is c2)
+        self.assertEqual((c1, 'a'), c1.restorable_plain[c1])
+        self.assertEqual((c2, 'b'), c1.restorable_plain[c2])
+        self.assertEqual((c1, 'a'), c2.restorable_plain[c1])
+        m.close()
+
+    def test_pickle(self):
+
+        m = RestorableMappedDict(self.path, 4, None, 1024, { 'a' : 1 })
+        m['b'] = 2
+        data = pickle.dumps(m, pickle.HIGHEST_PROTOCOL)
+        m.close()
+        unpickled = pickle.loads(data)
+        self.assertTrue(type(unpickled)._requires_restoration)
+        self.assertEqual({ 'a' : 1, 'b' : 2 }, unpickled)
+        self.assertEqual((self.path, None, 1024),
+            (unpickled.path, unpickled.partition, unpickled.budget))
+        unpickled.close()
+        with self.assertRaises(TypeError):
+            copy.copy(unpickled)
+        with self.assertRaises(TypeError):
+            unpickled.snapshot()
+        missing = pickle.loads(pickle.dumps(unpickled))
+        os.remove(self.path)
+        self.assertRaises(IOError, len, missing)
+
+
+@skipIf(PickleBuffer is None, 'pickle protocol 5 is not available')
+class OutOfBandTestCase(TestCase):
+    """
+    Tests pickling large binary values of restorable collections out of band
+    with pickle protocol 5, including values of cyclic keys.
+    """
+
+    def setUp(self):
+        self.large = b'x' * OUT_OF_BAND_THRESHOLD
+        self.writable = bytearray(OUT_OF_BAND_THRESHOLD)
+        self.elements = [ C(v) for v in range(3) ]
+
+    def test_out_of_band(self):
+
+        e = self.elements
+        for restorable in (RestorableDict(), RestorableOrderedDict(),
+                RestorableDefaultDict(c_factory), RestorableFrozenDict(),
+                RestorableLRUDict(3), ):
+            contents = ((e[0], self.large), (e[1], self.writable),
+                (e[2], b'small'))
+            if isinstance(restorable, RestorableFrozenDict):
+                restorable = RestorableFrozenDict(contents)
+            else:
+                restorable.update(contents)
+            for c in e:
+                c.owner = restorable # cycles through the keys
+
+            buffers = []
+            data = pickle.dumps(restorable, 5,
+                buffer_callback = buffers.append)
+            self.assertEqual(2, len(buffers))
+            self.assertTrue(len(data) < OUT_OF_BAND_THRESHOLD)
+            unpickled = pickle.loads(data, buffers = buffers)
+            eu = sorted(unpickled, key = c_partition)
+            for c in eu:
+                self.assertTrue(c.owner is unpickled)
+            self.assertEqual(self.large, bytes(memoryview(unpickled[eu[0]])))
+            self.assertEqual(b'small', unpickled[eu[2]])
+            # loading out of band does not copy
+            memoryview(unpickled[eu[1]])[0] = 1
+            self.assertEqual(1, self.writable[0])
+            self.writable[0] = 0
+
+            # pickled in band, values keep their types
+            unpickled = pickle.loads(pickle.dumps(restorable, 5))
+            eu = sorted(unpickled, key = c_partition)
+            self.assertTrue(type(unpickled[eu[0]]) is bytes)
+            self.assertTrue(type(unpickled[eu[1]]) is bytearray)
+            self.assertEqual(self.large, unpickled[eu[0]])
+            self.assertEqual(self.writable, unpickled[eu[1]])
+
+    def test_pending_and_snapshot(self):
+
+        d = RestorableDict({ 0 : self.large, 1 : b'small' })
+        pending = pickle.loads(pickle.dumps(d, 5))
+        with d.snapshot() as snapshot:
+            for restorable in (pending, snapshot):
+                buffers = []
+                data = pickle.dumps(restorable, 5,
+                    buffer_callback = buffers.append)
+                self.assertEqual(1, len(buffers))
+                self.assertTrue(pending._requires_restoration)
+                unpickled = pickle.loads(data, buffers = buffers)
+                self.assertEqual(b'small', unpickled[1])
+                self.assertEqual(self.large, bytes(memoryview(unpickled[0])))
+
+        # earlier protocols pickle values in band
+        self.assertTrue(len(pickle.dumps(d, 4)) > OUT_OF_BAND_THRESHOLD)
+
+    def test_subclass_state(self):
+
+        # whose state is unknown to restorable collections
+        tagged = TaggedDict('tag', { 0 : self.large })
+        unpickled = pickle.loads(pickle.dumps(tagged, 5))
+        self.assertEqual('tag', unpickled.tag)
+        self.assertEqual(self.large, unpickled[0])
+
+
+
+class RestorablePicklerTestCase(TestCase):
+    """
+    Tests pickling built-in dictionaries and sets featuring cycles through their
+    keys with :class:`RestorablePickler` and :class:`RestorableUnpickler`.
+    """
+
+    def pickle_and_unpickle(self, obj, protocol = None):
+        f = BytesIO()
+        RestorablePickler(f, protocol).dump(obj)
+        f.seek(0)
+        return RestorableUnpickler(f).load()
+
+    def test_dict_cycles(self):
+
+        for protocol in range(1, pickle.HIGHEST_PROTOCOL + 1):
+            gu = self.pickle_and_unpickle(cyclic_group(), protocol)
+            c1u, c2u = gu.elements
+            for c in (c1u, c2u):
+                self.assertTrue(type(c.plain) is dict)
+                self.assertTrue(type(c.plain_ordered) is OrderedDict)
+                self.assertTrue(type(c.plain_default) is defaultdict)
+                self.assertTrue(c.plain_default.default_factory is c_factory)
+
+            self.assertEqual(c1u, c1u.plain[c1u][0])
+            self.assertEqual(c2u, c1u.plain[c2u][0])
+            self.assertEqual(c1u, c2u.plain[c1u][0])
+            self.assertEqual([c1u, c2u], list(c1u.plain_ordered))
+            self.assertEqual('b', c1u.plain_ordered[c2u][1])
+            self.assertEqual('a', c2u.plain_default[c1u][1])
+            self.assertEqual(1, len(c2u.plain_default))
+            self.assertEqual(c1u, c1u.restorable_plain[c1u][0])
+
+    def test_set_cycles(self):
+
+        d1 = D(1)
+        d2 = D(2)
+        d1.add(d1)
+        d1.add(d2)
+        d2.add(d1)
+        d1u, d2u = self.pickle_and_unpickle([d1, d2])
+        self.assertTrue(type(d1u.plain) is set)
+        self.assertEqual(set([d1u, d2u]), d1u.plain)
+        self.assertTrue(d1u in d2u.plain)
+        self.assertTrue(d1u in d1u.restorable_plain)
+
+    def test_shared(self):
+
+        c = C(1)
+        shared = { c : 'a' }
+        lu = self.pickle_and_unpickle([shared, shared, { 'atomic' : shared }])
+        self.assertTrue(lu[0] is lu[1])
+        self.assertTrue(lu[0] is lu[2]['atomic'])
+        self.assertEqual('a', lu[0][list(lu[0])[0]])
+
+    def test_consumed(self):
+
+        c1 = C(1)
+        c2 = C(2)
+        for protocol in range(1, pickle.HIGHEST_PROTOCOL + 1):
+            # reconstructed from a dictionary, which is copied
+            counter = self.pickle_and_unpickle(Counter({ c1 : 3, c2 : 5 }),
+                protocol)
+            self.assertTrue(type(counter) is Counter)
+            self.assertEqual({ 1 : 3, 2 : 5 },
+                dict((c.v, counter[c]) for c in counter))
+
+            # set from a state passed to __setstate__
+            shared = { c1 : 'a' }
+            lu = self.pickle_and_unpickle([partial(dict, shared), shared],
+                protocol)
+            self.assertTrue(lu[0].args[0] is lu[1])
+            self.assertEqual([ (1, 'a') ],
+                [ (c.v, v) for c, v in lu[0]().items() ])
+            self.assertRaises(pickle.PicklingError, self.pickle_and_unpickle,
+                [shared, partial(dict, shared)], protocol)
+
+    def test_protocol_0(self):
+        self.assertRaises(ValueError, RestorablePickler, BytesIO(), 0)
+
+
+
+class CyclicCollectionsTestCase(TestCase):
+    """
+    Tests reporting the built-in collections of an object graph which require
+    restorable wrapping, both as a library function and from the command line.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cycles(self):
+
+        found = find_cyclic_collections(cyclic_group(), 'g')
+        self.assertEqual([
+            ('g.elements[0].plain', 2, 2),
+            ('g.elements[0].plain_default', 2, 2),
+            ('g.elements[0].plain_ordered', 2, 2),
+            ('g.elements[1].plain', 1, 1),
+            ('g.elements[1].plain_default', 1, 1),
+            ('g.elements[1].plain_ordered', 1, 1),
+        ], sorted((f.path, f.size, len(f.keys)) for f in found))
+
+        d1 = D(1)
+        d2 = D(2)
+        d1.add(d1)
+        d1.add(d2)
+        d2.add(d1)
+        found = find_cyclic_collections([d1, d2])
+        self.assertEqual(['obj[0].plain', 'obj[1].plain'],
+            sorted(f.path for f in found))
+        self.assertEqual(set([d1, d2]), set(found[0].keys))
+        self.assertEqual(2, found[0].size)
+
+    def test_no_cycles(self):
+
+        c1 = C(1)
+        c2 = C(2)
+        c1.add(c2, 'a')
+        self.assertEqual([], find_cyclic_collections(c1))
+
+        # keys hashed by identity are safe
+        g1 = Group('g1')
+        g1.elements.append({ g1 : set([g1]) })
+        self.assertEqual([], find_cyclic_collections(g1))
+
+        # labels are only formatted for the paths which are reported
+        class Unrepresentable(object):
+            def __repr__(self):
+                raise AssertionError('labelled')
+        self.assertEqual([], find_cyclic_collections(
+            { Unrepresentable() : [ Unrepresentable() ] }))
+
+    def test_pending(self):
+
+        gu = pickle.loads(pickle.dumps(cyclic_group()))
+        self.assertEqual(6, len(find_cyclic_collections(gu)))
+        self.assertTrue(gu.elements[0].restorable_plain._requires_restoration)
+
+    def test_command_line(self):
+
+        source = os.path.join(self.directory, 'graph.pickle')
+        output = os.path.join(self.directory, 'report.json')
+        with open(source, 'wb') as f:
+            RestorablePickler(f).dump(cyclic_group())
+        analyze([source, '--output', output])
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(6, len(report))
+        self.assertEqual(set(['dict', 'OrderedDict', 'defaultdict']),
+            set(found['type'] for found in report))
+
+        analyze(['restorable_collections_tests.helpers:cyclic_group',
+            '--call', '--output', output])
+        with open(output) as f:
+            report = json.load(f)
+        self.assertTrue(
+            'restorable_collections_tests.helpers:cyclic_group()'
+            '.elements[1].plain' in [ found['path'] for found in report ])
+
+
+
+class ShardedDictTestCase(TestCase):
+    """
+    Tests :class:`RestorableShardedDict`, and checkpointing it in parallel
+    with :func:`dump_sharded` and :func:`load_sharded`, including cycles
+    through keys of different shards.
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cyclic_sharded(self):
+        """
+        :return: a :class:`RestorableShardedDict` of four shards, whose keys
+            refer to one another across shards, both directly and through the
+            keys of their restorable collections.
+        """
+        g = cyclic_group()
+        elements = g.elements + [ C(v) for v in range(2, 10) ]
+        sharded = RestorableShardedDict(4, c_partition)
+        for c in elements:
+            successor = elements[(elements.index(c) + 1) % len(elements)]
+            c.successor = successor
+            c.successors = RestorableSet([ successor ])
+            sharded[c] = g
+        return sharded
+
+    def assertCyclic(self, sharded):
+        self.assertEqual(10, len(sharded))
+        elements = sorted(sharded, key = c_partition)
+        g = sharded[elements[0]]
+        for c in elements:
+            self.assertTrue(sharded[c] is g)
+            self.assertTrue(c.successor in elements)
+            self.assertTrue(c.successor in c.successors)
+        c1, c2 = g.elements
+        self.assertTrue(c1 in elements)
+        self.assertTrue(c1.restorable_plain[c2][0] is c2)
+        self.assertTrue(c2.restorable_keyed[c1][0] is c1)
+
+    def test_mapping(self):
+
+        expected = { 'k{}'.format(i) : i for i in range(100) }
+        expected.update({ i : 'v{}'.format(i) for i in range(100) })
+        sharded = RestorableShardedDict(8, None, expected)
+        self.assertEqual(200, len(sharded))
+        self.assertEqual(expected, sharded)
+        self.assertTrue(all(sharded._contents))
+        self.assertEqual(0, sharded['k0'])
+        self.assertTrue(1.0 in sharded)
+        self.assertEqual(None, sharded.get('missing'))
+        self.assertEqual(2, sharded.pop('k2'))
+        del expected['k2']
+        self.assertEqual((1, 2), sharded.setdefault((1, 2), (1, 2)))
+        expected[(1, 2)] = (1, 2)
+        key, value = sharded.popitem()
+        self.assertEqual(expected.pop(key), value)
+        self.assertEqual(set(expected.items()), set(sharded.items()))
+        self.assertEqual(expected, copy.copy(sharded))
+        sharded.clear()
+        self.assertEqual({}, sharded)
+        self.assertRaises(TypeError, sharded.__setitem__, object(), None)
+        self.assertRaises(ValueError, RestorableShardedDict, 0)
+        self.assertTrue(isinstance(sharded, MutableMapping))
+
+    def test_pickle(self):
+
+        self.assertCyclic(pickle.loads(pickle.dumps(self.cyclic_sharded())))
+        self.assertCyclic(copy.deepcopy(self.cyclic_sharded()))
+
+    def test_dump_and_load(self):
+
+        sharded = self.cyclic_sharded()
+        for processes in (1, 2):
+            dump_sharded(sharded, self.directory, processes)
+            loaded = load_sharded(self.directory)
+            self.assertTrue(all(shard._requires_restoration
+                for shard in loaded._contents))
+            self.assertCyclic(loaded)
+
+        # checkpoints replace one another
+        del sharded[sorted(sharded, key = c_partition)[-1]]
+        dump_sharded(sharded, self.directory)
+        self.assertEqual(9, len(load_sharded(self.directory)))
+        self.assertRaises(ValueError, dump_sharded, sharded, self.directory,
+            1, 1)
+
+    def test_interrupted(self):
+
+        def shards(directory):
+            return sorted(name for name in os.listdir(directory)
+                if name.startswith('shard-'))
+
+        sharded = self.cyclic_sharded()
+        dump_sharded(sharded, self.directory, 1)
+        self.assertEqual(4, len(shards(self.directory)))
+
+        # shards written without their index leave the checkpoint intact
+        del sharded[sorted(sharded, key = c_partition)[-1]]
+        following = os.path.join(self.directory, 'following')
+        dump_sharded(sharded, following, 1)
+        for name in shards(following):
+            shutil.copy(os.path.join(following, name), self.directory)
+        self.assertEqual(8, len(shards(self.directory)))
+        self.assertCyclic(load_sharded(self.directory))
+
+        # and are removed by the next checkpoint
+        dump_sharded(sharded, self.directory, 1)
+        self.assertEqual(4, len(shards(self.directory)))
+        self.assertEqual(9, len(load_sharded(self.directory)))
+
+        # shards of another generation are rejected
+        current = shards(self.directory)
+        shutil.copy(os.path.join(following, shards(following)[0]),
+            os.path.join(self.directory, current[0]))
+        self.assertRaises(pickle.UnpicklingError, load_sharded,
+            self.directory)
+
+        # and so are references to objects which no shard defines, such as
+        # the last shard once the index omits it
+        for i, c in enumerate(sorted(sharded, key = c_partition)):
+            c.shard = sharded._contents[i % 4]
+        dump_sharded(sharded, self.directory, 1)
+        index = os.path.join(self.directory, 'index.pickle')
+        with open(index, 'rb') as f:
+            count, partition, generation = pickle.load(f)
+        with open(index, 'wb') as f:
+            pickle.dump((count - 1, partition, generation), f)
+        self.assertRaises(pickle.UnpicklingError, load_sharded,
+            self.directory)
+
+    def test_shared_references(self):
+
+        sharded = self.cyclic_sharded()
+        elements = sorted(sharded, key = c_partition)
+        g = sharded[elements[0]]
+        for i, c in enumerate(elements):
+            c.owner = sharded
+            c.shard = sharded._contents[i % 4]
+            c.pair = (g.elements, g)
+        for processes in (1, 2):
+            dump_sharded(sharded, self.directory, processes)
+            loaded = load_sharded(self.directory)
+            self.assertCyclic(loaded)
+            elements = sorted(loaded, key = c_partition)
+            g = loaded[elements[0]]
+            for i, c in enumerate(elements):
+                self.assertTrue(c.owner is loaded)
+                self.assertTrue(c.shard is loaded._contents[i % 4])
+                self.assertTrue(c.pair[0] is g.elements)
+                self.assertTrue(c.pair[1] is g)
+
+        # mutable objects which cannot be owned are not duplicated silently
+        shared = []
+        sharded = RestorableShardedDict(4, None,
+            { i : (shared, ) for i in range(16) })
+        self.assertRaises(ValueError, dump_sharded, sharded, self.directory)
@@ -48,7 +48,8 @@ from collections import OrderedDict, defaultdict
 
 # Restorable Collections
 from restorable_collections import RestorableDict, RestorableOrderedDict, \
-    RestorableDefaultDict, RestorableSet
+    RestorableDefaultDict, RestorableOrderedDefaultDict, RestorableKeyedDict, \
+    RestorableSet, RestorableOrderedSet
 
 
 class Group(object):
@@ -62,6 +63,26 @@ class Group(object):
         return "Group({})".format(self.name)
 
 
+class TaggedDict(RestorableDict):
+    """
+    A :class:`RestorableDict` holding state of its own, which it pickles along
+    with its entries.
+    """
+
+    __slots__ = ('tag', )
+
+    def __init__(self, tag, *args, **kwargs):
+        RestorableDict.__init__(self, *args, **kwargs)
+        self.tag = tag
+
+    def __getstate__(self):
+        return self.tag, RestorableDict.__getstate__(self)
+
+    def __setstate__(self, state):
+        self.tag, entries = state
+        RestorableDict.__setstate__(self, entries)
+
+
 class C(object):
 
     def __init__(self, v):
@@ -73,6 +94,9 @@ class C(object):
         self.restorable_plain = RestorableDict()
         self.restorable_ordered = RestorableOrderedDict()
         self.restorable_default = RestorableDefaultDict(c_factory)
+        self.restorable_ordered_default = RestorableOrderedDefaultDict(
+            c_factory)
+        self.restorable_keyed = RestorableKeyedDict(self, 'restorable_keyed')
 
     def add(self, key, value):
         self.plain[key] = (key, value)
@@ -81,6 +105,8 @@ class C(object):
         self.restorable_plain[key] = (key, value)
         self.restorable_ordered[key] = (key, value)
         self.restorable_default[key] = (key, value)
+        self.restorable_ordered_default[key] = (key, value)
+        self.restorable_keyed[key] = (key, value)
 
     def __hash__(self):
         return hash(self.v) if hasattr(self, 'v') else id(self)
@@ -92,13 +118,34 @@ class C(object):
         return key.v
 
     def restoration_map(self, d, identifier = None):
-        return { v : c[0] for v, c in d.iteritems() }
+        return { v : c[0] for v, c in d.items() }
+
+
+def cyclic_group():
+    """
+    :return: a :class:`Group` of two :class:`C` elements featuring both self
+        and mutual cycles.
+    """
+    g = Group("group")
+    c1 = C(42)
+    g.elements.append(c1)
+    c2 = C(67)
+    g.elements.append(c2)
+
+    c1.add(c1, 'a') # cycle to itself
+    c1.add(c2, 'b') # points to c2, which points to c1, forming cycle
+    c2.add(c1, 'a')
+    return g
 
 
 def c_factory():
     return (C(0), '_')
 
 
+def c_partition(c):
+    return c.v
+
+
 class D(object):
 
     def __init__(self, v):
@@ -106,10 +153,12 @@ class D(object):
         self.v = v
         self.plain = set()
         self.restorable_plain = RestorableSet()
+        self.restorable_ordered = RestorableOrderedSet()
 
     def add(self, item):
         self.plain.add(item)
         self.restorable_plain.add(item)
+        self.restorable_ordered.add(item)
 
     def __hash__(self):
         return hash(self.v) if hasattr(self, 'v') else id(self)